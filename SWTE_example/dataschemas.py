@@ -40,7 +40,7 @@ ds_datetime = "<http://DateTimeDataSchema>"
 
 def YSAPEngine(path_to_ysap):
     with open(path_to_ysap, "r") as sap_file:
-        ysap = SAPObject(yaml.load(sap_file))
+        ysap = SAPObject(yaml.load(sap_file, Loader=yaml.SafeLoader))
     return SEPA(sapObject=ysap)
 
 
@@ -55,28 +55,28 @@ def main(args):
         {"ds_uri": ds_threshold,
          "fs_uri": "<http://localhost:9876/threshold>",
          "fs_types": "swot:FieldSchema, xsd:Literal"}).post()
-    threshold_dataschema.dsServer_start("localhost", 8322)
+    threshold_dataschema.dsServer_start("localhost", 8322, shared=True)
          
     hotcold_dataschema = DataSchema(
         engine,
         {"ds_uri": ds_psi,
          "fs_uri": "<http://localhost:9876/hotcold>",
          "fs_types": "swot:FieldSchema, xsd:Literal"}).post()
-    hotcold_dataschema.dsServer_start("localhost", 8323)
+    hotcold_dataschema.dsServer_start("localhost", 8322, shared=True)
          
     temperature_dataschema = DataSchema(
         engine,
         {"ds_uri": ds_lambda,
          "fs_uri": "_:FloatFS-BlankNode",
          "fs_types": "swot:FieldSchema, xsd:float"}).post()
-    temperature_dataschema.dsServer_start("localhost", 8324)
+    temperature_dataschema.dsServer_start("localhost", 8322, shared=True)
          
     datetime_dataschema = DataSchema(
         engine,
         {"ds_uri": ds_datetime,
          "fs_uri": "_:DatetuneFS-BlankNode",
          "fs_types": "swot:FieldSchema, xsd:dateTime"}).post()
-    datetime_dataschema.dsServer_start("localhost", 8325)
+    datetime_dataschema.dsServer_start("localhost", 8322, shared=True)
     
     print("Ctrl-C to stop servers...")
     try:
@@ -26,6 +26,7 @@ from cocktail.Thing import Thing
 from cocktail.Action import *
 from cocktail.Event import *
 from cocktail.Property import *
+from cocktail.registry import LiveResultSet
 
 from dataschemas import ds_psi, ds_lambda, YSAPEngine
 from time import sleep
@@ -94,11 +95,14 @@ def main(args):
     local_engine.update("ADD_HOTCOLD_CONTEXT_TRIPLES", forcedBindings={"hc": HotColdURI})
 
     # main hotcold event search logic
-    local_engine.subscribe(
-        "HOTCOLD_SMART_DISCOVERY", 
-        "hotcold_subscription", 
-        forcedBindings={"ds": ds_lambda}, 
-        handler=available_sensors)
+    # (events removed and added back by the same update are not notified)
+    sensors = LiveResultSet(
+        local_engine,
+        "HOTCOLD_SMART_DISCOVERY",
+        "event",
+        forcedBindings={"ds": ds_lambda},
+        on_change=available_sensors,
+        alias="hotcold_subscription").start()
     
     #
     # DEVICE LOOP
@@ -110,6 +114,7 @@ def main(args):
     except KeyboardInterrupt:
         print("Got KeyboardInterrupt!")
     mainHC_Action.disable()
+    sensors.stop()
     return 0
     
 
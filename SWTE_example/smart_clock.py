@@ -24,11 +24,11 @@
 
 from cocktail.Thing import Thing
 from cocktail.Action import *
+from cocktail.dispatcher import Dispatcher
 
 from dataschemas import ds_datetime, ds_lambda, YSAPEngine
 from time import sleep, time
 from datetime import datetime
-from uuid import uuid4
 from temperature import simulate
 
 import sys
@@ -50,11 +50,9 @@ def main(args):
     def timeActionHandler(added, removed):
         print(added)
         if added != []:
-            whatTimeIsIt.post_output(
-                {"instance": added[0]["aInstance"]["value"], 
-                 "oData": "<http://SmartClock.swot/TimeAction/Data_{}>".format(uuid4()),
-                 "oValue": datetime.fromtimestamp(time()).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-                 "oDS": ds_datetime})
+            whatTimeIsIt.post_output(whatTimeIsIt.next_output_bindings(
+                added[0]["aInstance"]["value"],
+                datetime.fromtimestamp(time()).strftime('%Y-%m-%dT%H:%M:%S.%fZ')))
         
     # Setup the Hot/Cold Action
     whatTimeIsIt = Action(
@@ -68,11 +66,8 @@ def main(args):
     def temperatureActionHandler(added, removed):
         print(added)
         if added != []:
-            whatTimeIsIt.post_output(
-                {"instance": added[0]["aInstance"]["value"], 
-                 "oData": "<http://SmartClock.swot/TemperatureAction/Data_{}>".format(uuid4()),
-                 "oValue": str(simulate()),
-                 "oDS": ds_lambda})
+            whatsTheTemperature.post_output(whatsTheTemperature.next_output_bindings(
+                added[0]["aInstance"]["value"], str(simulate())))
         
     whatsTheTemperature = Action(
         engine,
@@ -92,8 +87,11 @@ def main(args):
          "newName": "SmartClock",
          "newTD": ClockTD}).post(interaction_patterns=[whatTimeIsIt, whatsTheTemperature])
          
+    # the temperature is read through http: its requests are handled
+    # by the dispatcher workers, not by the subscription thread
+    dispatcher = Dispatcher(max_workers=4)
     whatTimeIsIt.enable()
-    whatsTheTemperature.enable()
+    whatsTheTemperature.enable(dispatcher=dispatcher, concurrency=2)
     
     local_engine = YSAPEngine("./example.ysap")
     # adding context triples
@@ -109,6 +107,7 @@ def main(args):
             print("Got KeyboardInterrupt!")
             whatTimeIsIt.disable()
             whatsTheTemperature.disable()
+            dispatcher.shutdown()
             break
     
     return 0
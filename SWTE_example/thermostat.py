@@ -28,9 +28,9 @@ from temperature import simulate
 from cocktail.Thing import Thing
 from cocktail.Action import *
 from cocktail.Event import *
+from cocktail.registry import ThingRegistry, LiveResultSet
 
 from time import sleep
-from uuid import uuid4
 from threading import Lock
 
 from dataschemas import ds_threshold, ds_lambda, ds_psi, YSAPEngine
@@ -42,17 +42,23 @@ T_low = 15
 T_high = 27
 
 thresholdLock = Lock()
-actuatorListLock = Lock()
-actuatorList = []
+actuatorObjectsLock = Lock()
+actuatorObjects = {}
+actuators = None
 engine = None
+registry = None
 
 
 def main(args):
     global engine
+    global registry
+    global actuators
     # opening the sap file, and creating the SEPA instance
     engine = YSAPEngine("./cocktail_sap.ysap")
     if "clear" in args:
         engine.clear()
+    # local copy of the environment, used to build the actuators' Actions
+    registry = ThingRegistry(engine).start()
     
     #
     # IDENTIFICATION OF INTERACTION PATTERNS
@@ -99,25 +105,23 @@ def main(args):
     threshold_Action.enable()
     
     # main thermostat triggering logic
-    local_engine.subscribe(
-        "THERMOSTAT_SMART_DISCOVERY", 
-        "thermostat_subscription", 
-        forcedBindings={"ds": ds_psi}, 
-        handler=available_actuators)
+    actuators = LiveResultSet(
+        local_engine,
+        "THERMOSTAT_SMART_DISCOVERY",
+        "action",
+        forcedBindings={"ds": ds_psi},
+        on_change=available_actuators,
+        alias="thermostat_subscription").start()
     
     #
     # DEVICE LOOP
     #
     # temperature Event triggering logic
-    event_bindings = {"event": temperature_Event.uri, "newDS": ds_lambda}
     try:
         while True:
             sleep(2)
-            unique_id = uuid4()
-            event_bindings["newEInstance"] = "<http://MyThermostat.swot/TemperatureEvent/Instance_{}>".format(unique_id)
-            event_bindings["newOData"] = "<http://MyThermostat.swot/TemperatureEvent/Data_{}>".format(unique_id)
             # in the real world this simulate() call would be a read to a temperature sensor!
-            event_bindings["newValue"] = str(simulate())
+            event_bindings = temperature_Event.next_instance_bindings(str(simulate()))
             temperature_Event.notify(event_bindings)
             with thresholdLock:
                 if float(event_bindings["newValue"]) < T_low:
@@ -131,6 +135,8 @@ def main(args):
     except Exception as ex:
         print("Temperature simulation failed! Check the simulation server: {}".format(ex))
     threshold_Action.disable()
+    actuators.stop()
+    registry.stop()
     thermostat.tdServer_stop()
     return 0
 
@@ -144,27 +150,39 @@ def threshold_update(added, removed):
         print("threshold_update removed: {}".format(removed))
     
 def available_actuators(added, removed):
-    with actuatorListLock:
-        for item in added:
-            print("Available actuator found: {}".format(item["action"]["value"]))
-            actuatorList.append(item["action"]["value"])
+    # the actuators themselves are kept by the LiveResultSet
+    for item in added:
+        print("Available actuator found: {}".format(item["action"]["value"]))
+    with actuatorObjectsLock:
         for item in removed:
-            actuatorList.remove(item["action"]["value"])
+            if item["action"]["value"] not in actuators:
+                actuatorObjects.pop(item["action"]["value"], None)
     
 def trigger_action(message):
-    with actuatorListLock:
+    actuatorList = actuators.keys()
+    with actuatorObjectsLock:
         if actuatorList == []:
             print("No trigger targets!")
         else: 
             print("Triggering {} - {}".format(actuatorList, message))
-            bindings = {"newAuthor": ThermostatURI, "newIValue": message, "newIDS": ds_psi}
             for action in actuatorList:
-                action_object = Action.buildFromQuery(engine, action)
-                unique_id = uuid4()
-                bindings["action"] = action
-                bindings["newAInstance"] = "<http://MyThermostat.swot/Request/Instance_{}>".format(unique_id)
-                bindings["newIData"] = "<http://MyThermostat.swot/Request/Data_{}>".format(unique_id)
-                instance, subids = action_object.newRequest(bindings)
+                if action not in actuatorObjects:
+                    actuatorObjects[action] = Action.buildFromQuery(engine, action, registry=registry)
+                action_object = actuatorObjects[action]
+                bindings = action_object.next_request_bindings(ThermostatURI, message)
+                request = action_object.request_async(bindings, timeout=30)
+                request.add_done_callback(request_done(action))
+
+
+def request_done(action):
+    def callback(request):
+        if request.cancelled():
+            print("Request to {} cancelled".format(action))
+        elif request.exception() is not None:
+            print("Request to {} failed: {}".format(action, request.exception()))
+        else:
+            print("Request to {} completed: {}".format(action, request.result()))
+    return callback
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -0,0 +1,188 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  hot_paths.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+#  Latency and throughput of the cocktail hot paths, against the
+#  in-process MemorySEPA engine, for fleets of increasing size. Results are
+#  stored as json, and can be compared with a previous run:
+#
+#      python3 -m benchmarks.hot_paths -s 10 100 -o new.json -b old.json
+#
+#  Use -h parameter to see the options.
+
+import sys
+import argparse
+import json
+import platform
+
+from time import perf_counter
+from datetime import datetime
+from pkg_resources import resource_filename
+from cocktail.Thing import Thing
+from cocktail.Action import Action
+from cocktail.Event import Event
+from cocktail.Property import Property
+from cocktail.utils import compare_queries
+from cocktail.memory_engine import MemorySEPA
+
+DS_STRING = "<http://XSDstringDataSchema.org>"
+DS_INTEGER = "<http://XSDintegerDataSchema.org>"
+DS_TIMESTAMP = "<http://XSDdateTimeStampDataSchema.org>"
+
+
+def statistics(latencies):
+    """
+    Summary of a list of latencies, in seconds
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {"operations": len(ordered),
+            "seconds": total,
+            "throughput": len(ordered)/total if total > 0 else None,
+            "mean_ms": total*1000/len(ordered),
+            "p50_ms": ordered[len(ordered)//2]*1000,
+            "p95_ms": ordered[min(int(len(ordered)*0.95), len(ordered)-1)]*1000,
+            "max_ms": ordered[-1]*1000}
+
+
+def measure(operation, repeat):
+    latencies = []
+    for index in range(repeat):
+        start = perf_counter()
+        operation(index)
+        latencies.append(perf_counter()-start)
+    return statistics(latencies)
+
+
+def fleet_member(engine, index):
+    """
+    A Thing with an IO Action, an Event and a Property
+    """
+    thing = "<http://Fleet.swot/Thing_{}>".format(index)
+    td = "<http://Fleet.swot/Thing_{}/TD>".format(index)
+    action = Action(engine,
+                    {"td": td, "action": "<http://Fleet.swot/Thing_{}/Action>".format(index),
+                     "newName": "Action_{}".format(index), "ids": DS_STRING, "ods": DS_STRING},
+                    lambda added, removed: None)
+    event = Event(engine,
+                  {"td": td, "event": "<http://Fleet.swot/Thing_{}/Event>".format(index),
+                   "eName": "Event_{}".format(index), "ods": DS_TIMESTAMP})
+    prop = Property(engine,
+                    {"td": td, "property": "<http://Fleet.swot/Thing_{}/Property>".format(index),
+                     "newName": "Property_{}".format(index), "newStability": "1000",
+                     "newWritability": "false", "newDS": DS_INTEGER,
+                     "newPD": "<http://Fleet.swot/Thing_{}/Property/Data>".format(index),
+                     "newValue": "0"})
+    return Thing(engine, {"thing": thing, "newName": "Thing_{}".format(index), "newTD": td}), [action, event, prop]
+
+
+def run(size, repeat):
+    """
+    Runs the benchmarks on a fleet of 'size' Things, repeating the
+    operations on a single item 'repeat' times
+    """
+    engine = MemorySEPA()
+    with open(resource_filename("cocktail.tests", "insert_dataschemas.sparql")) as dataschemas:
+        engine.sparql_update(dataschemas.read())
+    fleet = [fleet_member(engine, index) for index in range(size)]
+    results = {}
+    results["thing_post"] = measure(
+        lambda index: fleet[index][0].post(interaction_patterns=fleet[index][1]), size)
+
+    thing, (action, event, prop) = fleet[size//2]
+    results["event_notify"] = measure(
+        lambda index: event.notify(event.next_instance_bindings(str(index))), repeat)
+
+    def answer(added, removed):
+        for binding in added:
+            action.post_output(action.next_output_bindings(binding["aInstance"]["value"], "done"))
+    action.action_task = answer
+    action.enable()
+    image = Action.buildFromQuery(engine, action.uri)
+    results["action_request"] = measure(
+        lambda index: image.request_async(
+            image.next_request_bindings(thing.uri, str(index)), timeout=10).result(), repeat)
+    action.disable()
+
+    results["build_from_query"] = measure(
+        lambda index: Action.buildFromQuery(engine, fleet[index % size][1][0].uri), repeat)
+    results["to_jsonld"] = measure(lambda index: fleet[index % size][0].toJsonLD(), repeat)
+
+    everything = engine.query_all()
+    copy = json.loads(json.dumps(everything))
+    results["compare_queries"] = measure(lambda index: compare_queries(everything, copy), repeat)
+    results["compare_queries_indexed"] = measure(
+        lambda index: compare_queries(everything, copy, indexed=True), repeat)
+    results["store_triples"] = len(engine.graph)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the mean latencies of 'results' against the 'baseline' ones.
+    Returns the number of regressions, i.e. of latencies grown more
+    than 'tolerance' (a fraction).
+    """
+    regressions = 0
+    for size, benchmarks in results["results"].items():
+        for name, stats in benchmarks.items():
+            try:
+                old = baseline["results"][size][name]["mean_ms"]
+            except (KeyError, TypeError):
+                continue
+            ratio = stats["mean_ms"]/old if old > 0 else float("inf")
+            regression = ratio > 1+tolerance
+            regressions += regression
+            print("{:>6} {:<24} {:>10.3f} ms {:>10.3f} ms {:>7.2f}x{}".format(
+                size, name, old, stats["mean_ms"], ratio, "  REGRESSION" if regression else ""))
+    return regressions
+
+
+def main(args):
+    output = {"environment": {"python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "date": datetime.now().isoformat(),
+                              "repeat": args["repeat"]},
+              "results": {}}
+    for size in args["sizes"]:
+        output["results"][str(size)] = results = run(size, args["repeat"])
+        for name, stats in results.items():
+            if isinstance(stats, dict):
+                print("{:>6} {:<24} {:>10.3f} ms mean {:>10.3f} ms p95 {:>10.1f} ops/s".format(
+                    size, name, stats["mean_ms"], stats["p95_ms"], stats["throughput"] or 0))
+    with open(args["output"], "w") as destination:
+        json.dump(output, destination, indent=2)
+    if args["baseline"] is not None:
+        with open(args["baseline"]) as baseline:
+            if compare(output, json.load(baseline), args["tolerance"]):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cocktail hot paths benchmark")
+    parser.add_argument("-s", "--sizes", default=[10, 50], type=int, nargs="+", help="Fleet sizes (Things)")
+    parser.add_argument("-r", "--repeat", default=20, type=int, help="Repetitions of each single-item operation")
+    parser.add_argument("-o", "--output", default="hot_paths.json", help="Result json file")
+    parser.add_argument("-b", "--baseline", default=None, help="Result json file of a previous run, to compare with")
+    parser.add_argument("-t", "--tolerance", default=0.2, type=float, help="Mean latency growth tolerated by the comparison")
+    sys.exit(main(vars(parser.parse_args())))
@@ -0,0 +1,102 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  jld_memory.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+#  Memory footprint of repeated JSON-LD exports.
+#  The script builds the JSON-LD of a construct result, containing blank
+#  nodes, over and over, and prints the memory traced at regular
+#  checkpoints: it is expected to stay flat.
+#  Use -h parameter to see the options.
+
+import sys
+import argparse
+import gc
+import tracemalloc
+
+from time import time
+from cocktail.cocktail_jld import jldFileBuilder
+
+WOT = "http://wot.arces.unibo.it/ontology/web_of_things#"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+
+def uri(value):
+    return {"type": "uri", "value": value}
+
+
+def bnode(value):
+    return {"type": "bnode", "value": value}
+
+
+def literal(value):
+    return {"type": "literal", "value": value}
+
+
+def construct_result(n_patterns):
+    """
+    A Thing Description with 'n_patterns' interaction patterns, each with
+    a blank node DataSchema, in the shape of JSONLD_TD_CONSTRUCT results.
+    """
+    thing = uri("http://MyThing")
+    td = uri("http://MyThingDescription")
+    bindings = [
+        {"subject": thing, "predicate": uri(RDF_TYPE), "object": uri(WOT+"Thing")},
+        {"subject": thing, "predicate": uri(WOT+"hasThingDescription"), "object": td},
+        {"subject": td, "predicate": uri(RDF_TYPE), "object": uri(WOT+"ThingDescription")}]
+    for index in range(n_patterns):
+        ip = uri("http://MyAction_{}".format(index))
+        ds = bnode("b{}".format(index))
+        bindings += [
+            {"subject": td, "predicate": uri(WOT+"hasInteractionPattern"), "object": ip},
+            {"subject": ip, "predicate": uri(RDF_TYPE), "object": uri(WOT+"Action")},
+            {"subject": ip, "predicate": uri(WOT+"hasName"), "object": literal("Action {}".format(index))},
+            {"subject": ip, "predicate": uri(WOT+"hasInputDataSchema"), "object": ds},
+            {"subject": ds, "predicate": uri(RDF_TYPE), "object": uri(WOT+"DataSchema")}]
+    return {"head": {"vars": ["subject", "predicate", "object"]},
+            "results": {"bindings": bindings}}
+
+
+def main(args):
+    result = construct_result(args["patterns"])
+    checkpoint = max(args["exports"] // args["checkpoints"], 1)
+    tracemalloc.start()
+    start = time()
+    baseline = None
+    for export in range(1, args["exports"]+1):
+        jldFileBuilder(result)
+        if export % checkpoint == 0:
+            gc.collect()
+            current, peak = tracemalloc.get_traced_memory()
+            if baseline is None:
+                baseline = current
+            print("{:>8} exports\t{:>10} B traced\t{:>+10} B from first checkpoint\t{:.3f} ms/export".format(
+                export, current, current-baseline, (time()-start)*1000/export))
+    tracemalloc.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="JSON-LD export memory benchmark")
+    parser.add_argument("-n", "--exports", default=100000, type=int, help="Number of exports")
+    parser.add_argument("-p", "--patterns", default=5, type=int, help="Interaction patterns per Thing Description")
+    parser.add_argument("-c", "--checkpoints", default=10, type=int, help="Number of memory checkpoints")
+    sys.exit(main(vars(parser.parse_args())))
@@ -23,13 +23,18 @@
 #  
 
 from .InteractionPattern import InteractionPattern
-from .Thing import Thing
 from .utils import forPropertySparqlBuilder
+from .templates import getTemplate, compiled_update, paged_query
+from .tracker import getTracker
+from .dispatcher import instanceKey
+from .instances import InstanceURIGenerator
 
 from sepy.SAPObject import uriFormat
 from sepy.tablaze import tablify
 
 from enum import Enum
+from threading import local
+from concurrent.futures import InvalidStateError
 import logging
 
 logger = logging.getLogger("cocktail_log")
@@ -75,6 +80,10 @@ class Action(InteractionPattern):
             self._type = AType.EMPTY_ACTION
         self._forProperties = forProperties
         self._enable_subid = None
+        self._enable_subscriber = None
+        self._request_uris = None
+        self._output_uris = None
+        self._reused = local()
     
     @property
     def uri(self):
@@ -97,28 +106,45 @@ class Action(InteractionPattern):
         This method is not available if the Action is inferred.
         Posts the Action to the rdf store, together with its forced bindings.
         """
-        assert not self.isInferred()
-        self._sepa.update(
-            "ADD_{}_ACTION".format(self._type.value),
-            forcedBindings=self._bindings)
+        for sparql in self.getPostSparqls():
+            self._sepa.sparql_update(sparql)
         logger.debug("Posting action {}: {}".format(self.name, self.uri))
-        
+        return self
+    
+    def getPostSparqls(self):
+        """
+        This method is not available if the Action is inferred.
+        Returns the sparql updates needed to post the Action.
+        """
+        assert not self.isInferred()
+        sparqls = [getTemplate(self._sepa.sap, "ADD_{}_ACTION".format(
+            self._type.value)).render(self._bindings)]
         if self._forProperties:
-            self._sepa.sparql_update(forPropertySparqlBuilder(
+            sparqls.append(forPropertySparqlBuilder(
                 self._sepa.sap, self.uri, self._forProperties))
-        return self
+        return sparqls
         
-    def enable(self):
+    def enable(self, dispatcher=None, concurrency=None, manager=None):
         """
         This method is not available if the Action is inferred.
         Subscribe to action requests
+        If a Dispatcher is given, the action_task runs on its workers, at
+        most 'concurrency' requests at once, and one at a time for each
+        action instance.
+        If a SubscriptionManager is given, the subscription is shared with
+        the other local subscribers to the requests of the action using it.
         """
         if self._enable_subid is None:
             assert not self.isInferred()
             logger.info("Enabling Action "+self.uri)
-            self._enable_subid = self._sepa.subscribe(
+            handler = self._action_task
+            if dispatcher is not None:
+                handler = dispatcher.wrap(handler, name=self.uri, concurrency=concurrency,
+                                          order_by=instanceKey("aInstance"))
+            self._enable_subscriber = manager if manager is not None else self._sepa
+            self._enable_subid = self._enable_subscriber.subscribe(
                 "SUBSCRIBE_ACTION_INSTANCE", self.uri,
-                forcedBindings=self._bindings, handler=self._action_task)
+                forcedBindings=self._bindings, handler=handler)
         else:
             logger.warning("{} already enabled".format(self.uri))
         return self
@@ -133,7 +159,7 @@ class Action(InteractionPattern):
         if self._enable_subid is not None:
             assert not self.isInferred()
             logger.info("Disabling Action "+self.uri)
-            self._sepa.unsubscribe(self._enable_subid)
+            self._enable_subscriber.unsubscribe(self._enable_subid)
             self._enable_subid = None
         else:
             logger.warning("{} already disabled".format(self.uri))
@@ -147,13 +173,31 @@ class Action(InteractionPattern):
         if (self._type is AType.OUTPUT_ACTION) or (self._type is AType.IO_ACTION):
             logger.debug("Posting output for instance "+bindings["instance"])
             if (("oValue" in bindings) and (bindings["oValue"] != "")):
-                self._sepa.update("NEW_ACTION_INSTANCE_OUTPUT",
-                                  forcedBindings=bindings)
+                compiled_update(self._sepa, "NEW_ACTION_INSTANCE_OUTPUT",
+                                forcedBindings=bindings)
             else:
-                self._sepa.update("NEW_ACTION_INSTANCE_OUTPUT_NOVALUE",
-                                  forcedBindings=bindings)
+                compiled_update(self._sepa, "NEW_ACTION_INSTANCE_OUTPUT_NOVALUE",
+                                forcedBindings=bindings)
             self.post_completion(bindings["instance"])
            
+    def next_output_bindings(self, instance, value=None):
+        """
+        Returns the bindings for 'post_output' of the 'instance' request,
+        with a new output data uri in the namespace of the action.
+        The same dictionary is returned at every call of the same thread,
+        updated: copy it to keep it.
+        """
+        if self._output_uris is None:
+            self._output_uris = InstanceURIGenerator(
+                self.uri, kinds=("Data",), namespaces=self._namespaces())
+        bindings = getattr(self._reused, "output", None)
+        if bindings is None:
+            bindings = self._reused.output = {"oDS": self._bindings.get("ods", "")}
+        bindings["instance"] = instance
+        bindings["oData"], = next(self._output_uris)
+        bindings["oValue"] = "" if value is None else value
+        return bindings
+
     def post_completion(self, instance):
         """
         This method is not available if the Action is inferred.
@@ -175,8 +219,8 @@ class Action(InteractionPattern):
         assert not self.isInferred()
         if (ts_type.upper() != "COMPLETION") and (ts_type.upper() != "CONFIRMATION"):
             raise ValueError("Only 'completion' and 'confirmation' are valid keys")
-        self._sepa.update("ADD_{}_TIMESTAMP".format(ts_type.upper()),
-                          forcedBindings={"aInstance": instance})
+        compiled_update(self._sepa, "ADD_{}_TIMESTAMP".format(ts_type.upper()),
+                        forcedBindings={"aInstance": instance})
         
     @property
     def type(self):
@@ -210,42 +254,68 @@ class Action(InteractionPattern):
         if (action != "UNDEF") and (len(d_output["results"]["bindings"]) > 1):
             raise Exception("Action discovery gave more than one result")
         return d_output
+
+    @staticmethod
+    def discover_iter(sepa, action="UNDEF", page_size=1000, records=False):
+        """
+        Same as 'discover', yielding the bindings one at a time, while
+        they are queried in pages of 'page_size' results. With 'records'
+        True, records.Record objects are yielded instead.
+        """
+        return paged_query(sepa, "DESCRIBE_ACTION", forcedBindings={"action_uri": action},
+                           order_by=("action", "aName", "iDS", "iFS", "iFS_type",
+                                     "oDS", "oFS", "oFS_type", "property"), page_size=page_size,
+                           records=records)
     
     @staticmethod
-    def buildFromQuery(sepa, actionURI):
+    def buildFromQuery(sepa, actionURI, registry=None):
         """
         Static method to build an inferred local copy of an action by
         querying the rdf store.
         'actionURI' is the uri of the action needed.
+        If a started ThingRegistry is given as 'registry', the action is
+        built from its indexes, without querying the rdf store.
         """
-        query_action = Action.discover(sepa, action=actionURI)
-        query_ip = InteractionPattern.discover(
-            sepa, ip_type="swot:Action", nice_output=False)
-        for binding in query_ip["results"]["bindings"]:
-            if binding["ipattern"]["value"] == actionURI.replace("<", "").replace(">", ""):
-                td = uriFormat(binding["td"]["value"])
-        aBinding = query_action["results"]["bindings"][0]
+        if registry is not None:
+            aBinding = registry.action(actionURI)
+            td, thing = registry.resolve(actionURI)
+        else:
+            query_action = Action.discover(sepa, action=actionURI)
+            query_ip = InteractionPattern.discover(
+                sepa, ip_type="swot:Action", ipattern_uri=actionURI)
+            ipBinding = query_ip["results"]["bindings"][0]
+            td = uriFormat(ipBinding["td"]["value"])
+            thing = uriFormat(ipBinding["thing"]["value"])
+            aBinding = query_action["results"]["bindings"][0]
         out_bindings = {"td": td,
+                        "thing": thing,
                         "action": uriFormat(aBinding["action"]["value"]),
                         "newName": aBinding["aName"]["value"]}
         if "oDS" in aBinding.keys():
             out_bindings["ods"] = uriFormat(aBinding["oDS"]["value"])
         if "iDS" in aBinding.keys():
             out_bindings["ids"] = uriFormat(aBinding["iDS"]["value"])
-        query_thing = Thing.discover(sepa, bindings={"td_uri": td})
-        out_bindings["thing"] = uriFormat(query_thing["results"]["bindings"][0]["thing"]["value"])
         return Action(sepa, out_bindings, None)
     
     def newRequest(self, bindings, confirm_handler=None,
-                   completion_handler=None, output_handler=None):
+                   completion_handler=None, output_handler=None, tracker=None):
         """
         Used by clients, this method allows to ask to perform an action.
         'bindings' contains the information needed by the new-action-instance
         sparql.
         Returns the instance uri, and the subids for subscriptions in the
         form {"confirm": None,"completion": None,"output": None}
+        If a RequestTracker is given as 'tracker', the handlers are served
+        by its shared subscription, and the PendingRequest is returned
+        instead of the subids.
         """
         assert self.isInferred()
+        if tracker is not None:
+            request = tracker.track(
+                self, bindings["newAInstance"], confirm_handler=confirm_handler,
+                completion_handler=completion_handler, output_handler=output_handler)
+            self._post_request(bindings)
+            return bindings["newAInstance"], request
         subids = {"confirm": None, "completion": None, "output": None}
         if confirm_handler is not None:
             # in case i'm interested in capturing the confirm flag
@@ -265,14 +335,88 @@ class Action(InteractionPattern):
                 "SUBSCRIBE_INSTANCE_OUTPUT", bindings["newAInstance"],
                 forcedBindings={"instance": bindings["newAInstance"]},
                 handler=output_handler)
+        self._post_request(bindings)
+        return bindings["newAInstance"], subids
+
+    def next_request_bindings(self, author, value=None):
+        """
+        Returns the bindings for 'newRequest' or 'request_async' of a new
+        request of the action by 'author', whose uris are generated by an
+        InstanceURIGenerator in the namespace of the action, and whose
+        input 'value' (if any) is set.
+        The same dictionary is returned at every call of the same thread,
+        updated: copy it to keep it.
+        """
+        hasInput = (self._type is AType.INPUT_ACTION) or (self._type is AType.IO_ACTION)
+        if self._request_uris is None:
+            self._request_uris = InstanceURIGenerator(
+                self.uri, kinds=("Request", "Input") if hasInput else ("Request",),
+                namespaces=self._namespaces())
+        bindings = getattr(self._reused, "request", None)
+        if bindings is None:
+            bindings = self._reused.request = {"action": self.uri}
+            if hasInput:
+                bindings["newIDS"] = self._bindings.get("ids", "")
+        bindings["newAuthor"] = author
+        if "newIDS" in bindings:
+            bindings["newAInstance"], bindings["newIData"] = next(self._request_uris)
+            bindings["newIValue"] = "" if value is None else value
+        else:
+            bindings["newAInstance"], = next(self._request_uris)
+        return bindings
+
+    def request_async(self, bindings, timeout=None, tracker=None):
+        """
+        Used by clients, asks to perform the action without blocking.
+        'bindings' are the same of 'newRequest'.
+        Returns a concurrent.futures.Future resolving to the output binding
+        ({"od": ..., "oValue": ..., "oDS": ...}) if the Action has an
+        output, otherwise to the completion timestamp binding ({"ts": ...}).
+        The Future raises TimeoutError if the request is not completed in
+        'timeout' seconds, and RuntimeError if it is completed without
+        output; cancelling it stops following the request.
+        Requests are followed by 'tracker', or by the RequestTracker
+        shared by the users of this sepa instance. In a coroutine, the
+        Future can be awaited through asyncio.wrap_future.
+        """
+        assert self.isInferred()
+        if tracker is None:
+            tracker = getTracker(self._sepa)
+        instance = bindings["newAInstance"]
+        request = tracker.track(self, instance, timeout=timeout)
+        if (self._type is AType.OUTPUT_ACTION) or (self._type is AType.IO_ACTION):
+            future = request.output
+
+            def on_completion(f):
+                # called before the tracker cancels the steps left unset
+                if not (f.cancelled() or future.done()):
+                    try:
+                        future.set_exception(RuntimeError(
+                            "Request {} completed without output".format(instance)))
+                    except InvalidStateError:
+                        pass
+            request.completion.add_done_callback(on_completion)
+        else:
+            future = request.completion
+
+        def on_done(f):
+            if f.cancelled():
+                tracker.untrack(instance)
+        future.add_done_callback(on_done)
+        try:
+            self._post_request(bindings)
+        except Exception as e:
+            tracker.untrack(instance, exception=e)
+        return future
+
+    def _post_request(self, bindings):
         req_type = AType.INPUT_ACTION.value if (self._type is AType.INPUT_ACTION or self._type is AType.IO_ACTION) else AType.EMPTY_ACTION.value
         if req_type is AType.EMPTY_ACTION:
-            self._sepa.update("NEW_EMPTY_ACTION_INSTANCE", forcedBindings=bindings)
+            compiled_update(self._sepa, "NEW_EMPTY_ACTION_INSTANCE", forcedBindings=bindings)
         elif (("newIValue" in bindings) and (bindings["newIValue"] != "")):
-            self._sepa.update("NEW_I_ACTION_INSTANCE", forcedBindings=bindings)
+            compiled_update(self._sepa, "NEW_I_ACTION_INSTANCE", forcedBindings=bindings)
         else:
-            self._sepa.update("NEW_I_ACTION_INSTANCE_NOVALUE", forcedBindings=bindings)
-        return bindings["newAInstance"], subids
+            compiled_update(self._sepa, "NEW_I_ACTION_INSTANCE_NOVALUE", forcedBindings=bindings)
             
     def isInferred(self):
         """
@@ -291,5 +435,5 @@ class Action(InteractionPattern):
         """
         super().deleteInstance(instance)
         assert not self.isInferred()
-        self._sepa.update(
-            "DELETE_ACTION_INSTANCE", forcedBindings={"aInstance": instance})
+        compiled_update(
+            self._sepa, "DELETE_ACTION_INSTANCE", forcedBindings={"aInstance": instance})
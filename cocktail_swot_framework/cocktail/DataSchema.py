@@ -22,13 +22,12 @@
 #  
 #  
 
-from sepy.SAPObject import SAPObject
 from sepy.tablaze import tablify
-from .utils import generate_cocktail_sap
-from .cocktail_jld import JLDServer, jldFileBuilder
+from .utils import cocktail_sap_dict, plainURI
+from .templates import compiled_update, paged_query, streamed_query
+from .cocktail_jld import JLDServer, jldFileBuilder, shared_jld_server, jldPath
 
 import logging
-import yaml
 
 logger = logging.getLogger("cocktail_log")
 
@@ -40,6 +39,8 @@ class DataSchema:
     def __init__(self, sepa, bindings):
         self._sepa = sepa
         self._bindings = bindings
+        self._TDserver = None
+        self._TDpath = None
         
     @property
     def bindings(self):
@@ -53,7 +54,14 @@ class DataSchema:
         """
         Post to the SEPA a new dataschema
         """
-        self._sepa.update("NEW_DATASCHEMA", forcedBindings=self._bindings)
+        compiled_update(self._sepa, "NEW_DATASCHEMA", forcedBindings=self._bindings)
+        return self
+
+    async def post_async(self, async_sepa):
+        """
+        Same as 'post', awaiting the update on an AsyncSEPA instance
+        """
+        await async_sepa.update("NEW_DATASCHEMA", forcedBindings=self._bindings)
         return self
         
     @staticmethod
@@ -64,13 +72,19 @@ class DataSchema:
         bindings necessary to build up a DataSchema.
         """
         if sap_object is None:
-            sap = SAPObject(yaml.load(generate_cocktail_sap(None)), log=logging.ERROR)
-            result = sap.updates["NEW_DATASCHEMA"]["forcedBindings"].keys()
+            result = cocktail_sap_dict()["updates"]["NEW_DATASCHEMA"]["forcedBindings"].keys()
         else:
             result = sap_object.updates["NEW_DATASCHEMA"]["forcedBindings"].keys()
         return result
         
     
+    @staticmethod
+    async def discover_async(async_sepa, ds="UNDEF"):
+        """
+        Same as 'discover', awaiting the query on an AsyncSEPA instance
+        """
+        return await async_sepa.run(DataSchema.discover, ds=ds)
+
     @staticmethod
     def discover(sepa, ds="UNDEF", nice_output=False):
         """
@@ -83,6 +97,17 @@ class DataSchema:
             d_output = tablify(d_output, prefix_file=sepa.sap.get_namespaces(stringList=True), destination=None)
         return d_output
 
+    @staticmethod
+    def discover_iter(sepa, ds="UNDEF", page_size=1000, records=False):
+        """
+        Same as 'discover', yielding the bindings one at a time, while
+        they are queried in pages of 'page_size' results. With 'records'
+        True, records.Record objects are yielded instead.
+        """
+        return paged_query(sepa, "GET_DATASCHEMAS", forcedBindings={"ds_force": ds},
+                           order_by=("ds", "fs", "fs_type", "ip"), page_size=page_size,
+                           records=records)
+
     def delete(self):
         raise NotImplementedError
         
@@ -92,9 +117,13 @@ class DataSchema:
         pointed to by 'destination', if available.
         The output can be also seen as table on stdout, if 'nice_output' is True.
         """
-        result = self._sepa.query(
-            "JSONLD_DS_CONSTRUCT", forcedBindings={"ds": self.uri},
-            destination=destination)
+        if nice_output or (destination is not None):
+            result = self._sepa.query(
+                "JSONLD_DS_CONSTRUCT", forcedBindings={"ds": self.uri},
+                destination=destination)
+        else:
+            # the triples are framed while they are received
+            result = streamed_query(self._sepa, "JSONLD_DS_CONSTRUCT", {"ds": self.uri})
         
         if nice_output:
             tablify(result, prefix_file=self._sepa.sap.get_namespaces(stringList=True))
@@ -112,10 +141,41 @@ class DataSchema:
         
         return jld_result
         
-    def dsServer_start(self, ip, port):
-        self._TDserver = JLDServer(ip, port, self.toJsonLD())
-        self._TDserver.daemon = True
-        self._TDserver.start()
+    def dsServer_start(self, ip, port, shared=False):
+        """
+        Starts serving the JSON-LD DataSchema at 'ip':'port'.
+        If 'shared' is True, the DataSchema is published at /ds/<uri> of
+        the server shared with the other Things and DataSchemas of the
+        process, instead of on its own server.
+        If the server is already running, its content is refreshed.
+        Returns the path of the DataSchema.
+        """
+        if self._TDserver is not None:
+            self.dsServer_refresh()
+        elif shared:
+            self._TDserver = shared_jld_server(ip, port)
+            self._TDpath = jldPath("ds", plainURI(self.uri))
+            self._TDserver.add(self._TDpath, self.toJsonLD())
+        else:
+            self._TDserver = JLDServer(ip, port, self.toJsonLD())
+            self._TDserver.daemon = True
+            self._TDserver.start()
+            self._TDpath = "/"
+        return self._TDpath
+    
+    def dsServer_refresh(self):
+        """
+        Rebuilds the JSON-LD DataSchema, and swaps it into the running server.
+        """
+        if self._TDpath == "/":
+            self._TDserver.set_content(self.toJsonLD())
+        else:
+            self._TDserver.add(self._TDpath, self.toJsonLD())
         
     def dsServer_stop(self):
-        self._TDserver.kill()
+        if self._TDpath == "/":
+            self._TDserver.kill()
+        else:
+            self._TDserver.remove(self._TDpath)
+        self._TDserver = None
+        self._TDpath = None
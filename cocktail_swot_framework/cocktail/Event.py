@@ -23,16 +23,26 @@
 #  
 
 from .InteractionPattern import InteractionPattern
-from .Thing import Thing
-from .utils import forPropertySparqlBuilder
+from .utils import forPropertySparqlBuilder, batch_update
+from .templates import getTemplate, compiled_query, compiled_update, paged_query
+from .scheduling import scheduleWork
+from .instances import InstanceURIGenerator
 
 from sepy.tablaze import tablify
 from sepy.SAPObject import uriFormat
 
 from enum import Enum
+from threading import Lock, local
+from weakref import WeakSet
+from datetime import datetime, timezone, timedelta
+
+import atexit
 import logging
 
 logger = logging.getLogger("cocktail_log")
+_buffers = WeakSet()
+_buffers_lock = Lock()
+_buffers_atexit = False
 
 
 class EType(Enum):
@@ -63,29 +73,191 @@ class Event(InteractionPattern):
             self._type = EType.EMPTY_EVENT
         self._forProperties = forProperties
         self._observation_subid = None
+        self._observation_subscriber = None
+        self._instances = None
+        self._reused = local()
+        self._retention = None
+        self._retention_lock = Lock()
+        self._compaction_timer = None
+        self._compaction_generation = 0
         
     def post(self):
-        self._sepa.update("ADD_{}_EVENT".format(self._type.value),
-                          forcedBindings=self._bindings)
+        for sparql in self.getPostSparqls():
+            self._sepa.sparql_update(sparql)
         logger.debug("Posting event {}: {}".format(self.name, self.uri))
-        
+        return self
+    
+    def getPostSparqls(self):
+        """
+        Returns the sparql updates needed to post the Event.
+        """
+        sparqls = [getTemplate(self._sepa.sap, "ADD_{}_EVENT".format(
+            self._type.value)).render(self._bindings)]
         if self._forProperties:
-            self._sepa.sparql_update(forPropertySparqlBuilder(
+            sparqls.append(forPropertySparqlBuilder(
                 self._sepa.sap, self.uri, self._forProperties))
-        return self
+        return sparqls
         
     def notify(self, bindings):
         """
         Posts to the rdf store a notification, whose data in 'bindings'
         is formatted as in the new-event-instance yaml.
         """
+        self._sepa.sparql_update(self.getNotifySparql(bindings))
+        return bindings["newEInstance"]
+
+    def getNotifySparql(self, bindings):
+        """
+        Returns the sparql update notifying the instance in 'bindings'.
+        """
         if ((self._type is EType.EMPTY_EVENT) or (("newValue" in bindings) and (bindings["newValue"] != ""))):
-            self._sepa.update("NEW_{}_EVENT_INSTANCE".format(self._type.value),
-                              forcedBindings=bindings)
+            identifier = "{}_EVENT_INSTANCE".format(self._type.value)
         else:
-            self._sepa.update("NEW_O_EVENT_INSTANCE_NOVALUE", forcedBindings=bindings)
-        return bindings["newEInstance"]
+            identifier = "O_EVENT_INSTANCE_NOVALUE"
+        prefix = "NEW_" if self._retention is None else "RETAIN_"
+        return getTemplate(self._sepa.sap, prefix+identifier).render(bindings)
+
+    def next_instance_bindings(self, value=None):
+        """
+        Returns the bindings for 'notify' of a new instance of the event,
+        whose uris are generated by an InstanceURIGenerator in the
+        namespace of the event, and whose 'value' (if any) is set.
+        The same dictionary is returned at every call of the same thread,
+        updated: copy it to keep it.
+        """
+        if self._instances is None:
+            self._instances = InstanceURIGenerator(
+                self.uri, kinds=("Instance", "Data") if self._type is EType.OUTPUT_EVENT else ("Instance",),
+                namespaces=self._namespaces())
+        bindings = getattr(self._reused, "bindings", None)
+        if bindings is None:
+            bindings = {"event": self.uri}
+            if self._type is EType.OUTPUT_EVENT:
+                bindings["newDS"] = self._bindings.get("ods", "")
+            self._reused.bindings = bindings
+        if self._type is EType.OUTPUT_EVENT:
+            bindings["newEInstance"], bindings["newOData"] = next(self._instances)
+            bindings["newValue"] = "" if value is None else value
+        else:
+            bindings["newEInstance"], = next(self._instances)
+        return bindings
+
+    def notify_many(self, samples, latest_only=None):
+        """
+        Notifies the list of 'samples' bindings with a single request.
+        As each notification replaces the previous instance of the event,
+        by default only the last sample is sent: the others would be
+        deleted within the same request, unseen by the subscribers.
+        With 'latest_only=False', which is the default in retention mode,
+        all the samples are sent, in order, as a batch of updates.
+        Returns the instances posted.
+        """
+        if not samples:
+            return []
+        if latest_only is None:
+            latest_only = self._retention is None
+        if latest_only:
+            samples = samples[-1:]
+        batch_update(self._sepa, [self.getNotifySparql(bindings) for bindings in samples])
+        return [bindings["newEInstance"] for bindings in samples]
+
+    def buffered(self, max_samples=100, max_delay=0.1, latest_only=None):
+        """
+        Returns an EventBuffer, to notify the event at a high rate.
+        """
+        return EventBuffer(self, max_samples=max_samples, max_delay=max_delay,
+                           latest_only=latest_only)
     
+    def retain(self, count=None, seconds=None, compaction_interval=60):
+        """
+        Enables the retention mode: notifications no longer delete the
+        previous instance of the event, so that consumers can catch up
+        with 'history'. Every 'compaction_interval' seconds the instances
+        beyond the latest 'count', or older than 'seconds', are deleted
+        (see 'compact'). Ages are measured with the local clock against
+        the timestamps of the rdf store.
+        """
+        if (count is None) and (seconds is None):
+            raise ValueError("Retention needs a count or a duration")
+        with self._retention_lock:
+            self._cancel_compaction()
+            self._retention = (count, seconds, compaction_interval)
+            self._schedule_compaction(self._compaction_generation)
+        return self
+
+    def stop_retaining(self):
+        """
+        Goes back to keeping only the last instance, which is enforced
+        by the next notification.
+        """
+        with self._retention_lock:
+            self._retention = None
+            self._cancel_compaction()
+
+    def _cancel_compaction(self):
+        # called with the retention lock held: a compaction already
+        # running finds a newer generation, and does not schedule again
+        self._compaction_generation += 1
+        if self._compaction_timer is not None:
+            self._compaction_timer.cancel()
+            self._compaction_timer = None
+
+    def _schedule_compaction(self, generation):
+        # called with the retention lock held
+        def job():
+            with self._retention_lock:
+                if generation != self._compaction_generation:
+                    return
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error("Compaction of {} failed: {}".format(self.uri, e))
+            with self._retention_lock:
+                if generation == self._compaction_generation:
+                    self._schedule_compaction(generation)
+        # the queries run on a worker, not on the timer thread
+        self._compaction_timer = scheduleWork(self._retention[2], job)
+
+    def compact(self):
+        """
+        Deletes, with a single request, the instances of the event beyond
+        the retention limits. Returns the number of instances deleted.
+        """
+        if self._retention is None:
+            return 0
+        count, seconds = self._retention[:2]
+        instances = [(_timestamp(b["eTS"]["value"]), b["eInstance"]["value"])
+                     for b in self.history()["results"]["bindings"]]
+        instances.sort(reverse=True)
+        expired = set()
+        if count is not None:
+            expired.update(instance for ts, instance in instances[count:])
+        if seconds is not None:
+            oldest = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+            expired.update(instance for ts, instance in instances if ts < oldest)
+        template = getTemplate(self._sepa.sap, "DELETE_EVENT_INSTANCE")
+        batch_update(self._sepa, [template.render({"eInstance": instance}) for instance in sorted(expired)])
+        if expired:
+            logger.debug("Deleted {} instances of {}".format(len(expired), self.uri))
+        return len(expired)
+
+    def history(self, since=None):
+        """
+        Returns the query result of the instances of the event occurred
+        after 'since' (a datetime, or an xsd:dateTime string), or of all
+        of them, in order of occurrence: in retention mode, consumers can
+        use it to catch up with the notifications they missed.
+        """
+        if isinstance(since, datetime):
+            since = since.isoformat()
+        return compiled_query(self._sepa, "EVENT_HISTORY", forcedBindings={
+            "event_uri": self.uri, "since_ts": "UNDEF" if since is None else since})
+
+    @property
+    def retention(self):
+        """(count, seconds, compaction_interval) in retention mode, or None"""
+        return self._retention
+
     @property
     def uri(self):
         """Event URI getter"""
@@ -117,8 +289,8 @@ class Event(InteractionPattern):
         """
         super().deleteInstance(instance)
         logger.warning("Deleting Event instance "+instance)
-        self._sepa.update("DELETE_EVENT_INSTANCE",
-                          forcedBindings={"eInstance": instance})
+        compiled_update(self._sepa, "DELETE_EVENT_INSTANCE",
+                        forcedBindings={"eInstance": instance})
         
     @staticmethod
     def discover(sepa, event="UNDEF", nice_output=False):
@@ -135,37 +307,65 @@ class Event(InteractionPattern):
         if (event != "UNDEF") and (len(d_output["results"]["bindings"]) > 1):
             raise Exception("Event discovery gave more than one result")
         return d_output
+
+    @staticmethod
+    def discover_iter(sepa, event="UNDEF", page_size=1000, records=False):
+        """
+        Same as 'discover', yielding the bindings one at a time, while
+        they are queried in pages of 'page_size' results. With 'records'
+        True, records.Record objects are yielded instead.
+        """
+        return paged_query(sepa, "DESCRIBE_EVENT", forcedBindings={"event_uri": event},
+                           order_by=("event", "eName", "oDS", "oFS", "oFS_type", "property"), page_size=page_size,
+                           records=records)
         
     @staticmethod
-    def buildFromQuery(sepa, eventURI):
+    def buildFromQuery(sepa, eventURI, registry=None):
         """
         Static method to build a local copy of an event by querying the
         rdf store.
         'eventURI' is the uri of the event needed.
+        If a started ThingRegistry is given as 'registry', the event is
+        built from its indexes, without querying the rdf store.
         """
-        query_event = Event.discover(sepa, event=eventURI)
-        query_ip = InteractionPattern.discover(
-            sepa, ip_type="swot:Event", nice_output=False)
-        for binding in query_ip["results"]["bindings"]:
-            if binding["ipattern"]["value"] == eventURI.replace("<", "").replace(">", ""):
-                td = uriFormat(binding["td"]["value"])
-        eBinding = query_event["results"]["bindings"][0]
+        if registry is not None:
+            eBinding = registry.event(eventURI)
+            td, thing = registry.resolve(eventURI)
+        else:
+            query_event = Event.discover(sepa, event=eventURI)
+            query_ip = InteractionPattern.discover(
+                sepa, ip_type="swot:Event", ipattern_uri=eventURI)
+            ipBinding = query_ip["results"]["bindings"][0]
+            td = uriFormat(ipBinding["td"]["value"])
+            thing = uriFormat(ipBinding["thing"]["value"])
+            eBinding = query_event["results"]["bindings"][0]
         out_bindings = {"td": td,
+                        "thing": thing,
                         "event": uriFormat(eBinding["event"]["value"]),
                         "eName": eBinding["eName"]["value"]}
         if "oDS" in eBinding.keys():
             out_bindings["ods"] = uriFormat(eBinding["oDS"]["value"])
-        query_thing = Thing.discover(sepa, bindings={"td_uri": td})
-        out_bindings["thing"] = uriFormat(query_thing["results"]["bindings"][0]["thing"]["value"])
         return Event(sepa, out_bindings)
     
-    def observe(self, handler):
+    def observe(self, handler, dispatcher=None, concurrency=None, manager=None):
         """
         Subscribes to event notifications coming from eventURI.
         'handler' deals with the task to be performed in such situation.
+        If a Dispatcher is given, the handler runs on its workers, one
+        notification at a time and in order. Every notification carries a
+        new event instance, so giving 'concurrency' lets that many run at
+        once, in any order.
+        If a SubscriptionManager is given, the subscription is shared with
+        the other observers of the event using it.
         """
         if self._observation_subid is None:
-            self._observation_subid = self._sepa.subscribe(
+            if dispatcher is not None:
+                uri = self.uri
+                handler = dispatcher.wrap(
+                    handler, name=uri, concurrency=concurrency,
+                    order_by=(lambda added, removed: uri) if concurrency is None else None)
+            self._observation_subscriber = manager if manager is not None else self._sepa
+            self._observation_subid = self._observation_subscriber.subscribe(
                 "SUBSCRIBE_EVENT_INSTANCE", self.uri, 
                 forcedBindings=self._bindings, handler=handler)
             logger.info("Started observation of {}: id-{}".format(
@@ -180,7 +380,98 @@ class Event(InteractionPattern):
         if self._observation_subid is not None:
             logger.info("Stopped observation of {}: id-{}".format(
                 self.uri, self._observation_subid))
-            self._sepa.unsubscribe(self._observation_subid)
+            self._observation_subscriber.unsubscribe(self._observation_subid)
             self._observation_subid = None
         else:
             logger.warning("Observation of {} already stopped".format(self.uri))
+
+
+def _timestamp(value):
+    # xsd:dateTime of the rdf store, as an aware datetime (UTC if naive)
+    ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return ts if ts.tzinfo is not None else ts.replace(tzinfo=timezone.utc)
+
+
+def _flush_buffers():
+    with _buffers_lock:
+        buffers = list(_buffers)
+    for buffer in buffers:
+        buffer.flush()
+
+
+def _registerBuffer(buffer):
+    # buffers are flushed at exit, without being kept alive until then
+    global _buffers_atexit
+    with _buffers_lock:
+        _buffers.add(buffer)
+        if not _buffers_atexit:
+            atexit.register(_flush_buffers)
+            _buffers_atexit = True
+
+
+class EventBuffer:
+    """
+    Collects the notifications of an Event, sending them with
+    Event.notify_many when 'max_samples' are collected, or 'max_delay'
+    seconds after the first one, whichever comes first. 'latest_only' is
+    given to notify_many.
+    The buffer is flushed at interpreter exit, or by 'close'.
+    """
+    def __init__(self, event, max_samples=100, max_delay=0.1, latest_only=None):
+        self._event = event
+        self._max_samples = max_samples
+        self._max_delay = max_delay
+        self._latest_only = latest_only
+        self._samples = []
+        self._timer = None
+        self._lock = Lock()
+        self._write_lock = Lock()
+        self.notified = 0
+        self.requests = 0
+        _registerBuffer(self)
+
+    def notify(self, bindings):
+        """
+        Adds a notification to the buffer. Returns its instance.
+        """
+        with self._lock:
+            # bindings may be reused by the caller (see next_instance_bindings)
+            self._samples.append(dict(bindings))
+            full = len(self._samples) >= self._max_samples
+            if (not full) and (self._timer is None):
+                self._timer = scheduleWork(self._max_delay, self.flush)
+        if full:
+            self.flush()
+        return bindings["newEInstance"]
+
+    def flush(self):
+        """
+        Sends the buffered notifications, if any.
+        """
+        with self._write_lock:
+            with self._lock:
+                samples, self._samples = self._samples, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if samples:
+                self._event.notify_many(samples, latest_only=self._latest_only)
+                self.notified += len(samples)
+                self.requests += 1
+
+    def close(self):
+        """
+        Sends the buffered notifications, and releases the buffer.
+        """
+        self.flush()
+        with _buffers_lock:
+            _buffers.discard(self)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -24,6 +24,8 @@
 
 from abc import abstractmethod
 from sepy.tablaze import tablify
+from .templates import compiled_update, paged_query
+from .utils import COCKTAIL_NAMESPACES
 
 import logging
 
@@ -57,6 +59,10 @@ class InteractionPattern:
     
     def setSepa(self, new_sepa):
         self._sepa = new_sepa
+
+    def _namespaces(self):
+        # prefixes of the sap, to expand the prefixed uris
+        return self._sepa.sap.get_namespaces() if self._sepa is not None else COCKTAIL_NAMESPACES
         
     def delete(self):
         """
@@ -70,13 +76,36 @@ class InteractionPattern:
             tag = "action"
         else:
             raise ValueError("Bad bindings!")
-        self._sepa.update("DELETE_INTERACTION_PATTERN",
-                          forcedBindings={"ip": self._bindings[tag]})
+        compiled_update(self._sepa, "DELETE_INTERACTION_PATTERN",
+                        forcedBindings={"ip": self._bindings[tag]})
         
     @abstractmethod
     def post(self):
         pass
     
+    async def post_async(self, async_sepa):
+        """
+        Same as 'post', awaiting the updates on an AsyncSEPA instance
+        """
+        for sparql in self.getPostSparqls():
+            await async_sepa.sparql_update(sparql)
+        return self
+
+    @classmethod
+    async def discover_async(cls, async_sepa, *args, **kwargs):
+        """
+        Same as 'discover', awaiting the query on an AsyncSEPA instance
+        """
+        return await async_sepa.run(cls.discover, *args, **kwargs)
+
+    @abstractmethod
+    def getPostSparqls(self):
+        """
+        Returns the list of sparql updates performed by 'post', without
+        sending them.
+        """
+        pass
+    
     @classmethod
     @abstractmethod
     def getBindingList(self):
@@ -84,18 +113,39 @@ class InteractionPattern:
     
     @staticmethod
     @abstractmethod
-    def discover(sepa, td_uri="UNDEF", ip_type="UNDEF", nice_output=False):
+    def discover(sepa, td_uri="UNDEF", ip_type="UNDEF", nice_output=False,
+                 ipattern_uri=None):
         """
         Generic InteractionPattern discovery. Can be more selective by giving
         'td_uri' and 'ip_type' params.
+        When 'ipattern_uri' is given, instead, only that InteractionPattern is
+        retrieved, together with its ThingDescription and its Thing
+        ('td_uri' is not considered).
         'nice_output' prints to console a table with the result.
         """
-        d_output = sepa.query(
-            "DISCOVER_INTERACTION_PATTERNS",
-            forcedBindings={"td_uri": td_uri, "ipattern_type_specific": ip_type})
+        if ipattern_uri is not None:
+            d_output = sepa.query(
+                "RESOLVE_INTERACTION_PATTERN",
+                forcedBindings={"ipattern_uri": ipattern_uri,
+                                "ipattern_type_specific": ip_type})
+        else:
+            d_output = sepa.query(
+                "DISCOVER_INTERACTION_PATTERNS",
+                forcedBindings={"td_uri": td_uri, "ipattern_type_specific": ip_type})
         if nice_output:
             tablify(d_output, prefix_file=sepa.get_namespaces(stringList=True))
         return d_output
+
+    @staticmethod
+    def discover_iter(sepa, td_uri="UNDEF", ip_type="UNDEF", page_size=1000, records=False):
+        """
+        Same as 'discover', yielding the bindings one at a time, while
+        they are queried in pages of 'page_size' results. With 'records'
+        True, records.Record objects are yielded instead.
+        """
+        return paged_query(sepa, "DISCOVER_INTERACTION_PATTERNS", forcedBindings={"td_uri": td_uri, "ipattern_type_specific": ip_type},
+                           order_by=("td", "ipattern", "ipatterntype", "ipatternName"), page_size=page_size,
+                           records=records)
         
     def deleteInstance(self, instance):
         pass
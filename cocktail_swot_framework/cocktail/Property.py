@@ -24,10 +24,25 @@
 
 from sepy.tablaze import tablify
 from .InteractionPattern import InteractionPattern
+from .templates import getTemplate, paged_query
+from .scheduling import scheduleWork
+from threading import Lock
+from weakref import WeakSet
 
+import atexit
 import logging
 
 logger = logging.getLogger("cocktail_log")
+_coalescing = WeakSet()
+_coalescing_lock = Lock()
+_atexit_registered = False
+
+
+def _flush_all():
+    with _coalescing_lock:
+        properties = list(_coalescing)
+    for prop in properties:
+        prop.flush()
 
 
 class Property(InteractionPattern):
@@ -38,24 +53,118 @@ class Property(InteractionPattern):
     
     def __init__(self, sepa, bindings):
         super().__init__(sepa, bindings)
+        self._window = None
+        self._threshold = None
+        self._pending = None
+        self._timer = None
+        self._posted = None
+        self._lock = Lock()
+        self._write_lock = Lock()
         
     def post(self):
         """
         Posts the thing to the rdf store.
         """
         logger.info("Posting property {}: {}".format(self.name, self.uri))
-        if (("newValue" in self._bindings) and (self._bindings["newValue"] != "")):
-            self._sepa.update("ADD_UPDATE_PROPERTY", forcedBindings=self._bindings)
-        else:
-            self._sepa.update("ADD_UPDATE_PROPERTY_NOVALUE", forcedBindings=self._bindings)
+        for sparql in self.getPostSparqls():
+            self._sepa.sparql_update(sparql)
         return self
+    
+    def getPostSparqls(self):
+        """
+        Returns the sparql updates needed to post the Property.
+        """
+        if (("newValue" in self._bindings) and (self._bindings["newValue"] != "")):
+            return [getTemplate(self._sepa.sap, "ADD_UPDATE_PROPERTY").render(self._bindings)]
+        return [getTemplate(self._sepa.sap, "ADD_UPDATE_PROPERTY_NOVALUE").render(self._bindings)]
         
     def update(self, bindings):
         """
         Updates the thing already present in the rdf store.
+        In coalescing mode, the update is delayed, and possibly merged
+        with the following ones or suppressed (see 'coalesce').
+        """
+        if self._window is None:
+            self._bindings = bindings
+            self.post()
+            return
+        with self._lock:
+            if self._negligible(bindings):
+                logger.debug("Update of {} below threshold".format(self.uri))
+                self._pending = None
+                return
+            self._pending = bindings
+            if self._timer is None:
+                # the write runs on a worker, not on the timer thread
+                self._timer = scheduleWork(self._window, self.flush)
+
+    def coalesce(self, window=None, threshold=None):
+        """
+        Enables the coalescing mode: the updates within 'window' seconds
+        from the first one are collapsed into a single write of the
+        latest value. If 'window' is None, the stability of the Property
+        (in milliseconds) is used.
+        If 'threshold' is given, updates whose numeric value differs less
+        than 'threshold' from the last value written (or, for non numeric
+        values, that are equal to it) are suppressed, as long as the other
+        bindings do not change.
+        Pending updates are written by 'flush', which is also called at
+        interpreter exit.
+        """
+        global _atexit_registered
+        if window is None:
+            window = float(self.stability)/1000
+        with self._lock:
+            self._window = window
+            self._threshold = threshold
+            if self._posted is None:
+                self._posted = dict(self._bindings)
+        with _coalescing_lock:
+            _coalescing.add(self)
+            if not _atexit_registered:
+                atexit.register(_flush_all)
+                _atexit_registered = True
+        return self
+
+    def stop_coalescing(self):
+        """
+        Writes the pending update, if any, and goes back to writing every
+        update immediately.
+        """
+        self.flush()
+        with self._lock:
+            self._window = None
+        with _coalescing_lock:
+            _coalescing.discard(self)
+
+    def flush(self):
+        """
+        Writes the pending update, if any.
         """
-        self._bindings = bindings
-        self.post()
+        with self._write_lock:
+            with self._lock:
+                bindings, self._pending = self._pending, None
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if bindings is not None:
+                self._bindings = bindings
+                self.post()
+                self._posted = dict(bindings)
+
+    def _negligible(self, bindings):
+        # whether 'bindings' differ from the last written ones only by a
+        # value change below the threshold
+        if (self._threshold is None) or (self._posted is None):
+            return False
+        for key in set(bindings) | set(self._posted):
+            if (key != "newValue") and (bindings.get(key) != self._posted.get(key)):
+                return False
+        new, old = bindings.get("newValue"), self._posted.get("newValue")
+        try:
+            return abs(float(new)-float(old)) < self._threshold
+        except (TypeError, ValueError):
+            return new == old
         
     @property
     def uri(self):
@@ -96,3 +205,15 @@ class Property(InteractionPattern):
         if (prop != "UNDEF") and (len(d_output["results"]["bindings"]) > 1):
             raise Exception("Property discovery gave more than one result")
         return d_output
+
+    @staticmethod
+    def discover_iter(sepa, prop="UNDEF", page_size=1000, records=False):
+        """
+        Same as 'discover', yielding the bindings one at a time, while
+        they are queried in pages of 'page_size' results. With 'records'
+        True, records.Record objects are yielded instead.
+        """
+        return paged_query(sepa, "DESCRIBE_PROPERTY", forcedBindings={"property_uri": prop},
+                           order_by=("property", "pName", "pStability", "pWritability", "pDS",
+                                     "pData", "pValue", "pFS", "pFS_type", "ipattern"), page_size=page_size,
+                           records=records)
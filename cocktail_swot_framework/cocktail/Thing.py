@@ -24,8 +24,11 @@
 
 from sepy.tablaze import tablify
 from io import TextIOBase
-from .cocktail_jld import JLDServer, jldFileBuilder
+from .cocktail_jld import JLDServer, jldFileBuilder, shared_jld_server, jldPath
+from .utils import batch_update, plainURI
+from .templates import getTemplate, compiled_update, paged_query, streamed_query
 
+import asyncio
 import logging
 
 
@@ -75,31 +78,74 @@ class Thing:
         self._sepa = sepa
         self._superthing = superthing
         self._TDserver = None
+        self._TDpath = None
+        self._saved_round_trips = 0
         
-    def post(self, interaction_patterns=[]):
+    def post(self, interaction_patterns=[], batch=False):
         """
         Posting the wot:Thing (and its connection to a superthing) with
         all its interaction patterns. Note that putting interaction patterns
         here is *not* the only way to proceed.
+        If 'batch' is True, all the updates are merged in a single SPARQL
+        request, which is split only if the broker rejects it. The number
+        of requests spared is then available in 'saved_round_trips'.
         """
-        self._sepa.update("NEW_THING", forcedBindings=self._bindings)
+        if batch:
+            sparqls = self.getPostSparqls(interaction_patterns)
+            requests = batch_update(self._sepa, sparqls)
+            self._saved_round_trips = len(sparqls) - requests
+            logger.debug("Posting thing {} with {} accepted requests instead of {}".format(
+                self.uri, requests, len(sparqls)))
+            return self
+        compiled_update(self._sepa, "NEW_THING", forcedBindings=self._bindings)
         logger.debug("Posting thing {}: {}".format(self.name, self.uri))
         
         if self._superthing is not None:
-            self._sepa.update("NEW_SUBTHING",
-                              forcedBindings={"superthing": self._superthing,
-                                              "subthing": self.uri})
+            compiled_update(self._sepa, "NEW_SUBTHING",
+                            forcedBindings={"superthing": self._superthing,
+                                            "subthing": self.uri})
             logger.debug("Connecting superthing {} to {}".format(self._superthing, self.uri))
         for ip in interaction_patterns:
             logger.debug("Appending interaction pattern {} to {}".format(ip.uri, self.uri))
             ip.post()
         return self
+    
+    async def post_async(self, async_sepa, interaction_patterns=[]):
+        """
+        Same as 'post', awaiting the updates on an AsyncSEPA instance.
+        The interaction patterns are posted concurrently, once the Thing
+        is in the rdf store.
+        """
+        for sparql in self.getPostSparqls():
+            await async_sepa.sparql_update(sparql)
+        await asyncio.gather(*[ip.post_async(async_sepa) for ip in interaction_patterns])
+        return self
+
+    def getPostSparqls(self, interaction_patterns=[]):
+        """
+        Returns the sparql updates performed by 'post', in the same order,
+        without sending them.
+        """
+        sparqls = [getTemplate(self._sepa.sap, "NEW_THING").render(self._bindings)]
+        if self._superthing is not None:
+            sparqls.append(getTemplate(self._sepa.sap, "NEW_SUBTHING").render(
+                {"superthing": self._superthing, "subthing": self.uri}))
+        for ip in interaction_patterns:
+            sparqls += ip.getPostSparqls()
+        return sparqls
             
     def delete(self):
         """Deletes the thing from the rdf store"""
-        self._sepa.update("DELETE_THING", self._bindings)
+        compiled_update(self._sepa, "DELETE_THING", forcedBindings=self._bindings)
         logger.debug("Deleting "+self.uri)
         
+    @staticmethod
+    async def discover_async(async_sepa, bindings={}):
+        """
+        Same as 'discover', awaiting the query on an AsyncSEPA instance
+        """
+        return await async_sepa.run(Thing.discover, bindings=bindings)
+
     @staticmethod
     def discover(sepa, bindings={}, nice_output=False):
         """
@@ -111,6 +157,17 @@ class Thing:
         if nice_output:
             d_output = tablify(d_output, prefix_file=sepa.sap.get_namespaces(stringList=True), destination=None)
         return d_output
+
+    @staticmethod
+    def discover_iter(sepa, bindings={}, page_size=1000, records=False):
+        """
+        Same as 'discover', yielding the bindings one at a time, while
+        they are queried in pages of 'page_size' results. With 'records'
+        True, records.Record objects are yielded instead.
+        """
+        return paged_query(sepa, "DISCOVER_THINGS", bindings,
+                           order_by=("thing", "subThing", "name", "td"), page_size=page_size,
+                           records=records)
         
     @property
     def bindings(self):
@@ -132,6 +189,13 @@ class Thing:
     def superthing(self):
         return self._superthing
     
+    @property
+    def saved_round_trips(self):
+        """
+        Number of requests spared by the last batch 'post'
+        """
+        return self._saved_round_trips
+    
     @classmethod
     def getBindingList(self):
         """
@@ -146,9 +210,13 @@ class Thing:
         pointed to by 'destination', if available.
         The output can be also seen as table on stdout, if 'nice_output' is True.
         """
-        result = self._sepa.query(
-            "JSONLD_TD_CONSTRUCT", forcedBindings={"thing": self.uri},
-            destination=destination)
+        if nice_output or (destination is not None):
+            result = self._sepa.query(
+                "JSONLD_TD_CONSTRUCT", forcedBindings={"thing": self.uri},
+                destination=destination)
+        else:
+            # the triples are framed while they are received
+            result = streamed_query(self._sepa, "JSONLD_TD_CONSTRUCT", {"thing": self.uri})
         
         if nice_output:
             tablify(result, prefix_file=self._sepa.sap.get_namespaces(stringList=True))
@@ -166,10 +234,43 @@ class Thing:
         
         return jld_result
         
-    def tdServer_start(self, ip, port):
-        self._TDserver = JLDServer(ip, port, self.toJsonLD())
-        self._TDserver.daemon = True
-        self._TDserver.start()
+    def tdServer_start(self, ip, port, shared=False):
+        """
+        Starts serving the JSON-LD Thing Description at 'ip':'port'.
+        If 'shared' is True, the Thing Description is published at
+        /td/<thing uri> of the server shared with the other Things and
+        DataSchemas of the process, instead of on its own server.
+        If the server is already running, its content is refreshed.
+        Returns the path of the Thing Description.
+        """
+        if self._TDserver is not None:
+            self.tdServer_refresh()
+        elif shared:
+            self._TDserver = shared_jld_server(ip, port)
+            # names are not unique: two Things must not share a route
+            self._TDpath = jldPath("td", plainURI(self.uri))
+            self._TDserver.add(self._TDpath, self.toJsonLD())
+        else:
+            self._TDserver = JLDServer(ip, port, self.toJsonLD())
+            self._TDserver.daemon = True
+            self._TDserver.start()
+            self._TDpath = "/"
+        return self._TDpath
+    
+    def tdServer_refresh(self):
+        """
+        Rebuilds the JSON-LD Thing Description, and swaps it into the
+        running server.
+        """
+        if self._TDpath == "/":
+            self._TDserver.set_content(self.toJsonLD())
+        else:
+            self._TDserver.add(self._TDpath, self.toJsonLD())
         
     def tdServer_stop(self):
-        self._TDserver.kill()
+        if self._TDpath == "/":
+            self._TDserver.kill()
+        else:
+            self._TDserver.remove(self._TDpath)
+        self._TDserver = None
+        self._TDpath = None
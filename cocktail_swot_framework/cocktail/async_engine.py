@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  async_engine.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
+from urllib.parse import urlsplit
+from functools import partial
+from threading import Lock
+from .templates import getTemplate
+from .streaming import StreamedResult
+
+import asyncio
+import logging
+import json
+
+logger = logging.getLogger("cocktail_log")
+
+
+class ConnectionPool:
+    """
+    Keep-alive http connections to a SEPA, reused among requests.
+    At most 'max_size' idle connections are kept for each host.
+    """
+    def __init__(self, max_size=8, timeout=30):
+        self._max_size = max_size
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = Lock()
+
+    def request(self, url, body, headers):
+        """
+        Posts 'body' to 'url', returning status code and text of the
+        response. A request failing on a reused connection, which the
+        server may have closed meanwhile, is sent again on a new one.
+        """
+        key, connection, (status, text) = self._post(url, body, headers, self._send)
+        self._put(key, connection)
+        return status, text
+
+    def stream(self, url, body, headers):
+        """
+        Posts 'body' to 'url' as 'request' does, returning the http
+        response before reading its body, and a function release(complete)
+        to be called once done: the connection goes back to the pool if
+        the response has been 'complete'ly read, and is closed otherwise.
+        """
+        key, connection, response = self._post(url, body, headers, self._open)
+
+        def release(complete):
+            if complete:
+                # trailing whitespace, if any
+                response.read()
+            if complete and (response.getheader("Connection", "").lower() != "close"):
+                self._put(key, connection)
+            else:
+                connection.close()
+        return response, release
+
+    def _post(self, url, body, headers, send):
+        parts = urlsplit(url)
+        key = (parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?"+parts.query
+        connection, reused = self._get(key)
+        try:
+            try:
+                sent = send(connection, path, body, headers)
+            except (ConnectionError, HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._new(key)
+                sent = send(connection, path, body, headers)
+        except Exception:
+            connection.close()
+            raise
+        return key, connection, sent
+
+    def _open(self, connection, path, body, headers):
+        connection.request("POST", path, body=body, headers=headers)
+        return connection.getresponse()
+
+    def _send(self, connection, path, body, headers):
+        response = self._open(connection, path, body, headers)
+        text = response.read().decode("utf-8")
+        if response.getheader("Connection", "").lower() == "close":
+            connection.close()
+        return response.status, text
+
+    def _new(self, key):
+        return HTTPConnection(key[0], key[1], timeout=self._timeout)
+
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new(key), False
+
+    def _put(self, key, connection):
+        if connection.sock is None:
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class PooledSEPA:
+    """
+    Blocking SEPA client with the same query and update methods of sepy's
+    SEPA, sending http requests on keep-alive connections of a
+    ConnectionPool. Subscriptions, and requests to https hosts, are
+    left to the sepy 'sepa' instance.
+    """
+    def __init__(self, sepa, max_connections=8):
+        self._sepa = sepa
+        self.sap = sepa.sap
+        self._pool = ConnectionPool(max_size=max_connections)
+
+    def _request(self, url, sparql, isQuery):
+        headers = {
+            "Content-Type": "application/sparql-query" if isQuery else "application/sparql-update",
+            "Accept": "application/sparql-results+json"}
+        return self._pool.request(url, sparql.encode("utf-8"), headers)
+
+    def sparql_query(self, sparql, destination=None):
+        if urlsplit(self.sap.query_url).scheme != "http":
+            return self._sepa.sparql_query(sparql, destination=destination)
+        status, text = self._request(self.sap.query_url, sparql, True)
+        if status != 200:
+            error_message = "Query status code: {}".format(status)
+            logger.error(error_message)
+            raise ValueError(error_message)
+        results = json.loads(text)
+        if "error" in results:
+            logger.error(results["error"]["message"])
+            raise ValueError(results["error"]["message"])
+        if destination is not None:
+            with open(destination, "w") as fileDest:
+                print(json.dumps(results), file=fileDest)
+        return results
+
+    def sparql_query_stream(self, sparql):
+        """
+        Same as sparql_query, returning a streaming.StreamedResult, whose
+        bindings are parsed while they are received
+        """
+        if urlsplit(self.sap.query_url).scheme != "http":
+            return self._sepa.sparql_query(sparql)
+        headers = {"Content-Type": "application/sparql-query",
+                   "Accept": "application/sparql-results+json"}
+        response, release = self._pool.stream(self.sap.query_url, sparql.encode("utf-8"), headers)
+        if response.status != 200:
+            release(True)
+            error_message = "Query status code: {}".format(response.status)
+            logger.error(error_message)
+            raise ValueError(error_message)
+        return StreamedResult(response, on_close=release)
+
+    def sparql_update(self, sparql):
+        if urlsplit(self.sap.update_url).scheme != "http":
+            return self._sepa.sparql_update(sparql)
+        status, text = self._request(self.sap.update_url, sparql, False)
+        if status != 200:
+            logger.error(text)
+            raise ValueError(text)
+        return text
+
+    def query(self, sapIdentifier, forcedBindings={}, destination=None):
+        return self.sparql_query(
+            getTemplate(self.sap, sapIdentifier, sparqlSet="queries").render(forcedBindings),
+            destination=destination)
+
+    def update(self, sapIdentifier, forcedBindings={}):
+        return self.sparql_update(
+            getTemplate(self.sap, sapIdentifier).render(forcedBindings))
+
+    def query_all(self, destination=None):
+        return self.sparql_query("select * where {?a ?b ?c}", destination=destination)
+
+    def clear(self):
+        return self.sparql_update("delete where {?a ?b ?c}")
+
+    def subscribe(self, *args, **kwargs):
+        return self._sepa.subscribe(*args, **kwargs)
+
+    def unsubscribe(self, *args, **kwargs):
+        return self._sepa.unsubscribe(*args, **kwargs)
+
+    def close(self):
+        self._pool.close()
+
+
+class AsyncSEPA:
+    """
+    asyncio adapter of a sepy SEPA instance. Requests are sent by a pool
+    of 'max_connections' threads, each one reusing a keep-alive
+    connection, so that many queries and updates can be awaited
+    concurrently:
+
+        async_sepa = AsyncSEPA(sepa)
+        await asyncio.gather(*[thing.post_async(async_sepa) for thing in things])
+    """
+    def __init__(self, sepa, max_connections=8):
+        self.engine = PooledSEPA(sepa, max_connections=max_connections)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="cocktail-async")
+
+    @property
+    def sap(self):
+        return self.engine.sap
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs function(engine, *args, **kwargs) in the pool, where 'engine'
+        is the blocking PooledSEPA. Any cocktail function taking a sepa
+        instance as first argument can be awaited this way.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(function, self.engine, *args, **kwargs))
+
+    async def sparql_query(self, sparql, destination=None):
+        return await self.run(PooledSEPA.sparql_query, sparql, destination=destination)
+
+    async def sparql_update(self, sparql):
+        return await self.run(PooledSEPA.sparql_update, sparql)
+
+    async def query(self, sapIdentifier, forcedBindings={}, destination=None):
+        return await self.run(PooledSEPA.query, sapIdentifier,
+                              forcedBindings=forcedBindings, destination=destination)
+
+    async def update(self, sapIdentifier, forcedBindings={}):
+        return await self.run(PooledSEPA.update, sapIdentifier, forcedBindings=forcedBindings)
+
+    def close(self):
+        """
+        Waits for the pending requests, and closes the connections
+        """
+        self._executor.shutdown(wait=True)
+        self.engine.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -24,80 +24,308 @@
 
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from threading import Thread
-from time import asctime
+from socketserver import ThreadingMixIn
+from email.utils import formatdate, parsedate_to_datetime
+from threading import Thread, Lock
+from functools import lru_cache
+from urllib.parse import urlsplit, quote
+from time import asctime, time
+from math import ceil
 from rdflib import Graph, Literal, BNode, URIRef
 from pyld import jsonld
+from .jld_framing import frameConstruct
 
 import logging
+import hashlib
+import gzip
 import json
 
 
 logger = logging.getLogger("cocktail_log")
-bnode_id = {}
+_shared_servers = {}
+_shared_servers_lock = Lock()
 
 
-def graphNodeBuilder(binding):
-    global bnode_id
+@lru_cache(maxsize=4096)
+def _uriRef(value):
+    # predicates and classes repeat in every construct: the URIRef objects
+    # are shared among calls, within a bounded cache
+    return URIRef(value)
+
+
+def graphNodeBuilder(binding, bnodes=None):
+    """
+    Returns the rdflib node of the sparql json 'binding'. Blank nodes
+    are looked up in 'bnodes', the dictionary of the blank nodes of the
+    current result, which is updated with the new ones. If 'bnodes' is
+    None, every blank node is a new one.
+    """
     bindingValue = binding["value"]
     if binding["type"] == "uri":
-        return URIRef(bindingValue)
+        return _uriRef(bindingValue)
     elif binding["type"] == "literal":
         return Literal(bindingValue)
-    elif bindingValue in bnode_id.keys():
-        return bnode_id[bindingValue]
-    else:
-        bnode_id[bindingValue] = BNode()
-        return bnode_id[bindingValue]
+    elif bnodes is None:
+        return BNode()
+    elif bindingValue not in bnodes:
+        bnodes[bindingValue] = BNode()
+    return bnodes[bindingValue]
 
 
-def jldTaskBuilder(jld_content):
-    class JLDServerTask(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.respond()
-        
-        def handle_http(self, status, content_type):
-            self.send_response(status)
-            self.send_header("Content-type", content_type)
-            self.end_headers()
-            result = bytes(jld_content, "UTF-8")
-            return result
+class JLDPayload:
+    """
+    JSON-LD content served by JLDServer, encoded (and compressed) once.
+    """
+    def __init__(self, jld_content):
+        self.timestamp = time()
+        self.last_modified = formatdate(int(self.timestamp), usegmt=True)
+        self.content = bytes(jld_content, "UTF-8")
+        self.gzip_content = gzip.compress(self.content)
+        digest = hashlib.sha1(self.content).hexdigest()
+        # strong validators differ for each content coding
+        self.etag = '"{}"'.format(digest)
+        self.gzip_etag = '"{}-gzip"'.format(digest)
+
+    def not_modified(self, headers, etag=None):
+        """
+        Checks the conditional GET 'headers' against the payload, whose
+        representation has the 'etag' validator (the identity one if None).
+        As in RFC 7232, If-Modified-Since is ignored when If-None-Match is
+        given. Last-Modified has a one second resolution, so the payload is
+        modified unless its timestamp, rounded up, is not after the date.
+        """
+        etag = etag if etag is not None else self.etag
+        if headers.get("If-None-Match") is not None:
+            # If-None-Match uses the weak comparison
+            etags = [tag.strip() for tag in headers["If-None-Match"].split(",")]
+            etags = [tag[2:] if tag.startswith("W/") else tag for tag in etags]
+            return (etag in etags) or ("*" in etags)
+        if headers.get("If-Modified-Since") is not None:
+            try:
+                since = parsedate_to_datetime(headers["If-Modified-Since"])
+                return ceil(self.timestamp) <= since.timestamp()
+            except (TypeError, ValueError):
+                pass
+        return False
+
+
+def acceptsGzip(accept_encoding):
+    """
+    Whether the 'accept_encoding' header value allows gzip, i.e. lists
+    gzip (or *) with a non zero q-value
+    """
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        parts = [part.strip() for part in item.split(";")]
+        if not parts[0]:
+            continue
+        q = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[parts[0].lower()] = q
+    if "gzip" in qvalues:
+        return qvalues["gzip"] > 0
+    return qvalues.get("*", 0) > 0
+
+
+class JLDRequestHandler(BaseHTTPRequestHandler):
+    content_type = "application/json-ld"
 
-        def respond(self):
-            content = self.handle_http(200, "application/json-ld")
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body):
+        payload = self.server.jld_server.payload_for(self.path)
+        if payload is None:
+            self.send_error(404)
+            return
+        gzipped = acceptsGzip(self.headers.get("Accept-Encoding", ""))
+        etag = payload.gzip_etag if gzipped else payload.etag
+        if payload.not_modified(self.headers, etag):
+            self.send_response(304)
+            self.send_cache_headers(payload, etag)
+            self.end_headers()
+            return
+        content = payload.content
+        self.send_response(200)
+        self.send_header("Content-type", self.content_type)
+        if gzipped:
+            content = payload.gzip_content
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_cache_headers(payload, etag)
+        self.end_headers()
+        if send_body:
             self.wfile.write(content)
-    return JLDServerTask
-    
-def jldFileBuilder(construct_result, frame=None):
-    thingGraph = Graph()
-    for binding in construct_result["results"]["bindings"]:
-        # subject
-        s = graphNodeBuilder(binding["subject"])
-        # predicate
-        p = graphNodeBuilder(binding["predicate"])
-        # object
-        o = graphNodeBuilder(binding["object"])
-        thingGraph.add((s, p, o))
-    jld_result = thingGraph.serialize(format="json-ld").decode("utf-8")
+
+    def send_cache_headers(self, payload, etag):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", payload.last_modified)
+        self.send_header("Cache-Control", "max-age={}".format(self.server.jld_server.max_age))
+        self.send_header("Vary", "Accept-Encoding")
+
+    def log_message(self, format, *args):
+        logger.debug("{} - {}".format(self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def jldFileBuilder(construct_result, frame=None, native=True):
+    """
+    Builds the JSON-LD of the 'construct_result' triples, framed with
+    'frame' if given. Blank nodes are scoped to this call.
+    Framing is done natively on the bindings if 'native' is True and the
+    frame is supported by jld_framing; otherwise the triples go through
+    an rdflib graph and pyld, which remain the reference implementation.
+    """
+    if frame and native:
+        try:
+            return json.dumps(frameConstruct(construct_result, json.loads(frame)), indent=4)
+        except NotImplementedError as e:
+            logger.debug("Native framing not available: {}".format(e))
+    jld_result = _rdflibJsonLD(construct_result)
     if frame:
         jld_frame = json.loads(frame)
         jld_result_framed = jsonld.frame(json.loads(jld_result), jld_frame)
         return json.dumps(jld_result_framed, indent=4)
     return jld_result
 
+
+def _rdflibJsonLD(construct_result):
+    thingGraph = Graph()
+    bnodes = {}
+    thingGraph.addN(
+        (graphNodeBuilder(binding["subject"], bnodes),
+         graphNodeBuilder(binding["predicate"], bnodes),
+         graphNodeBuilder(binding["object"], bnodes),
+         thingGraph) for binding in construct_result["results"]["bindings"])
+    jld_result = thingGraph.serialize(format="json-ld")
+    if isinstance(jld_result, bytes):
+        # rdflib < 6 serializes to bytes
+        jld_result = jld_result.decode("utf-8")
+    return jld_result
+
+
+def sameJsonLD(jldA, jldB):
+    """
+    Checks whether two JSON-LD objects describe the same graph, comparing
+    their URDNA2015 normalization.
+    """
+    options = {"algorithm": "URDNA2015", "format": "application/n-quads"}
+    return jsonld.normalize(jldA, options) == jsonld.normalize(jldB, options)
+
+
 class JLDServer(Thread):
-    def __init__(self, ip, port, jld_content):
+    """
+    Threaded http server for JSON-LD contents. Contents are encoded
+    once, and served with ETag and Last-Modified headers, so that clients
+    can make conditional requests. gzip encoding is supported.
+    The server may host many contents, each at its own path: the
+    'jld_content' given to the constructor, if any, is served at every
+    path that has not been added explicitly.
+    A server replaced by 'shared_jld_server' forwards the changes of its
+    contents to the replacement.
+    """
+    def __init__(self, ip, port, jld_content=None, max_age=60):
         Thread.__init__(self)
         self.ip = ip
         self.port = port
-        self.httpd = None
-        self.jld_content = jld_content
+        self.max_age = max_age
+        self.payload = JLDPayload(jld_content) if jld_content is not None else None
+        self.routes = {}
+        self.replacement = None
+        self.httpd = ThreadingHTTPServer((self.ip, self.port), JLDRequestHandler)
+        self.httpd.jld_server = self
+
+    @property
+    def jld_content(self):
+        return self.payload.content.decode("UTF-8") if self.payload is not None else None
+
+    def set_content(self, jld_content):
+        """
+        Replaces the default content. Requests already being served
+        complete with the previous one.
+        """
+        if self.replacement is not None:
+            return self.replacement.set_content(jld_content)
+        self.payload = JLDPayload(jld_content)
+
+    def add(self, path, jld_content):
+        """
+        Serves 'jld_content' at 'path', replacing the previous content
+        of the same path, if any.
+        """
+        if self.replacement is not None:
+            return self.replacement.add(path, jld_content)
+        routes = dict(self.routes)
+        routes[path] = JLDPayload(jld_content)
+        self.routes = routes
+
+    def remove(self, path):
+        """
+        Stops serving the content at 'path'
+        """
+        if self.replacement is not None:
+            return self.replacement.remove(path)
+        routes = dict(self.routes)
+        routes.pop(path, None)
+        self.routes = routes
+
+    def payload_for(self, path):
+        """
+        Returns the JLDPayload to be served at 'path', or None
+        """
+        return self.routes.get(urlsplit(path).path, self.payload)
 
     def run(self):
-        self.httpd = HTTPServer((self.ip, self.port), jldTaskBuilder(self.jld_content))
-        logger.debug(asctime(), 'Server UP - {}:{}'.format(self.ip, self.port))
+        logger.debug("{} Server UP - {}:{}".format(asctime(), self.ip, self.port))
         self.httpd.serve_forever()
-        logger.debug(asctime(), 'Server DOWN - {}:{}'.format(self.ip, self.port))
+        logger.debug("{} Server DOWN - {}:{}".format(asctime(), self.ip, self.port))
         
     def kill(self):
+        if self.is_alive():
+            self.httpd.shutdown()
         self.httpd.server_close()
+
+
+def shared_jld_server(ip, port):
+    """
+    Returns the JLDServer listening at 'ip':'port' shared by all the Things
+    and DataSchemas of the process, starting it at the first call.
+    If the shared server has stopped, its socket is closed and a new one
+    is started, serving the same contents.
+    """
+    with _shared_servers_lock:
+        previous = _shared_servers.get((ip, port))
+        if (previous is None) or (not previous.is_alive()):
+            if previous is not None:
+                logger.warning("Shared JLDServer {}:{} is down: restarting it".format(ip, port))
+                previous.kill()
+            server = JLDServer(ip, port)
+            if previous is not None:
+                # Things and DataSchemas keep a reference to the old server
+                previous.replacement = server
+                server.payload = previous.payload
+                server.routes = previous.routes
+            server.daemon = True
+            server.start()
+            _shared_servers[(ip, port)] = server
+        return _shared_servers[(ip, port)]
+
+
+def jldPath(category, name):
+    """
+    Path at which the shared server publishes 'name' of 'category'
+    ('td' or 'ds')
+    """
+    return "/{}/{}".format(category, quote(name, safe=""))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  dispatcher.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Lock, Semaphore, Condition, local
+from time import monotonic
+
+import logging
+
+logger = logging.getLogger("cocktail_log")
+_handling = local()
+
+
+def instanceKey(variable):
+    """
+    Returns an 'order_by' function for Dispatcher.wrap, keying the
+    notifications on the value of 'variable' (e.g. "aInstance")
+    """
+    def key(added, removed):
+        for binding in (added or removed):
+            if variable in binding:
+                return binding[variable]["value"]
+        return None
+    return key
+
+
+def _runHandler(dispatcher_id, handler, added, removed):
+    # marks the worker thread as running a handler of the dispatcher
+    running = getattr(_handling, "dispatchers", None)
+    if running is None:
+        running = _handling.dispatchers = []
+    running.append(dispatcher_id)
+    try:
+        return handler(added, removed)
+    finally:
+        running.pop()
+
+
+class _Lane:
+    """
+    Jobs of a handler wrapped by a Dispatcher
+    """
+    def __init__(self, name, handler, concurrency, order_by):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.order_by = order_by
+        self.waiting = deque()
+        self.running = 0
+        self.busy_keys = set()
+
+    def startable(self, key):
+        return (((self.concurrency is None) or (self.running < self.concurrency)) and
+                ((key is None) or (key not in self.busy_keys)))
+
+
+class Dispatcher:
+    """
+    Runs subscription handlers on an executor, instead of the thread
+    receiving the notifications, so that a slow handler does not delay
+    the following notifications.
+    At most 'max_pending' notifications are queued or running at once:
+    when the limit is reached, the receiving thread waits for a free slot
+    if 'block' is True (so that the broker connection buffers the rest),
+    otherwise the notification is dropped.
+    Notifications received while running one of the handlers are never
+    waited for: with engines delivering them synchronously on the updating
+    thread (e.g. MemorySEPA), a handler making an update would otherwise
+    wait for the slot it holds itself. They are dropped when the limit is
+    reached.
+    The executor is a ThreadPoolExecutor with 'max_workers' threads, if
+    not given. A ProcessPoolExecutor can be used as well, as long as
+    handlers and notifications can be pickled.
+    """
+    def __init__(self, max_workers=8, max_pending=1000, block=True, executor=None):
+        self._executor = executor if executor is not None else ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="cocktail-dispatcher")
+        self._max_pending = max_pending
+        self._block = block
+        self._slots = Semaphore(max_pending)
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        self._lanes = []
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0,
+                          "dropped": 0, "pending": 0, "high_water": 0,
+                          "blocked_seconds": 0.0}
+
+    def wrap(self, handler, name=None, concurrency=None, order_by=None):
+        """
+        Returns a handler(added, removed) to be given to a subscription,
+        which dispatches the notifications to 'handler'.
+        At most 'concurrency' calls of 'handler' run at once (no limit if
+        None). If 'order_by' is given, notifications for which
+        order_by(added, removed) returns the same key are handled one at a
+        time, in the order they arrived.
+        """
+        lane = _Lane(name if name is not None else repr(handler), handler, concurrency, order_by)
+        with self._lock:
+            self._lanes.append(lane)
+
+        def dispatch(added, removed):
+            self.submit(lane, added, removed)
+        dispatch.lane = lane
+        return dispatch
+
+    def submit(self, lane, added, removed):
+        if not self._slots.acquire(blocking=False):
+            if (not self._block) or (id(self) in getattr(_handling, "dispatchers", ())):
+                with self._lock:
+                    self._counters["dropped"] += 1
+                logger.warning("Dispatcher full: notification for {} dropped".format(lane.name))
+                return
+            start = monotonic()
+            self._slots.acquire()
+            with self._lock:
+                self._counters["blocked_seconds"] += monotonic()-start
+        key = lane.order_by(added, removed) if lane.order_by is not None else None
+        with self._lock:
+            self._counters["submitted"] += 1
+            self._counters["pending"] += 1
+            self._counters["high_water"] = max(self._counters["high_water"], self._counters["pending"])
+            lane.waiting.append((key, added, removed))
+            jobs = self._take_startable(lane)
+        self._launch(lane, jobs)
+
+    def _launch(self, lane, jobs):
+        # out of the lock, as the done callback may run immediately
+        for key, added, removed in jobs:
+            future = self._executor.submit(_runHandler, id(self), lane.handler, added, removed)
+            future.add_done_callback(lambda f, key=key: self._done(lane, key, f))
+
+    def _done(self, lane, key, future):
+        failed = future.cancelled() or (future.exception() is not None)
+        if failed:
+            logger.error("Handler {} failed: {}".format(
+                lane.name, "cancelled" if future.cancelled() else future.exception()))
+        with self._lock:
+            self._counters["failed" if failed else "completed"] += 1
+            self._counters["pending"] -= 1
+            lane.running -= 1
+            lane.busy_keys.discard(key)
+            jobs = self._take_startable(lane)
+            if self._counters["pending"] == 0:
+                self._idle.notify_all()
+        self._slots.release()
+        self._launch(lane, jobs)
+
+    def _take_startable(self, lane):
+        # called with the lock held: takes the waiting jobs allowed to
+        # run, in order, never overtaking an earlier job with the same key
+        jobs = []
+        skipped = set()
+        remaining = deque()
+        while lane.waiting and lane.startable(None):
+            key, added, removed = lane.waiting.popleft()
+            if (key not in skipped) and lane.startable(key):
+                lane.running += 1
+                if key is not None:
+                    lane.busy_keys.add(key)
+                jobs.append((key, added, removed))
+            else:
+                if key is not None:
+                    skipped.add(key)
+                remaining.append((key, added, removed))
+        remaining.extend(lane.waiting)
+        lane.waiting = remaining
+        return jobs
+
+    @property
+    def metrics(self):
+        """
+        Counters of the dispatcher: notifications submitted, completed,
+        failed and dropped, currently pending (queued or running), the
+        highest number of pending ones, the seconds spent by the receiving
+        threads waiting for a free slot, and the queued/running jobs of
+        each wrapped handler.
+        """
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics["max_pending"] = self._max_pending
+            metrics["handlers"] = {
+                lane.name: {"queued": len(lane.waiting), "running": lane.running}
+                for lane in self._lanes}
+        return metrics
+
+    def shutdown(self, wait=True):
+        """
+        Stops the executor. If 'wait' is True, the notifications already
+        queued are handled first; otherwise they are dropped.
+        """
+        with self._lock:
+            if wait:
+                self._idle.wait_for(lambda: self._counters["pending"] == 0)
+            else:
+                dropped = 0
+                for lane in self._lanes:
+                    dropped += len(lane.waiting)
+                    lane.waiting.clear()
+                self._counters["dropped"] += dropped
+                self._counters["pending"] -= dropped
+        if not wait:
+            # the slots of the dropped notifications are given back
+            for _ in range(dropped):
+                self._slots.release()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  instances.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from itertools import count
+from os import urandom
+from time import time
+from .utils import absoluteURI, COCKTAIL_NAMESPACES
+
+
+class InstanceURIGenerator:
+    """
+    Generates unique uris for the instances of an InteractionPattern, in
+    its namespace, e.g. <http://event/Instance_TOKEN-0> and
+    <http://event/Data_TOKEN-0> for the 'kinds' Instance and Data.
+    TOKEN is drawn from the clock and from random bytes when the generator
+    is built, so that generators of different processes, or of the same
+    process after a restart, do not clash; then a counter is appended.
+    A prefixed 'namespace' (e.g. swot:MyEvent) is expanded with the
+    'namespaces' of the sap: anything else that is not an absolute uri
+    raises ValueError.
+    """
+    def __init__(self, namespace, kinds=("Instance", "Data"), namespaces=COCKTAIL_NAMESPACES):
+        token = "{:x}{}".format(int(time()*1000), urandom(4).hex())
+        namespace = absoluteURI(namespace, namespaces)
+        self._prefixes = tuple("<{}/{}_{}-".format(namespace.rstrip("/"), kind, token)
+                               for kind in kinds)
+        self._counter = count()
+
+    def __next__(self):
+        """
+        Returns a tuple with the next uri of each kind
+        """
+        n = str(next(self._counter)) + ">"
+        return tuple([prefix + n for prefix in self._prefixes])
+
+    def __iter__(self):
+        return self
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  jld_framing.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+#  Native JSON-LD framing of construct results.
+#  The frames used by cocktail only select nodes by @type, and embed
+#  properties with the default framing flags (@embed @once, no @explicit,
+#  null defaults). This module implements that subset of the JSON-LD 1.1
+#  framing algorithm directly on the sparql json bindings, without
+#  building an rdflib graph nor calling pyld.
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+
+class Frame:
+    """
+    A JSON-LD frame, with expanded iris. 'types' is None if the frame
+    matches every node, True if it matches every node having a type,
+    or the set of the types matched.
+    """
+    __slots__ = ("types", "properties")
+
+    def __init__(self, frame, expand):
+        self.types = None
+        self.properties = {}
+        for key, value in frame.items():
+            if key == "@context":
+                continue
+            elif key == "@type":
+                types = value if isinstance(value, list) else [value]
+                if types == [{}]:
+                    self.types = True
+                elif all(isinstance(t, str) for t in types):
+                    self.types = set(expand(t) for t in types)
+                else:
+                    raise NotImplementedError("@type frame {}".format(value))
+            elif key.startswith("@"):
+                raise NotImplementedError("Frame keyword {}".format(key))
+            else:
+                subframe = value[0] if (isinstance(value, list) and value) else value
+                if not isinstance(subframe, dict):
+                    raise NotImplementedError("Frame value {}".format(value))
+                self.properties[expand(key)] = Frame(subframe, expand)
+        if (self.types is None) and self.properties:
+            # duck typing frames are not used by cocktail
+            raise NotImplementedError("Frames must select nodes by @type")
+
+    def matches(self, node):
+        if self.types is None:
+            return True
+        if self.types is True:
+            return len(node[0]) > 0
+        return not self.types.isdisjoint(node[0])
+
+
+_IMPLICIT_FRAME = Frame({}, None)
+
+
+class Context:
+    """
+    Prefix definitions of a JSON-LD context, to expand and compact iris.
+    """
+    def __init__(self, context):
+        if not isinstance(context, dict):
+            raise NotImplementedError("Context {}".format(context))
+        self.prefixes = {}
+        for prefix, iri in context.items():
+            if prefix.startswith("@") or not isinstance(iri, str):
+                raise NotImplementedError("Context entry {}".format(prefix))
+            self.prefixes[prefix] = iri
+        self._compacted = {}
+
+    def expand(self, term):
+        prefix, colon, suffix = term.partition(":")
+        if colon and (prefix in self.prefixes) and not suffix.startswith("//"):
+            return self.prefixes[prefix] + suffix
+        return term
+
+    def compact(self, iri):
+        if iri not in self._compacted:
+            compacted = iri
+            for prefix, namespace in self.prefixes.items():
+                if iri.startswith(namespace) and len(iri) > len(namespace):
+                    candidate = prefix + ":" + iri[len(namespace):]
+                    if (compacted is iri) or (len(candidate) < len(compacted)):
+                        compacted = candidate
+            self._compacted[iri] = compacted
+        return self._compacted[iri]
+
+
+def _nodeMap(construct_result):
+    """
+    Nodes of the construct result, as id -> (types, properties).
+    Values of the properties are ("@id", id) or ("@value", literal)
+    tuples, in order of appearance and without duplicates.
+    """
+    nodes = {}
+    seen = set()
+    for binding in construct_result["results"]["bindings"]:
+        subject, predicate, obj = binding["subject"], binding["predicate"], binding["object"]
+        s = subject["value"] if subject["type"] == "uri" else "_:"+subject["value"]
+        p = predicate["value"]
+        if obj["type"] == "literal":
+            o = ("@value", obj["value"])
+        else:
+            o = ("@id", obj["value"] if obj["type"] == "uri" else "_:"+obj["value"])
+        if (s, p, o) in seen:
+            continue
+        seen.add((s, p, o))
+        types, properties = nodes.setdefault(s, ([], {}))
+        if (p == RDF_TYPE) and (o[0] == "@id"):
+            types.append(o[1])
+            continue
+        properties.setdefault(p, []).append(o)
+        if o[0] == "@id":
+            nodes.setdefault(o[1], ([], {}))
+    return nodes
+
+
+class _Framer:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.embedded = set()
+        self.stack = []
+        self.bnodes = {}
+
+    def frame(self, node_id, frame, embedded):
+        output = {"@id": node_id}
+        if node_id.startswith("_:"):
+            self.bnodes.setdefault(node_id, []).append(output)
+        if embedded and ((node_id in self.stack) or (node_id in self.embedded)):
+            # circular reference, or node already embedded elsewhere
+            return output
+        self.embedded.add(node_id)
+        self.stack.append(node_id)
+        types, properties = self.nodes[node_id]
+        if types:
+            output["@type"] = types
+        for prop in sorted(properties):
+            subframe = frame.properties.get(prop, _IMPLICIT_FRAME)
+            for kind, value in properties[prop]:
+                if kind == "@id":
+                    if subframe.matches(self.nodes[value]):
+                        output.setdefault(prop, []).append(self.frame(value, subframe, True))
+                elif subframe.types is None:
+                    output.setdefault(prop, []).append(value)
+        for prop in frame.properties:
+            output.setdefault(prop, None)
+        self.stack.pop()
+        return output
+
+
+def _compact(node, context, bnode_labels):
+    result = {}
+    for key in sorted(node):
+        value = node[key]
+        if key == "@id":
+            if value.startswith("_:"):
+                if value in bnode_labels:
+                    result["@id"] = bnode_labels[value]
+            else:
+                result["@id"] = context.compact(value)
+        elif key == "@type":
+            types = [context.compact(t) for t in value]
+            result["@type"] = types[0] if len(types) == 1 else types
+        elif value is None:
+            result[context.compact(key)] = None
+        else:
+            values = [_compact(v, context, bnode_labels) if isinstance(v, dict) else v
+                      for v in value]
+            result[context.compact(key)] = values[0] if len(values) == 1 else values
+    return result
+
+
+def frameConstruct(construct_result, frame):
+    """
+    Returns the JSON-LD object of the 'construct_result' triples, framed
+    with the 'frame' object, as pyld.jsonld.frame would produce it.
+    Nodes are embedded in order of id and property, so that, when a node
+    is referenced more than once, the place where it is embedded may
+    differ from pyld's; the graph is the same.
+    Literals are plain strings, as in jldFileBuilder.
+    NotImplementedError is raised for frames outside the supported subset.
+    """
+    context = Context(frame.get("@context", {}))
+    root = Frame(frame, context.expand)
+    nodes = _nodeMap(construct_result)
+    framer = _Framer(nodes)
+    results = []
+    for node_id in sorted(nodes):
+        if root.matches(nodes[node_id]):
+            framer.embedded = set()
+            results.append(framer.frame(node_id, root, False))
+
+    # blank nodes referenced only once lose their identifier
+    bnode_labels = {}
+    for bnode, outputs in framer.bnodes.items():
+        if len(outputs) > 1:
+            bnode_labels[bnode] = "_:b{}".format(len(bnode_labels))
+    results = [_compact(node, context, bnode_labels) for node in results]
+
+    jld = {"@context": frame["@context"]} if "@context" in frame else {}
+    if len(results) == 1:
+        jld.update(results[0])
+    elif results:
+        jld["@graph"] = results
+    return jld
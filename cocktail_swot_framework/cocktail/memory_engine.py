@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  memory_engine.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from collections import deque
+from threading import RLock
+from rdflib import Graph, URIRef, BNode
+from rdflib.plugins.stores.memory import Memory
+from sepy.SAPObject import SAPObject
+from .utils import cocktail_sap_content
+from .templates import getTemplate
+
+import json
+import logging
+
+logger = logging.getLogger("cocktail_log")
+
+
+def cocktail_sap():
+    """
+    Returns the SAPObject of the cocktail sparqls
+    """
+    return SAPObject(cocktail_sap_content())
+
+
+def _node(term):
+    if isinstance(term, URIRef):
+        return {"type": "uri", "value": str(term)}
+    if isinstance(term, BNode):
+        return {"type": "bnode", "value": str(term)}
+    cell = {"type": "literal", "value": str(term)}
+    if term.datatype is not None:
+        cell["datatype"] = str(term.datatype)
+    if term.language is not None:
+        cell["xml:lang"] = term.language
+    return cell
+
+
+def _rowKey(binding):
+    return frozenset((key, cell["type"], cell["value"]) for key, cell in binding.items())
+
+
+class _TrackedMemory(Memory):
+    """
+    rdflib memory store remembering whether triples were added or removed
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = False
+
+    def add(self, *args, **kwargs):
+        self.changed = True
+        return super().add(*args, **kwargs)
+
+    def remove(self, *args, **kwargs):
+        self.changed = True
+        return super().remove(*args, **kwargs)
+
+
+class MemorySEPA:
+    """
+    Drop-in replacement of sepy's SEPA, with the same query, update and
+    subscribe methods, working on an in-memory rdflib graph instead of a
+    remote broker: for tests, and for small deployments where a single
+    process uses the rdf store.
+    After every update changing the graph, the subscriptions are
+    evaluated again, and their handlers called with the added and removed
+    bindings. Handlers run on the thread performing the update (or the
+    subscription), after the update is applied and out of the store
+    lock, one at a time and in order: updates made meanwhile by other
+    threads, or by the handlers themselves, are notified once the
+    current notifications are delivered.
+    """
+    def __init__(self, sapObject=None, client_id=None, logLevel=logging.ERROR):
+        self.sap = sapObject if sapObject is not None else cocktail_sap()
+        self._store = _TrackedMemory()
+        self.graph = Graph(store=self._store)
+        self.requests = 0
+        self._lock = RLock()
+        self._subscriptions = {}
+        self._next_subid = 0
+        self._notifications = deque()
+        self._delivering = False
+
+    def setSAP(self, sapObject):
+        self.sap = sapObject
+
+    def get_subscriptions(self):
+        with self._lock:
+            return {subid: sparql for subid, (sparql, rows, handler) in self._subscriptions.items()}
+
+    def sparql_query(self, sparql, destination=None, **kwargs):
+        with self._lock:
+            self.requests += 1
+            results = self._evaluate(sparql)
+        if destination is not None:
+            with open(destination, "w") as fileDest:
+                print(json.dumps(results), file=fileDest)
+        return results
+
+    def _evaluate(self, sparql):
+        result = self.graph.query(sparql)
+        if result.type == "CONSTRUCT":
+            # as SEPA gives them: triples of the default graph, without context
+            return {"head": {"vars": ["subject", "predicate", "object", "context"]},
+                    "results": {"bindings": [
+                        {"subject": _node(s), "predicate": _node(p), "object": _node(o)}
+                        for s, p, o in result]}}
+        if result.type == "ASK":
+            return {"head": {}, "boolean": result.askAnswer}
+        variables = [str(v) for v in result.vars]
+        return {"head": {"vars": variables},
+                "results": {"bindings": [
+                    {var: _node(term) for var, term in zip(variables, row) if term is not None}
+                    for row in result]}}
+
+    def sparql_update(self, sparql, **kwargs):
+        with self._lock:
+            self.requests += 1
+            self._store.changed = False
+            self.graph.update(sparql)
+            if self._store.changed:
+                self._detectChanges()
+        self._deliver()
+
+    def _detectChanges(self):
+        # called with the lock held
+        for subid, subscription in self._subscriptions.items():
+            sparql, rows, handler = subscription
+            current = {_rowKey(b): b for b in self._evaluate(sparql)["results"]["bindings"]}
+            added = [b for key, b in current.items() if key not in rows]
+            removed = [b for key, b in rows.items() if key not in current]
+            subscription[1] = current
+            if added or removed:
+                self._notifications.append((subid, handler, added, removed))
+
+    def _deliver(self):
+        with self._lock:
+            if self._delivering:
+                return
+            self._delivering = True
+        while True:
+            with self._lock:
+                if not self._notifications:
+                    self._delivering = False
+                    return
+                subid, handler, added, removed = self._notifications.popleft()
+                if subid not in self._subscriptions:
+                    continue
+            try:
+                handler(added, removed)
+            except Exception as e:
+                logger.error("Handler of subscription {} failed: {}".format(subid, e))
+
+    def query(self, sapIdentifier, forcedBindings={}, destination=None, **kwargs):
+        return self.sparql_query(
+            getTemplate(self.sap, sapIdentifier, sparqlSet="queries").render(forcedBindings),
+            destination=destination)
+
+    def update(self, sapIdentifier, forcedBindings={}, **kwargs):
+        return self.sparql_update(getTemplate(self.sap, sapIdentifier).render(forcedBindings))
+
+    def query_all(self, destination=None, **kwargs):
+        return self.sparql_query("select * where {?a ?b ?c}", destination=destination)
+
+    def clear(self, **kwargs):
+        return self.sparql_update("delete where {?a ?b ?c}")
+
+    def sparql_subscribe(self, sparql, alias, handler=lambda a, r: None, **kwargs):
+        """
+        As with a SEPA broker, the first notification carries the current
+        results of the subscription. Returns the subscription id.
+        """
+        with self._lock:
+            self._next_subid += 1
+            subid = "{}_{}".format(alias, self._next_subid)
+            rows = {_rowKey(b): b for b in self._evaluate(sparql)["results"]["bindings"]}
+            self._subscriptions[subid] = [sparql, rows, handler]
+            self._notifications.append((subid, handler, list(rows.values()), []))
+        self._deliver()
+        return subid
+
+    def subscribe(self, sapIdentifier, alias, forcedBindings={}, handler=lambda a, r: None, **kwargs):
+        return self.sparql_subscribe(
+            getTemplate(self.sap, sapIdentifier, sparqlSet="queries").render(forcedBindings),
+            alias, handler=handler)
+
+    def unsubscribe(self, subid):
+        with self._lock:
+            self._subscriptions.pop(subid, None)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  records.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+#  Compact decoding of sparql json results.
+#  A row of a result, {"var": {"type": ..., "value": ...}, ...}, takes a
+#  dictionary per cell: Records keep instead the values in the slots of a
+#  single object, and the types in a tuple shared by the rows with the
+#  same types. ColumnarResult keeps a list of values per variable.
+
+from keyword import iskeyword
+from sys import intern
+
+_record_types = {}
+_type_tuples = {}
+
+
+def _tag(cell):
+    """
+    Interned tag of the type of 'cell': "uri", "bnode", "literal", the
+    datatype iri of a typed literal, or "@" and the language of a
+    language tagged literal
+    """
+    if "datatype" in cell:
+        return intern(cell["datatype"])
+    if "xml:lang" in cell:
+        return intern("@"+cell["xml:lang"])
+    return intern(cell["type"])
+
+
+def _cell(tag, value):
+    if (tag == "uri") or (tag == "bnode") or (tag == "literal"):
+        return {"type": tag, "value": value}
+    if tag.startswith("@"):
+        return {"type": "literal", "value": value, "xml:lang": tag[1:]}
+    return {"type": "literal", "value": value, "datatype": tag}
+
+
+def _shared(types):
+    return _type_tuples.setdefault(types, types)
+
+
+class Record:
+    """
+    A row of a query result, whose values are read as attributes
+    (record.thing) or items (record["thing"]); unbound variables are None.
+    Variables named as the methods of the record (e.g. ?type) are read
+    as items only.
+    Classes of records are made by 'recordType'.
+    """
+    __slots__ = ("_types",)
+    variables = ()
+    _slot_names = ()
+
+    def __getitem__(self, variable):
+        return getattr(self, self._slot_names[self.variables.index(variable)])
+
+    def get(self, variable, default=None):
+        if variable not in self.variables:
+            return default
+        value = self[variable]
+        return default if value is None else value
+
+    def type(self, variable):
+        """
+        "uri", "bnode", "literal", the datatype of a typed literal, "@"
+        and the language of a language tagged literal, or None if unbound
+        """
+        return self._types[self.variables.index(variable)]
+
+    def toBinding(self):
+        """
+        The row in sparql json format
+        """
+        binding = {}
+        for variable, slot, tag in zip(self.variables, self._slot_names, self._types):
+            if tag is not None:
+                binding[variable] = _cell(tag, getattr(self, slot))
+        return binding
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and (self.toBinding() == other.toBinding())
+
+    def __repr__(self):
+        return "Record({})".format(", ".join(
+            "{}={!r}".format(variable, self[variable]) for variable in self.variables))
+
+
+def _slotName(variable):
+    # sparql variables may not be python identifiers, or may shadow the
+    # attributes of the records
+    if (variable.isidentifier() and not iskeyword(variable) and not variable.startswith("_")
+            and (variable not in _reserved)):
+        return variable
+    return "_v_" + "".join(c if c.isalnum() else "_" for c in variable)
+
+
+_reserved = frozenset(dir(Record)) | {"fromBinding"}
+
+
+def recordType(variables):
+    """
+    Returns the Record class of the rows of a result with the given
+    'variables' (its ["head"]["vars"]), which is built only once.
+    """
+    variables = tuple(variables)
+    if variables not in _record_types:
+        slot_names = tuple(_slotName(variable) for variable in variables)
+        record_class = type("Record", (Record,), {
+            "__slots__": slot_names, "variables": variables, "_slot_names": slot_names})
+
+        def fromBinding(binding):
+            record = record_class.__new__(record_class)
+            types = []
+            for variable, slot in zip(variables, slot_names):
+                cell = binding.get(variable)
+                if cell is None:
+                    setattr(record, slot, None)
+                    types.append(None)
+                else:
+                    setattr(record, slot, cell["value"])
+                    types.append(_tag(cell))
+            record._types = _shared(tuple(types))
+            return record
+        record_class.fromBinding = staticmethod(fromBinding)
+        _record_types[variables] = record_class
+    return _record_types[variables]
+
+
+def decodeRecords(result):
+    """
+    Generator of the Records of the rows of a sparql json 'result'
+    """
+    fromBinding = recordType(result["head"]["vars"]).fromBinding
+    for binding in result["results"]["bindings"]:
+        yield fromBinding(binding)
+
+
+class ColumnarResult:
+    """
+    A query result stored by column: a list of values per variable, with
+    a list of interned type tags (see Record.type) beside each one.
+    """
+    def __init__(self, variables, bindings=()):
+        self.variables = tuple(variables)
+        self.columns = {variable: [] for variable in self.variables}
+        self.tags = {variable: [] for variable in self.variables}
+        for binding in bindings:
+            self.append(binding)
+
+    @classmethod
+    def fromQuery(cls, result):
+        return cls(result["head"]["vars"], result["results"]["bindings"])
+
+    def append(self, binding):
+        for variable in self.variables:
+            cell = binding.get(variable)
+            if cell is None:
+                self.columns[variable].append(None)
+                self.tags[variable].append(None)
+            else:
+                self.columns[variable].append(cell["value"])
+                self.tags[variable].append(_tag(cell))
+
+    def column(self, variable):
+        return self.columns[variable]
+
+    def __len__(self):
+        return len(self.columns[self.variables[0]]) if self.variables else 0
+
+    def binding(self, index):
+        """
+        The 'index' row in sparql json format
+        """
+        return {variable: _cell(self.tags[variable][index], self.columns[variable][index])
+                for variable in self.variables if self.tags[variable][index] is not None}
+
+    def __iter__(self):
+        """
+        Iterates over the rows as Records
+        """
+        fromBinding = recordType(self.variables).fromBinding
+        for index in range(len(self)):
+            yield fromBinding(self.binding(index))
+
+    def toQuery(self):
+        """
+        The result in sparql json format
+        """
+        return {"head": {"vars": list(self.variables)},
+                "results": {"bindings": [self.binding(index) for index in range(len(self))]}}
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  registry.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from sepy.SAPObject import uriFormat
+from threading import RLock, Event
+from .utils import canonical_binding, plainURI
+from .scheduling import timerQueue
+
+import logging
+
+logger = logging.getLogger("cocktail_log")
+
+
+class BindingIndex:
+    """
+    Dictionary of query result rows, indexed by the value of the 'key'
+    variable. Rows are added and removed as they come from subscription
+    notifications.
+    """
+    def __init__(self, key):
+        self._key = key
+        self._rows = {}
+
+    def add(self, binding, canonical=None):
+        """
+        Adds 'binding', whose canonical_binding may be given, returning
+        False if it was already there
+        """
+        if self._key not in binding:
+            return False
+        rows = self._rows.setdefault(binding[self._key]["value"], {})
+        canonical = canonical if canonical is not None else canonical_binding(binding)
+        if canonical in rows:
+            return False
+        rows[canonical] = binding
+        return True
+
+    def remove(self, binding, canonical=None):
+        """
+        Removes 'binding', returning False if it was not there
+        """
+        if self._key not in binding:
+            return False
+        value = binding[self._key]["value"]
+        rows = self._rows.get(value, {})
+        found = rows.pop(canonical if canonical is not None else canonical_binding(binding), None)
+        if not rows:
+            self._rows.pop(value, None)
+        return found is not None
+
+    def get(self, value):
+        """
+        Returns the list of rows for 'value', raising KeyError if none
+        """
+        return list(self._rows[plainURI(value)].values())
+
+    def keys(self):
+        return self._rows.keys()
+
+    def rows(self):
+        for rows in self._rows.values():
+            yield from rows.values()
+
+    def __contains__(self, value):
+        return plainURI(value) in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class LiveResultSet:
+    """
+    Current results of the 'identifier' subscription, indexed by the
+    value of the 'key' variable, as a BindingIndex kept up to date by the
+    notifications. A row removed and added back in the same notification
+    (e.g. by the delete/insert of an update) is not a change.
+    If 'on_change' is given, it is called as a subscription handler,
+    on_change(added, removed), with the rows actually changed; with a
+    'debounce' of some seconds, the changes are collected in that time
+    (a row removed and added back cancels out) and notified at once.
+
+        actuators = LiveResultSet(engine, "THERMOSTAT_SMART_DISCOVERY", "action",
+                                  forcedBindings={"ds": ds_psi}).start()
+        if actionURI in actuators:
+            ...
+    """
+    def __init__(self, sepa, identifier, key, forcedBindings={},
+                 on_change=None, debounce=None, alias=None):
+        self._sepa = sepa
+        self._identifier = identifier
+        self._forcedBindings = forcedBindings
+        self._alias = alias if alias is not None else "live_"+identifier.lower()
+        self._index = BindingIndex(key)
+        self._lock = RLock()
+        self._ready = Event()
+        self._on_change = on_change
+        self._debounce = debounce
+        self._pending = ({}, {})
+        self._timer = None
+        self._subid = None
+
+    def start(self, timeout=10):
+        """
+        Opens the subscription, and waits at most 'timeout' seconds for
+        its first notification.
+        """
+        if self._subid is not None:
+            logger.warning("{} already started".format(self._alias))
+            return self
+        self._subid = self._sepa.subscribe(
+            self._identifier, self._alias,
+            forcedBindings=self._forcedBindings, handler=self.handler)
+        if not self._ready.wait(timeout):
+            logger.warning("No initial results for {}".format(self._identifier))
+        return self
+
+    def stop(self):
+        """
+        Closes the subscription, and notifies the changes still pending.
+        The results are kept as they are.
+        """
+        if self._subid is not None:
+            self._sepa.unsubscribe(self._subid)
+            self._subid = None
+        self.flush()
+
+    def handler(self, added, removed):
+        """
+        Applies a notification. It is the handler of the subscription,
+        and can be given to a subscription opened elsewhere as well.
+        """
+        added = {canonical_binding(binding): binding for binding in added}
+        removed = {canonical_binding(binding): binding for binding in removed}
+        for canonical in set(added) & set(removed):
+            del added[canonical]
+            del removed[canonical]
+        with self._lock:
+            removed = [(canonical, binding) for canonical, binding in removed.items()
+                       if self._index.remove(binding, canonical)]
+            added = [(canonical, binding) for canonical, binding in added.items()
+                     if self._index.add(binding, canonical)]
+            if (self._on_change is not None) and (self._debounce is not None):
+                self._collect(added, removed)
+        self._ready.set()
+        if (self._on_change is not None) and (self._debounce is None) and (added or removed):
+            self._notify([binding for canonical, binding in added],
+                         [binding for canonical, binding in removed])
+
+    def _collect(self, added, removed):
+        # called with the lock held
+        pending_added, pending_removed = self._pending
+        for canonical, binding in removed:
+            if pending_added.pop(canonical, None) is None:
+                pending_removed[canonical] = binding
+        for canonical, binding in added:
+            if pending_removed.pop(canonical, None) is None:
+                pending_added[canonical] = binding
+        if (pending_added or pending_removed) and (self._timer is None):
+            self._timer = timerQueue().schedule(self._debounce, self.flush)
+
+    def flush(self):
+        """
+        Notifies the changes collected while debouncing
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            (added, removed), self._pending = self._pending, ({}, {})
+        if added or removed:
+            self._notify(list(added.values()), list(removed.values()))
+
+    def _notify(self, added, removed):
+        try:
+            self._on_change(added, removed)
+        except Exception as e:
+            logger.error("{} change handler failed: {}".format(self._alias, e))
+
+    def get(self, value):
+        """
+        Returns the rows for 'value', raising KeyError if none
+        """
+        with self._lock:
+            return self._index.get(value)
+
+    def keys(self):
+        with self._lock:
+            return list(self._index.keys())
+
+    def rows(self):
+        with self._lock:
+            return list(self._index.rows())
+
+    def __contains__(self, value):
+        return value in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+class ThingRegistry:
+    """
+    Local materialized copy of the Things, Thing Descriptions, Interaction
+    Patterns and DataSchemas available in the rdf store.
+    The registry subscribes once to the discovery queries, and keeps its
+    indexes up to date with the notifications, so that lookups do not
+    involve the broker.
+    """
+    # sap entry, indexes fed by it, forced bindings retrieving everything
+    SUBSCRIPTIONS = [
+        ("DISCOVER_THINGS", ["thing", "td"],
+         {"thing_uri": "UNDEF", "name_literal": "UNDEF", "td_uri": "UNDEF"}),
+        ("DISCOVER_INTERACTION_PATTERNS", ["ipattern", "td"],
+         {"td_uri": "UNDEF", "ipattern_type_specific": "UNDEF"}),
+        ("DESCRIBE_ACTION", ["action"], {"action_uri": "UNDEF"}),
+        ("DESCRIBE_EVENT", ["event"], {"event_uri": "UNDEF"}),
+        ("GET_DATASCHEMAS", ["ds"],
+         {"ip_force": "UNDEF", "ds_force": "UNDEF",
+          "fs_force": "UNDEF", "fs_type_force": "UNDEF"})]
+
+    def __init__(self, sepa):
+        self._sepa = sepa
+        self._lock = RLock()
+        self._indexes = {}
+        self._subids = []
+
+    def start(self, timeout=10):
+        """
+        Opens the subscriptions, and waits at most 'timeout' seconds for
+        their first notification.
+        """
+        if self._subids:
+            logger.warning("Registry already started")
+            return self
+        for identifier, keys, forcedBindings in self.SUBSCRIPTIONS:
+            indexes = [self._indexes.setdefault(
+                (identifier, key), BindingIndex(key)) for key in keys]
+            ready = Event()
+            self._subids.append(self._sepa.subscribe(
+                identifier, "registry_"+identifier.lower(),
+                forcedBindings=forcedBindings,
+                handler=self._handler(indexes, ready)))
+            if not ready.wait(timeout):
+                logger.warning("No initial results for {}".format(identifier))
+        return self
+
+    def stop(self):
+        """
+        Closes the subscriptions. Indexes are kept as they are.
+        """
+        for subid in self._subids:
+            self._sepa.unsubscribe(subid)
+        self._subids = []
+
+    def _handler(self, indexes, ready):
+        def handler(added, removed):
+            with self._lock:
+                for binding in removed:
+                    for index in indexes:
+                        index.remove(binding)
+                for binding in added:
+                    for index in indexes:
+                        index.add(binding)
+            ready.set()
+        return handler
+
+    def _get(self, identifier, key, value):
+        with self._lock:
+            return self._indexes[(identifier, key)].get(value)
+
+    def things(self):
+        """
+        Returns the uris of the known Things
+        """
+        with self._lock:
+            return list(self._indexes[("DISCOVER_THINGS", "thing")].keys())
+
+    def thing(self, thingURI):
+        """
+        Returns the DISCOVER_THINGS rows of 'thingURI'
+        """
+        return self._get("DISCOVER_THINGS", "thing", thingURI)
+
+    def thing_of_td(self, tdURI):
+        """
+        Returns the uri of the Thing described by 'tdURI'
+        """
+        return uriFormat(self._get("DISCOVER_THINGS", "td", tdURI)[0]["thing"]["value"])
+
+    def interaction_pattern(self, ipURI):
+        """
+        Returns the DISCOVER_INTERACTION_PATTERNS row of 'ipURI'
+        """
+        return self._get("DISCOVER_INTERACTION_PATTERNS", "ipattern", ipURI)[0]
+
+    def interaction_patterns(self, tdURI):
+        """
+        Returns the DISCOVER_INTERACTION_PATTERNS rows of the 'tdURI'
+        Thing Description
+        """
+        try:
+            return self._get("DISCOVER_INTERACTION_PATTERNS", "td", tdURI)
+        except KeyError:
+            return []
+
+    def resolve(self, ipURI):
+        """
+        Returns the Thing Description and the Thing of 'ipURI', as a
+        (td, thing) tuple of formatted uris.
+        """
+        td = uriFormat(self.interaction_pattern(ipURI)["td"]["value"])
+        return td, self.thing_of_td(td)
+
+    def action(self, actionURI):
+        """
+        Returns the DESCRIBE_ACTION row of 'actionURI'
+        """
+        return self._get("DESCRIBE_ACTION", "action", actionURI)[0]
+
+    def event(self, eventURI):
+        """
+        Returns the DESCRIBE_EVENT row of 'eventURI'
+        """
+        return self._get("DESCRIBE_EVENT", "event", eventURI)[0]
+
+    def dataschema(self, dsURI):
+        """
+        Returns the GET_DATASCHEMAS rows of 'dsURI'
+        """
+        return self._get("GET_DATASCHEMAS", "ds", dsURI)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  scheduling.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition, Lock
+from time import monotonic
+from itertools import count
+
+import heapq
+import logging
+
+logger = logging.getLogger("cocktail_log")
+_timer_queue = None
+_timer_queue_lock = Lock()
+_worker_pool = None
+_worker_pool_lock = Lock()
+
+
+class Timer:
+    """
+    A callback scheduled in a TimerQueue
+    """
+    __slots__ = ("deadline", "callback")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+
+    def cancel(self):
+        self.callback = None
+
+    @property
+    def cancelled(self):
+        return self.callback is None
+
+
+class TimerQueue(Thread):
+    """
+    A single thread running the callbacks scheduled with 'schedule' when
+    their delay expires, so that many timeouts do not need a thread, nor
+    a threading.Timer, each. Callbacks run on this thread one at a time,
+    so they should be short: requests to the broker are scheduled with
+    'scheduleWork' instead.
+    """
+    def __init__(self):
+        Thread.__init__(self, name="cocktail-timers")
+        self.daemon = True
+        self._condition = Condition()
+        self._heap = []
+        self._sequence = count()
+
+    def schedule(self, delay, callback):
+        """
+        Runs 'callback()' after 'delay' seconds. Returns the Timer, which
+        can be cancelled.
+        """
+        timer = Timer(monotonic()+delay, callback)
+        with self._condition:
+            heapq.heappush(self._heap, (timer.deadline, next(self._sequence), timer))
+            if self._heap[0][2] is timer:
+                self._condition.notify()
+        return timer
+
+    def __len__(self):
+        return len(self._heap)
+
+    def run(self):
+        while True:
+            with self._condition:
+                while (not self._heap) or (self._heap[0][0] > monotonic()):
+                    self._condition.wait(
+                        self._heap[0][0]-monotonic() if self._heap else None)
+                deadline, sequence, timer = heapq.heappop(self._heap)
+            callback = timer.callback
+            if callback is not None:
+                timer.cancel()
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error("Timer callback failed: {}".format(e))
+
+
+def timerQueue():
+    """
+    Returns the TimerQueue of the process, starting it at the first call
+    """
+    global _timer_queue
+    with _timer_queue_lock:
+        if _timer_queue is None:
+            _timer_queue = TimerQueue()
+            _timer_queue.start()
+        return _timer_queue
+
+
+def workerPool():
+    """
+    Returns the ThreadPoolExecutor running the callbacks scheduled with
+    'scheduleWork', starting it at the first call
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cocktail-workers")
+        return _worker_pool
+
+
+def _run(callback):
+    try:
+        callback()
+    except Exception as e:
+        logger.error("Scheduled work failed: {}".format(e))
+
+
+def scheduleWork(delay, callback):
+    """
+    Runs 'callback()' on the worker pool after 'delay' seconds, so that
+    a blocking callback does not delay the other timers. Returns the
+    Timer, which can be cancelled until the delay expires.
+    """
+    return timerQueue().schedule(delay, lambda: workerPool().submit(_run, callback))
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  streaming.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+#  Incremental parsing of sparql json results.
+#  The document is walked key by key, and the rows of
+#  ["results"]["bindings"] are decoded one at a time while the response
+#  is read, so that neither the whole body nor the whole list of
+#  bindings has to be kept in memory.
+
+from collections import deque
+from codecs import getincrementaldecoder
+from json import JSONDecoder
+
+import logging
+
+logger = logging.getLogger("cocktail_log")
+_decoder = JSONDecoder()
+_WHITESPACE = " \t\r\n"
+
+
+class _Reader:
+    """
+    Buffer of the text of a stream, read in chunks of 'chunk_size'
+    """
+    def __init__(self, stream, chunk_size):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._utf8 = getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self._stream.read(self._chunk_size)
+        if not chunk:
+            self.eof = True
+        if isinstance(chunk, bytes):
+            chunk = self._utf8.decode(chunk, final=self.eof)
+        # the text already parsed is dropped
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """
+        Skips the whitespace, returning the next character ("" at the end)
+        """
+        while True:
+            while (self.pos < len(self.text)) and (self.text[self.pos] in _WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def expect(self, character):
+        found = self.peek()
+        if found != character:
+            raise ValueError("Expected {!r} in sparql json result, found {!r}".format(
+                character, found))
+        self.pos += 1
+
+    def skip(self, character):
+        if self.peek() == character:
+            self.pos += 1
+
+    def value(self):
+        """
+        Decodes the next json value, reading until it is complete
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # a number at the end of the buffer may continue
+                if (end < len(self.text)) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+class StreamedResult:
+    """
+    A sparql json result parsed while it is read from 'stream' (a binary
+    or text file-like object, such as an http response). It can be used
+    where a query result is expected, as long as its bindings are
+    iterated only once:
+
+        for binding in result["results"]["bindings"]:
+            ...
+
+    and only one row at a time is decoded. Reading result["head"], when
+    the server sends it after the bindings, buffers the rows meanwhile.
+    'on_close', if given, is called with True when the whole document
+    has been parsed, or with False when the result is closed before.
+    """
+    def __init__(self, stream, chunk_size=65536, on_close=None):
+        self._reader = _Reader(stream, chunk_size)
+        self._on_close = on_close
+        self._document = {}
+        self._pending = deque()
+        self._rows = self._parse()
+        self._finished = False
+        self._closed = False
+
+    def _parse(self):
+        reader = self._reader
+        reader.expect("{")
+        while reader.peek() != "}":
+            key = reader.value()
+            reader.expect(":")
+            if key == "results":
+                yield from self._parseResults()
+            else:
+                self._document[key] = reader.value()
+                if key == "error":
+                    self.close()
+                    message = self._document[key]
+                    if isinstance(message, dict):
+                        message = message.get("message", message)
+                    logger.error(message)
+                    raise ValueError(message)
+            reader.skip(",")
+        reader.expect("}")
+        self._finished = True
+        self.close()
+
+    def _parseResults(self):
+        reader = self._reader
+        results = self._document.setdefault("results", {})
+        reader.expect("{")
+        while reader.peek() != "}":
+            key = reader.value()
+            reader.expect(":")
+            if key == "bindings":
+                reader.expect("[")
+                while reader.peek() != "]":
+                    yield reader.value()
+                    reader.skip(",")
+                reader.expect("]")
+            else:
+                results[key] = reader.value()
+            reader.skip(",")
+        reader.expect("}")
+
+    def _advance(self, key):
+        # reads the rows until the top level 'key' is found
+        while (key not in self._document) and not self._finished:
+            try:
+                self._pending.append(next(self._rows))
+            except StopIteration:
+                break
+
+    @property
+    def head(self):
+        self._advance("head")
+        return self._document.get("head", {"vars": []})
+
+    @property
+    def variables(self):
+        return self.head.get("vars", [])
+
+    def __getitem__(self, key):
+        if key == "head":
+            return self.head
+        if key == "results":
+            return {"bindings": self}
+        self._advance(key)
+        return self._document[key]
+
+    def __iter__(self):
+        """
+        Yields the bindings not read yet
+        """
+        while self._pending:
+            yield self._pending.popleft()
+        yield from self._rows
+
+    def toQuery(self):
+        """
+        Reads the rest of the result, returning it as a json dictionary
+        """
+        bindings = list(self)
+        document = dict(self._document)
+        document["results"] = dict(document.get("results", {}), bindings=bindings)
+        return document
+
+    def close(self):
+        """
+        Stops reading the stream; the rows not read yet are lost
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if not self._finished:
+            self._pending.clear()
+            self._rows = iter(())
+        if self._on_close is not None:
+            self._on_close(self._finished)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def streamQuery(sepa, sparql):
+    """
+    Sends the 'sparql' query, returning a StreamedResult if 'sepa' can
+    stream its responses (see async_engine.PooledSEPA), or the parsed
+    result otherwise. Both can be read as a query result.
+    """
+    if hasattr(sepa, "sparql_query_stream"):
+        return sepa.sparql_query_stream(sparql)
+    return sepa.sparql_query(sparql)
+
+
+def closeResult(result):
+    """
+    Closes 'result' if it is a StreamedResult, so that its connection is
+    released even if its bindings have not been all read.
+    """
+    if isinstance(result, StreamedResult):
+        result.close()
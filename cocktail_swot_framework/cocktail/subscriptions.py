@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  subscriptions.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from itertools import count
+from threading import RLock, Lock
+from weakref import WeakKeyDictionary, proxy
+from .utils import canonical_binding
+from .templates import getTemplate
+
+import logging
+
+logger = logging.getLogger("cocktail_log")
+_managers = WeakKeyDictionary()
+_managers_lock = Lock()
+
+
+def getSubscriptionManager(sepa):
+    """
+    Returns the SubscriptionManager shared by the users of 'sepa'. It
+    refers to 'sepa' weakly, so that both are collected once 'sepa' is
+    no longer used.
+    """
+    with _managers_lock:
+        if sepa not in _managers:
+            _managers[sepa] = SubscriptionManager(proxy(sepa))
+        return _managers[sepa]
+
+
+class SharedSubscription:
+    """
+    A broker subscription, with its local handlers and current results
+    """
+    def __init__(self, identifier, forcedBindings):
+        self.identifier = identifier
+        self.forcedBindings = dict(forcedBindings)
+        self.subid = None
+        self.closed = False
+        self.listeners = set()
+        self.handlers = {}
+        self.rows = {}
+        self.lock = RLock()
+
+    def notify(self, added, removed):
+        with self.lock:
+            for binding in removed:
+                self.rows.pop(canonical_binding(binding), None)
+            for binding in added:
+                self.rows[canonical_binding(binding)] = binding
+            # handlers are called one after the other, and never while
+            # a new one receives the current results
+            for handler in list(self.handlers.values()):
+                self.call(handler, added, removed)
+
+    def call(self, handler, added, removed):
+        try:
+            handler(added, removed)
+        except Exception as e:
+            logger.error("{} handler failed: {}".format(self.identifier, e))
+
+
+class SubscriptionManager:
+    """
+    Shares the broker subscriptions among the local handlers subscribing
+    to the same sap entry with equivalent forced bindings: the first one
+    opens the subscription, the last one leaving closes it, and the
+    notifications are fanned out to all of them. A handler joining an
+    open subscription receives its current results at once, as the
+    first notification of its own subscription would be.
+    It has the subscribe/unsubscribe methods of sepy's SEPA, so that it
+    can be given to Event.observe and Action.enable as 'manager'.
+    """
+    def __init__(self, sepa):
+        self._sepa = sepa
+        self._lock = Lock()
+        self._shared = {}
+        self._listeners = {}
+        self._ids = count()
+
+    def key(self, identifier, forcedBindings):
+        """
+        Subscriptions are shared when they render the same sparql, so
+        that bindings not used by the sap entry, or uris given with and
+        without angle brackets, do not matter
+        """
+        return getTemplate(self._sepa.sap, identifier, sparqlSet="queries").render(forcedBindings)
+
+    def subscribe(self, identifier, alias, forcedBindings={}, handler=None):
+        """
+        Adds 'handler' to the 'identifier' subscription with
+        'forcedBindings', opening it with 'alias' if needed. Returns the
+        id of the local subscription, to be given to 'unsubscribe'.
+        """
+        key = self.key(identifier, forcedBindings)
+        with self._lock:
+            listener = "{}#{}".format(alias, next(self._ids))
+            shared = self._shared.get(key)
+            opened = shared is None
+            if opened:
+                shared = self._shared[key] = SharedSubscription(identifier, forcedBindings)
+            shared.listeners.add(listener)
+            self._listeners[listener] = key
+        # handlers may subscribe in turn: the lock of the manager is not
+        # held while waiting for the one of the subscription
+        with shared.lock:
+            shared.handlers[listener] = handler
+            if not opened:
+                shared.call(handler, list(shared.rows.values()), [])
+        if opened:
+            try:
+                subid = self._sepa.subscribe(
+                    identifier, alias, forcedBindings=forcedBindings, handler=shared.notify)
+            except Exception:
+                self.unsubscribe(listener)
+                raise
+            with self._lock:
+                shared.subid = subid
+                closed = shared.closed
+            if closed:
+                self._sepa.unsubscribe(subid)
+            else:
+                logger.debug("Opened shared subscription {}".format(subid))
+        return listener
+
+    def unsubscribe(self, subid):
+        """
+        Removes the handler of the local 'subid' subscription, closing
+        the broker subscription if it was the last one.
+        """
+        with self._lock:
+            key = self._listeners.pop(subid, None)
+            if key is None:
+                logger.warning("Unknown subscription {}".format(subid))
+                return
+            shared = self._shared[key]
+            shared.listeners.discard(subid)
+            closing = shared.closed = not shared.listeners
+            if closing:
+                del self._shared[key]
+            broker_subid = shared.subid
+        with shared.lock:
+            shared.handlers.pop(subid, None)
+        if closing and (broker_subid is not None):
+            self._sepa.unsubscribe(broker_subid)
+            logger.debug("Closed shared subscription {}".format(broker_subid))
+
+    def listeners(self, identifier, forcedBindings={}):
+        """
+        Number of local handlers of the 'identifier' subscription
+        """
+        with self._lock:
+            shared = self._shared.get(self.key(identifier, forcedBindings))
+            return len(shared.listeners) if shared is not None else 0
+
+    def __len__(self):
+        """
+        Number of open broker subscriptions
+        """
+        return len(self._shared)
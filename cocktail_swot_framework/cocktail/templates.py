@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  templates.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from sepy.SAPObject import uriFormat
+from weakref import WeakKeyDictionary
+from threading import Lock
+from copy import deepcopy
+from .records import decodeRecords
+from .streaming import streamQuery, closeResult
+
+import logging
+
+logger = logging.getLogger("cocktail_log")
+_SLOT = "\x00"
+_templates = WeakKeyDictionary()
+_templates_lock = Lock()
+
+
+def escapeLiteral(value):
+    """
+    Escapes 'value' to be put within a single quoted sparql literal
+    """
+    return value.replace("\\", "\\\\").replace("'", "\\'").replace(
+        "\n", "\\n").replace("\r", "\\r")
+
+
+def formatBinding(binding_type, value, datatype=None):
+    """
+    Formats 'value' as sepy does when substituting forced bindings,
+    escaping literals.
+    """
+    if (binding_type == "literal") and (value != "UNDEF"):
+        if datatype is not None:
+            return "'{}'^^{}".format(escapeLiteral(value), datatype)
+        return "'{}'".format(escapeLiteral(value))
+    return uriFormat(value)
+
+
+class SparqlTemplate:
+    """
+    A sap entry compiled once into fixed text segments and forced binding
+    slots. Rendering the sparql then costs a single join, instead of a
+    full string substitution for every binding.
+    """
+    def __init__(self, sparql, forcedBindings={}, namespaces=[]):
+        """
+        'sparql' and 'forcedBindings' are the fields of the sap entry,
+        'namespaces' the list of prefixes as given by
+        SAPObject.get_namespaces(stringList=True).
+        """
+        text = " ".join(namespaces) + " " + sparql
+        names = list(forcedBindings.keys())
+        # bindings are substituted in the same order sepy does, so that
+        # a binding whose name is the prefix of another behaves the same
+        for index, name in enumerate(names):
+            text = text.replace("?"+name, "{0}{1}{0}".format(_SLOT, index))
+        self._segments = text.split(_SLOT)
+        self._slots = [(position, names[int(self._segments[position])])
+                       for position in range(1, len(self._segments), 2)]
+        self._types = {}
+        self._defaults = {}
+        self._required = []
+        for name, binding in forcedBindings.items():
+            self._types[name] = (binding["type"], binding.get("datatype"))
+            value = binding["value"]
+            if value == "":
+                self._required.append(name)
+            self._defaults[name] = self._format(name, value)
+
+    def _format(self, name, value):
+        if value is None:
+            return "?"+name
+        binding_type, datatype = self._types[name]
+        return formatBinding(binding_type, value, datatype=datatype)
+
+    def render(self, forcedBindings={}, bindingCheck=True):
+        """
+        Returns the sparql with the 'forcedBindings' substituted. Bindings
+        not given take their default value from the sap entry.
+        As in sepy, a KeyError is raised if a required binding is missing
+        and 'bindingCheck' is True.
+        """
+        if bindingCheck:
+            for name in self._required:
+                if name not in forcedBindings:
+                    raise KeyError(name+" is a required forcedbinding")
+        values = {}
+        for name, value in forcedBindings.items():
+            if name in self._types:
+                values[name] = self._format(name, value)
+        segments = list(self._segments)
+        for position, name in self._slots:
+            segments[position] = values[name] if name in values else self._defaults[name]
+        return "".join(segments)
+
+    @property
+    def bindings(self):
+        return self._types.keys()
+
+
+def getTemplate(sap, identifier, sparqlSet="updates"):
+    """
+    Returns the SparqlTemplate of the 'identifier' entry of the 'sap'
+    object, within 'sparqlSet' ('updates' or 'queries'). Templates are
+    compiled at first use and kept as long as the sap object lives:
+    namespaces added to the sap afterwards are not seen by the templates
+    already compiled.
+    As sepy's getSparql writes the bindings it is given into the sap
+    entries, templates are compiled from copies of the entries taken at
+    the first use of the sap.
+    """
+    with _templates_lock:
+        if sap not in _templates:
+            _templates[sap] = ({}, {})
+        sapTemplates, entries = _templates[sap]
+        key = (sparqlSet, identifier)
+        if key not in sapTemplates:
+            if not entries:
+                for entrySet in ("queries", "updates"):
+                    entries.update(((entrySet, name), deepcopy(entry)) for name, entry in (
+                        sap.explore([entrySet]) or {}).items())
+            if key not in entries:
+                # added to the sap after its first use
+                entry = sap.explore([sparqlSet, identifier])
+                if entry is None:
+                    raise KeyError(identifier)
+                entries[key] = deepcopy(entry)
+            entry = entries[key]
+            sapTemplates[key] = SparqlTemplate(
+                entry["sparql"],
+                forcedBindings=entry.get("forcedBindings", {}),
+                namespaces=sap.get_namespaces(stringList=True))
+            logger.debug("Compiled template for {}".format(identifier))
+        return sapTemplates[key]
+
+
+def compiled_update(sepa, identifier, forcedBindings={}):
+    """
+    Equivalent to sepa.update(identifier, forcedBindings=forcedBindings),
+    using the compiled template of the sap entry.
+    """
+    return sepa.sparql_update(
+        getTemplate(sepa.sap, identifier).render(forcedBindings))
+
+
+def compiled_query(sepa, identifier, forcedBindings={}):
+    """
+    Equivalent to sepa.query(identifier, forcedBindings=forcedBindings),
+    using the compiled template of the sap entry.
+    """
+    return sepa.sparql_query(
+        getTemplate(sepa.sap, identifier, sparqlSet="queries").render(forcedBindings))
+
+
+def paged_query(sepa, identifier, forcedBindings={}, order_by=(), page_size=1000, records=False):
+    """
+    Generator of the bindings of the 'identifier' query, which is sent
+    in pages of 'page_size' results (with LIMIT and OFFSET), so that only
+    one page at a time is kept in memory. Results are sorted by the
+    'order_by' variables, which should be all the projected ones, so
+    that ties do not make pages unstable. If 'records' is True, rows are
+    yielded as records.Record objects instead of sparql json bindings.
+    Engines streaming their responses (see streaming.streamQuery) decode
+    a row at a time also within a page: in that case 'page_size' may be
+    None, to send a single query.
+    """
+    sparql = getTemplate(sepa.sap, identifier, sparqlSet="queries").render(forcedBindings)
+    if order_by:
+        sparql += "\norder by " + " ".join("?"+variable for variable in order_by)
+    offset = 0
+    while True:
+        if page_size is None:
+            result = streamQuery(sepa, sparql)
+        else:
+            result = streamQuery(sepa, "{}\nlimit {} offset {}".format(sparql, page_size, offset))
+        rows = decodeRecords(result) if records else result["results"]["bindings"]
+        count = 0
+        try:
+            for count, row in enumerate(rows, 1):
+                yield row
+        finally:
+            closeResult(result)
+        if (page_size is None) or (count < page_size):
+            return
+        offset += page_size
+
+
+def streamed_query(sepa, identifier, forcedBindings={}):
+    """
+    Sends the 'identifier' query, returning its result as
+    streaming.streamQuery does
+    """
+    return streamQuery(sepa, getTemplate(sepa.sap, identifier, sparqlSet="queries").render(forcedBindings))
@@ -23,19 +23,18 @@
 #  
 
 import unittest
-import yaml
 
 from pkg_resources import resource_filename
 
-from sepy.SEPA import SEPA
-from sepy.SAPObject import SAPObject
+from cocktail.tests import make_test_engine
+from cocktail.memory_engine import cocktail_sap
 
 from cocktail.Thing import Thing
 from cocktail.DataSchema import DataSchema
 from cocktail.Property import Property
 from cocktail.Action import *
 from cocktail.Event import *
-from cocktail.utils import generate_cocktail_sap, compare_queries
+from cocktail.utils import compare_queries
 
 ds_string = "<http://XSDstringDataSchema.org>"
 ds_integer = "<http://XSDintegerDataSchema.org>"
@@ -55,9 +54,8 @@ def read_all_file(filename):
 class TestCase1_Setup(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        sap_file = generate_cocktail_sap(None)
-        self.ysap = SAPObject(yaml.load(sap_file))
-        self.engine = SEPA(sapObject=self.ysap, logLevel=logging.ERROR)
+        self.ysap = cocktail_sap()
+        self.engine = make_test_engine(self.ysap, logging.ERROR)
         
     def setUp(self):
         self.engine.clear()
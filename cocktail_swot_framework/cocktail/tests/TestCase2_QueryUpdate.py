@@ -32,14 +32,17 @@ from cocktail.Property import Property
 from cocktail.Action import *
 from cocktail.Event import *
 from cocktail.utils import *
+from cocktail.subscriptions import SubscriptionManager
+from cocktail.registry import ThingRegistry
 from cocktail import __name__ as cName
 
-from sepy.SEPA import SEPA
-from sepy.SAPObject import SAPObject
+from cocktail.tests import make_test_engine
+from cocktail.memory_engine import cocktail_sap
 
 from pkg_resources import resource_filename
 from os.path import isfile, splitext
 from os import listdir
+from collections import Counter
 
 
 def read_all_file(filename):
@@ -67,9 +70,8 @@ def switch_handler(added_bindings, result_file, ignore=[]):
 class TestCase2_QueryUpdate(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        sap_file = generate_cocktail_sap(None)
-        self.ysap = SAPObject(yaml.load(sap_file))
-        self.engine = SEPA(sapObject=self.ysap, logLevel=logging.INFO)
+        self.ysap = cocktail_sap()
+        self.engine = make_test_engine(self.ysap, logging.INFO)
 
     def setUp(self):
         self.engine.clear()
@@ -502,6 +504,115 @@ class TestCase2_QueryUpdate(unittest.TestCase):
             event.deleteInstance(instance)
         self.test_0()
 
+    def test_8(self):
+        """
+        Paged discovery yields the same bindings of the plain discovery,
+        also when the page size splits the results.
+        """
+        discoveries = [
+            (Thing.discover, Thing.discover_iter),
+            (InteractionPattern.discover, InteractionPattern.discover_iter),
+            (Action.discover, Action.discover_iter),
+            (Event.discover, Event.discover_iter),
+            (Property.discover, Property.discover_iter),
+            (DataSchema.discover, DataSchema.discover_iter)]
+        for discover, discover_iter in discoveries:
+            expected = discover(self.engine)
+            for page_size in (2, 1000):
+                paged = {"head": expected["head"],
+                         "results": {"bindings": list(discover_iter(self.engine, page_size=page_size))}}
+                self.assertEqual(len(paged["results"]["bindings"]), len(expected["results"]["bindings"]))
+                self.assertTrue(compare_queries(expected, paged, show_diff=True))
+            records = [record.toBinding() for record in discover_iter(self.engine, page_size=2, records=True)]
+            self.assertEqual(records, list(discover_iter(self.engine, page_size=2)))
+
+    def test_9(self):
+        """
+        Observers of an event using a SubscriptionManager share a single
+        subscription, and a late observer receives the current instances.
+        """
+        manager = SubscriptionManager(self.engine)
+        eventURI = "<http://MyThirdWebThing.com/Event1>"
+        observers = [Event.buildFromQuery(self.engine, eventURI) for i in range(3)]
+        received = [[] for observer in observers]
+        subscriptions = len(self.engine.get_subscriptions())
+
+        def instance_bindings(n):
+            return {"thing": observers[0].thing, "event": eventURI,
+                    "newEInstance": eventURI.replace(">", "/instance{}>".format(n)),
+                    "newOData": eventURI.replace(">", "/instance{}/OutputData>".format(n)),
+                    "newValue": "2018-06-23T10:05:19.478Z",
+                    "newDS": "<http://XSDdateTimeStampDataSchema.org>"}
+        observers[0].observe(lambda added, removed: received[0].extend(added), manager=manager)
+        observers[1].observe(lambda added, removed: received[1].extend(added), manager=manager)
+        observers[0].notify(instance_bindings(1))
+        observers[2].observe(lambda added, removed: received[2].extend(added), manager=manager)
+        self.assertEqual(len(self.engine.get_subscriptions()), subscriptions+1)
+        self.assertEqual(manager.listeners("SUBSCRIBE_EVENT_INSTANCE", observers[0].bindings), 3)
+        observers[0].notify(instance_bindings(2))
+        self.assertEqual(len(received[0]), 2)
+        self.assertEqual(received[0], received[1])
+        self.assertEqual(received[0], received[2])
+
+        observers[0].stop_observing()
+        observers[1].stop_observing()
+        self.assertEqual(len(self.engine.get_subscriptions()), subscriptions+1)
+        observers[2].stop_observing()
+        self.assertEqual(len(self.engine.get_subscriptions()), subscriptions)
+        self.assertEqual(len(manager), 0)
+
+    def test_10(self):
+        """
+        Equivalent forced bindings share the subscription, even when they
+        include bindings unused by the sap entry
+        """
+        manager = SubscriptionManager(self.engine)
+        image = Action.buildFromQuery(self.engine, "<http://MyFirstWebThing.com/Action1>")
+        action = Action(self.engine, image.bindings, lambda added, removed: None)
+        subscriptions = len(self.engine.get_subscriptions())
+        action.enable(manager=manager)
+        monitor = manager.subscribe("SUBSCRIBE_ACTION_INSTANCE", "monitor",
+                                    forcedBindings={"action": "http://MyFirstWebThing.com/Action1",
+                                                    "thing": "http://MyFirstWebThing.com"},
+                                    handler=lambda added, removed: None)
+        self.assertEqual(len(self.engine.get_subscriptions()), subscriptions+1)
+        self.assertEqual(len(manager), 1)
+        action.disable()
+        manager.unsubscribe(monitor)
+        self.assertEqual(len(self.engine.get_subscriptions()), subscriptions)
+
+    def test_11(self):
+        """
+        A ThingRegistry indexes the Interaction Patterns by Thing
+        Description, and builds the same actions as the rdf store queries.
+        """
+        registry = ThingRegistry(self.engine).start()
+        actionURI = "<http://MyFirstWebThing.com/Action1>"
+        self.assertIn("http://MyFirstWebThing.com", registry.things())
+        td, thing = registry.resolve(actionURI)
+        self.assertEqual(thing, "<http://MyFirstWebThing.com>")
+        ipatterns = [row["ipattern"]["value"] for row in registry.interaction_patterns(td)]
+        self.assertIn("http://MyFirstWebThing.com/Action1", ipatterns)
+        self.assertEqual(registry.interaction_patterns("<http://Unknown.com/TD>"), [])
+        self.assertEqual(Action.buildFromQuery(self.engine, actionURI, registry=registry).bindings,
+                         Action.buildFromQuery(self.engine, actionURI).bindings)
+        registry.stop()
+
+    def test_12(self):
+        """
+        Paged discoveries give every row of the plain ones exactly once,
+        also when the results span many pages
+        """
+        for discover, discover_iter in [(DataSchema.discover, DataSchema.discover_iter),
+                                        (Action.discover, Action.discover_iter),
+                                        (Event.discover, Event.discover_iter),
+                                        (Thing.discover, Thing.discover_iter)]:
+            expected = discover(self.engine)["results"]["bindings"]
+            self.assertGreater(len(expected), 2)
+            paged = list(discover_iter(self.engine, page_size=2))
+            self.assertEqual(Counter(map(canonical_binding, paged)),
+                             Counter(map(canonical_binding, expected)))
+
 
 if __name__ == '__main__':
     unittest.main(failfast=True)
@@ -0,0 +1,900 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  TestCase3_Utils.py
+#
+#  Copyright 2018 Francesco Antoniazzi <francesco.antoniazzi@unibo.it>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import unittest
+
+from pkg_resources import resource_filename
+
+from cocktail.utils import compare_queries, diff_queries, load_json, batch_update
+from cocktail.utils import cocktail_sap_dict, cocktail_sap_content, generate_cocktail_sap, sparqlFoldersHash
+from cocktail import utils
+from cocktail.memory_engine import cocktail_sap
+from cocktail.templates import SparqlTemplate, getTemplate
+from cocktail.instances import InstanceURIGenerator
+from cocktail.cocktail_jld import jldFileBuilder, sameJsonLD, JLDServer, JLDPayload, acceptsGzip, shared_jld_server
+from cocktail.Thing import Thing, json_ld_frame
+from cocktail.tracker import RequestTracker, getTracker
+from cocktail.subscriptions import getSubscriptionManager
+from cocktail.async_engine import AsyncSEPA, PooledSEPA
+from cocktail.dispatcher import Dispatcher, instanceKey
+from cocktail.Property import Property
+from cocktail.Event import Event as CocktailEvent
+from cocktail.Action import Action
+from cocktail.records import decodeRecords, ColumnarResult
+from cocktail.streaming import StreamedResult
+from cocktail.registry import LiveResultSet
+from cocktail.tests import make_test_engine
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.client import HTTPConnection
+from threading import Thread, Event, Lock, current_thread
+from io import BytesIO
+from email.utils import formatdate
+
+import asyncio
+import logging
+import time
+import weakref
+import gc
+import os
+import tempfile
+import yaml
+
+import json
+
+THING_1 = "<http://MyFirstWebThing.com>"
+ACTION_2 = "<http://MyFirstWebThing.com/Action2>"
+EVENT_1 = "<http://MyFirstWebThing.com/Event1>"
+
+
+def uri(value):
+    return {"type": "uri", "value": value}
+
+
+def literal(value):
+    return {"type": "literal", "value": value}
+
+
+def query_result(bindings):
+    return {"head": {"vars": ["a", "b"]}, "results": {"bindings": bindings}}
+
+
+def row(instance, **variables):
+    variables["aInstance"] = uri(instance)
+    return variables
+
+
+def property_bindings(value, stability="100"):
+    return {"property": "http://prop", "newName": "temperature", "newStability": stability,
+            "newWritability": "false", "newValue": value, "newDS": "http://ds"}
+
+
+def cocktail_engine(*resources):
+    """
+    A test engine on the cocktail sap, with the 'resources' sparql
+    files of the tests inserted
+    """
+    engine = make_test_engine(cocktail_sap(), logging.ERROR)
+    engine.clear()
+    for resource in resources:
+        with open(resource_filename(__name__, resource), "r") as sparql:
+            engine.sparql_update(sparql.read())
+    return engine
+
+
+class JSONBroker:
+    """
+    A http server answering every request with the json 'result', that
+    can be given as 'sepa' to the engines of async_engine. Connections
+    and request bodies received are recorded.
+    """
+    def __init__(self, result=None):
+        self.httpd = HTTPServer(("localhost", 0), JSONHandler)
+        self.httpd.connections = set()
+        self.httpd.received = []
+        self.httpd.result = result if result is not None else query_result([])
+        self.sap = self
+        self.query_url = "http://localhost:{}/query".format(self.httpd.server_port)
+        self.update_url = "http://localhost:{}/update".format(self.httpd.server_port)
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    @property
+    def received(self):
+        return self.httpd.received
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        self.server.received.append(self.rfile.read(int(self.headers["Content-Length"])))
+        content = json.dumps(self.server.result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RecordingProperty(Property):
+    def __init__(self, bindings):
+        super().__init__(None, bindings)
+        self.posted = []
+        self.threads = []
+
+    def post(self):
+        self.posted.append(dict(self._bindings))
+        self.threads.append(current_thread().name)
+        return self
+
+
+class RecordingDispatcher(Dispatcher):
+    def wrap(self, handler, **kwargs):
+        self.kwargs = kwargs
+        return super().wrap(handler, **kwargs)
+
+
+class TestCase3_Utils(unittest.TestCase):
+    """
+    These tests do not need a running SEPA instance.
+    """
+    def test_0(self):
+        """
+        The indexed comparison gives the same answer of the plain one
+        on the reference results.
+        """
+        res_query_all = resource_filename(__name__, "res_query_all.json")
+        self.assertTrue(compare_queries(res_query_all, res_query_all))
+        self.assertTrue(compare_queries(
+            res_query_all, res_query_all, indexed=True))
+
+        shorter = load_json(res_query_all)
+        removed = shorter["results"]["bindings"].pop()
+        self.assertFalse(compare_queries(res_query_all, shorter))
+        diff = compare_queries(res_query_all, shorter, indexed=True)
+        self.assertFalse(diff)
+        self.assertEqual(diff.missing_in_b, [removed])
+        self.assertEqual(diff.missing_in_a, [])
+
+    def test_1(self):
+        """
+        Bnodes are skipped, ignored values are compared by type only, and
+        duplicated bindings are counted.
+        """
+        jA = query_result([
+            {"a": uri("http://a"), "b": {"type": "bnode", "value": "b0"}},
+            {"a": uri("http://a"), "b": literal("x")},
+            {"a": uri("http://a"), "b": literal("x")}])
+        jB = query_result([
+            {"a": uri("http://a"), "b": {"type": "bnode", "value": "b1"}},
+            {"a": uri("http://a"), "b": literal("y")}])
+        diff = diff_queries(jA, jB, ignore_val=["b"])
+        self.assertEqual(diff.counts, {"A": 3, "B": 2,
+                                       "missing_in_A": 0, "missing_in_B": 1})
+        self.assertEqual(diff.missing_in_b, [jA["results"]["bindings"][2]])
+        jB["results"]["bindings"].append({"a": uri("http://a"), "b": literal("z")})
+        self.assertTrue(diff_queries(jA, jB, ignore_val=["b"]))
+        self.assertFalse(diff_queries(jA, jB))
+
+    def test_2(self):
+        """Different variables are reported when strictVars is set"""
+        jA = query_result([])
+        jB = {"head": {"vars": ["a"]}, "results": {"bindings": []}}
+        self.assertFalse(compare_queries(jA, jB, indexed=True))
+        self.assertTrue(compare_queries(jA, jB, strictVars=False, indexed=True))
+
+    def test_3(self):
+        """A rejected batch is split until the broker accepts it"""
+        class SmallBroker:
+            def __init__(self):
+                self.received = []
+
+            def sparql_update(self, sparql):
+                if sparql.count(";") > 1:
+                    raise ValueError("Too large")
+                self.received.append(sparql)
+        broker = SmallBroker()
+        sparqls = ["insert data {{<http://{}> <http://p> 1}}".format(i) for i in range(6)]
+        self.assertEqual(batch_update(broker, sparqls[:3]), 2)
+        self.assertEqual(batch_update(broker, sparqls[:2]), 1)
+        self.assertEqual(" ;\n".join(broker.received), " ;\n".join(sparqls[:3]+sparqls[:2]))
+        self.assertEqual(batch_update(broker, sparqls), 4)
+        self.assertEqual(batch_update(broker, []), 0)
+
+        engine = cocktail_engine()
+        requests = engine.requests
+        self.assertEqual(batch_update(engine, sparqls), 1)
+        self.assertEqual(engine.requests, requests+1)
+        self.assertEqual(len(engine.query_all()["results"]["bindings"]), 6)
+
+    def test_4(self):
+        """The compiled sap cache is rebuilt when corrupt or outdated"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            expected = cocktail_sap_dict(cache_dir=None)
+            self.assertEqual(cocktail_sap_dict(cache_dir=cache_dir), expected)
+            cache_files = os.listdir(cache_dir)
+            self.assertEqual(len(cache_files), 1)
+            with open(os.path.join(cache_dir, cache_files[0]), "w") as cached:
+                cached.write('{"queries": {')
+            utils._compiled_sap.pop(cache_dir)
+            self.assertEqual(cocktail_sap_dict(cache_dir=cache_dir), expected)
+            with open(os.path.join(cache_dir, cache_files[0])) as cached:
+                self.assertEqual(json.load(cached), expected)
+            utils._compiled_sap.pop(cache_dir)
+
+            # a cache folder that cannot be created is not used
+            unwritable = os.path.join(cache_dir, cache_files[0], "cocktail")
+            self.assertEqual(cocktail_sap_dict(cache_dir=unwritable), expected)
+            utils._compiled_sap.pop(unwritable)
+
+        with tempfile.TemporaryDirectory() as sap_dir:
+            queries, updates = os.path.join(sap_dir, "queries"), os.path.join(sap_dir, "updates")
+            os.makedirs(queries)
+            os.makedirs(updates)
+            with open(os.path.join(queries, "entry.sparql"), "w") as entry:
+                entry.write("ENTRY:\n    sparql: select * where {?a ?b ?c}\n")
+            before = sparqlFoldersHash([queries, updates])
+            os.rename(os.path.join(queries, "entry.sparql"), os.path.join(updates, "entry.sparql"))
+            self.assertNotEqual(sparqlFoldersHash([queries, updates]), before)
+
+    def test_5(self):
+        """The sap built from the compiled dictionary is the generated one"""
+        generated = yaml.load(generate_cocktail_sap(None), Loader=yaml.SafeLoader)
+        content = cocktail_sap_content()
+        for sparqlSet in ("queries", "updates"):
+            self.assertEqual(set(content[sparqlSet]), set(generated[sparqlSet]))
+            for identifier, entry in generated[sparqlSet].items():
+                self.assertEqual(content[sparqlSet][identifier]["sparql"].split(), entry["sparql"].split())
+                self.assertEqual(content[sparqlSet][identifier].get("forcedBindings"),
+                                 entry.get("forcedBindings"))
+            del content[sparqlSet], generated[sparqlSet]
+        self.assertEqual(content, generated)
+
+    def test_6(self):
+        """Instance uris are generated in the expanded namespace of prefixed uris"""
+        namespaces = cocktail_sap().get_namespaces()
+        request, = next(InstanceURIGenerator("swot:MyAction", kinds=("Request",), namespaces=namespaces))
+        self.assertTrue(request.startswith(
+            "<http://wot.arces.unibo.it/ontology/web_of_things#MyAction/Request_"))
+        instance, data = next(InstanceURIGenerator("<http://event>"))
+        self.assertTrue(instance.startswith("<http://event/Instance_"))
+        self.assertTrue(data.startswith("<http://event/Data_"))
+        for namespace in ("unknown:MyAction", "MyAction", "<MyAction>"):
+            with self.assertRaises(ValueError):
+                InstanceURIGenerator(namespace, namespaces={})
+
+
+class TestCase3_Templates(unittest.TestCase):
+    def test_0(self):
+        """Compiled templates substitute bindings as sepy does"""
+        template = SparqlTemplate(
+            "insert {?event ex:value ?newValue} where {?event ex:other ?opt}",
+            forcedBindings={"event": {"type": "uri", "value": ""},
+                            "newValue": {"type": "literal", "value": ""},
+                            "opt": {"type": "uri", "value": "UNDEF"}},
+            namespaces=["PREFIX ex: <http://ex#>"])
+        self.assertEqual(
+            template.render({"event": "<http://e>", "newValue": "it's"}),
+            "PREFIX ex: <http://ex#> insert {<http://e> ex:value 'it\\'s'} "
+            "where {<http://e> ex:other UNDEF}")
+        self.assertEqual(
+            template.render({"event": "http://e", "newValue": "v", "opt": None}),
+            "PREFIX ex: <http://ex#> insert {<http://e> ex:value 'v'} "
+            "where {<http://e> ex:other ?opt}")
+        with self.assertRaises(KeyError):
+            template.render({"event": "<http://e>"})
+
+    def test_1(self):
+        """Posted literals are escaped, and the sap entries are left as they are"""
+        engine = cocktail_engine()
+        entry = json.dumps(engine.sap.explore(["updates", "NEW_THING"]))
+        things = [Thing(engine, {"thing": "<http://thing{}>".format(n), "newName": "Thing's {}".format(n),
+                                 "newTD": "<http://td{}>".format(n)}, superthing=THING_1)
+                  for n in range(2)]
+        things[0].post()
+        things[1].post(batch=True)
+        names = sorted(b["name"]["value"] for b in Thing.discover(engine)["results"]["bindings"])
+        self.assertEqual(names, ["Thing's 0", "Thing's 1"])
+        self.assertEqual(json.dumps(engine.sap.explore(["updates", "NEW_THING"])), entry)
+
+        # sepy writes the bindings into the sap, templates compiled later do not see them
+        engine.sap.getUpdate("DELETE_THING", forcedBindings={"thing": THING_1})
+        self.assertNotIn(THING_1, getTemplate(engine.sap, "DELETE_THING").render({}))
+
+
+class TestCase3_JsonLD(unittest.TestCase):
+    def test_0(self):
+        """Native framing gives the same graph of rdflib and pyld"""
+        construct = load_json(resource_filename(__name__, "res_jsonld-td-construct.json"))
+        native = json.loads(jldFileBuilder(construct, frame=json_ld_frame))
+        reference = json.loads(jldFileBuilder(construct, frame=json_ld_frame, native=False))
+        self.assertEqual(len(native["@graph"]), len(reference["@graph"]))
+        self.assertTrue(sameJsonLD(native, reference))
+
+        construct["results"]["bindings"] = [
+            binding for binding in construct["results"]["bindings"]
+            if binding["subject"]["value"] == "http://MyFirstWebThing.com"]
+        native = json.loads(jldFileBuilder(construct, frame=json_ld_frame))
+        self.assertEqual(native["@id"], "http://MyFirstWebThing.com")
+        self.assertIsNone(native["swot:hasThingDescription"])
+        self.assertTrue(sameJsonLD(
+            native, json.loads(jldFileBuilder(construct, frame=json_ld_frame, native=False))))
+
+    def test_1(self):
+        """Things with the same name get their own route on the shared server"""
+        engine = cocktail_engine("insert_dataschemas.sparql", "insert_thing_1.sparql",
+                                 "insert_thing_2.sparql")
+        things = [Thing(engine, {"thing": thing, "newName": "Twin"})
+                  for thing in (THING_1, "<http://MySecondWebThing.com>")]
+        paths = [thing.tdServer_start("localhost", 0, shared=True) for thing in things]
+        server = things[0]._TDserver
+        self.assertIs(server, things[1]._TDserver)
+        self.assertNotEqual(paths[0], paths[1])
+        things[0].tdServer_stop()
+        self.assertIsNone(server.payload_for(paths[0]))
+        self.assertEqual(json.loads(server.payload_for(paths[1]).content.decode("utf-8"))["@id"],
+                         "http://MySecondWebThing.com")
+        things[1].tdServer_stop()
+
+    def test_2(self):
+        """gzip and identity contents have their own ETag"""
+        self.assertTrue(acceptsGzip("deflate, gzip;q=0.5"))
+        self.assertFalse(acceptsGzip("gzip;q=0, identity"))
+        self.assertTrue(acceptsGzip("*"))
+        self.assertFalse(acceptsGzip("br, *;q=0"))
+
+        server = JLDServer("localhost", 0, '{"@id": "http://thing"}')
+        server.daemon = True
+        server.start()
+
+        def get(headers):
+            connection = HTTPConnection("localhost", server.httpd.server_port)
+            connection.request("GET", "/", headers=headers)
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            return response
+        try:
+            identity = get({})
+            gzipped = get({"Accept-Encoding": "gzip"})
+            refused = get({"Accept-Encoding": "gzip;q=0"})
+            revalidated = get({"Accept-Encoding": "gzip", "If-None-Match": gzipped.getheader("ETag")})
+            mismatched = get({"If-None-Match": gzipped.getheader("ETag")})
+        finally:
+            server.kill()
+        self.assertNotEqual(identity.getheader("ETag"), gzipped.getheader("ETag"))
+        self.assertEqual(gzipped.getheader("Content-Encoding"), "gzip")
+        self.assertIsNone(refused.getheader("Content-Encoding"))
+        self.assertEqual(revalidated.status, 304)
+        self.assertEqual(mismatched.status, 200)
+
+    def test_3(self):
+        """A stopped shared server is replaced, keeping its routes"""
+        engine = cocktail_engine("insert_dataschemas.sparql", "insert_thing_1.sparql")
+        thing = Thing(engine, {"thing": THING_1, "newName": "Restarted"})
+        path = thing.tdServer_start("localhost", 0, shared=True)
+        server = thing._TDserver
+        server.kill()
+        server.join(timeout=5)
+
+        replacement = shared_jld_server("localhost", 0)
+        self.assertIsNot(replacement, server)
+        self.assertEqual(server.httpd.socket.fileno(), -1)
+        self.assertIs(replacement.payload_for(path), server.routes[path])
+        connection = HTTPConnection("localhost", replacement.httpd.server_port)
+        connection.request("GET", path)
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(response.read().decode("utf-8"))["@id"], "http://MyFirstWebThing.com")
+        connection.close()
+
+        # the Thing still refers to the old server
+        thing.tdServer_stop()
+        self.assertIsNone(replacement.payload_for(path))
+
+    def test_4(self):
+        """If-Modified-Since does not hide a content set in the same second"""
+        previous = JLDPayload('{"@id": "http://thing"}')
+        payload = JLDPayload('{"@id": "http://other_thing"}')
+        self.assertFalse(payload.not_modified({"If-Modified-Since": previous.last_modified}))
+        later = formatdate(payload.timestamp+2, usegmt=True)
+        self.assertTrue(payload.not_modified({"If-Modified-Since": later}))
+        # If-None-Match takes precedence
+        self.assertFalse(payload.not_modified({"If-None-Match": previous.etag, "If-Modified-Since": later}))
+        self.assertTrue(payload.not_modified({"If-None-Match": payload.etag, "If-Modified-Since": "x"}))
+
+
+class TestCase3_Tracker(unittest.TestCase):
+    def setUp(self):
+        self.engine = cocktail_engine("insert_dataschemas.sparql", "insert_thing_1.sparql")
+        self.image = Action.buildFromQuery(self.engine, ACTION_2)
+        self.action = Action(self.engine, self.image.bindings,
+                             lambda added, removed: None).enable()
+
+    def tearDown(self):
+        self.action.disable()
+
+    def test_0(self):
+        """A single subscription routes the notifications of many requests"""
+        tracker = RequestTracker(self.engine)
+        subscriptions = len(self.engine.get_subscriptions())
+        confirmed = []
+        instance, first = self.image.newRequest(
+            dict(self.image.next_request_bindings("<http://me>")), tracker=tracker,
+            confirm_handler=lambda added, removed: confirmed.extend(added))
+        instance, second = self.image.newRequest(
+            dict(self.image.next_request_bindings("<http://me>")), tracker=tracker)
+        self.assertEqual(len(self.engine.get_subscriptions()), subscriptions+1)
+
+        self.action.post_confirmation(first.instance)
+        self.assertEqual(confirmed, [first.confirmation.result(timeout=5)])
+        self.assertFalse(first.done)
+        self.action.post_output(self.action.next_output_bindings(first.instance, "42"))
+        self.assertEqual(first.output.result(timeout=5)["oValue"]["value"], "42")
+        self.assertTrue(first.done)
+        self.assertNotIn(first.instance, tracker)
+
+        # a request removed before its completion
+        self.engine.sparql_update("delete where {{{} ?p ?o}}".format(second.instance))
+        self.assertTrue(second.completion.cancelled())
+        self.assertEqual(len(tracker), 0)
+        tracker.stop()
+        self.assertEqual(len(self.engine.get_subscriptions()), subscriptions)
+
+    def test_1(self):
+        """The steps never notified are cancelled when the request is completed"""
+        tracker = RequestTracker(self.engine)
+        instance, request = self.image.newRequest(
+            dict(self.image.next_request_bindings("<http://me>")), tracker=tracker)
+        self.action.post_completion(instance)
+        self.assertIn("ts", request.completion.result(timeout=5))
+        self.assertTrue(request.confirmation.cancelled())
+        self.assertTrue(request.output.cancelled())
+        self.assertEqual(len(tracker), 0)
+        tracker.stop()
+
+    def test_2(self):
+        """Asynchronous requests fail when the action completes without output"""
+        tracker = RequestTracker(self.engine)
+        bindings = dict(self.image.next_request_bindings("<http://me>"))
+        future = self.image.request_async(bindings, timeout=60, tracker=tracker)
+        self.action.post_completion(bindings["newAInstance"])
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+        self.assertEqual(len(tracker), 0)
+        tracker.stop()
+
+    def test_3(self):
+        """Requests not completed in time fail with TimeoutError"""
+        tracker = RequestTracker(self.engine)
+        late = self.image.request_async(
+            dict(self.image.next_request_bindings("<http://me>")), timeout=0.3, tracker=tracker)
+        bindings = dict(self.image.next_request_bindings("<http://me>"))
+        early = self.image.request_async(bindings, timeout=5, tracker=tracker)
+        self.action.post_output(self.action.next_output_bindings(bindings["newAInstance"], "1"))
+        self.assertEqual(early.result(timeout=5)["oValue"]["value"], "1")
+        with self.assertRaises(TimeoutError):
+            late.result(timeout=5)
+        self.assertEqual(len(tracker), 0)
+        tracker.stop()
+
+    def test_4(self):
+        """The shared tracker does not keep its engine alive"""
+        engine = cocktail_engine()
+        tracker = getTracker(engine)
+        self.assertIs(getTracker(engine), tracker)
+        tracker.track(self.image, "<http://MyFirstWebThing.com/Action2/Request>")
+        self.assertEqual(len(engine.get_subscriptions()), 1)
+        engine = weakref.ref(engine)
+        gc.collect()
+        self.assertIsNone(engine())
+
+
+class TestCase3_Subscriptions(unittest.TestCase):
+    def test_0(self):
+        """The shared subscription manager does not keep its engine alive"""
+        engine = cocktail_engine()
+        manager = getSubscriptionManager(engine)
+        self.assertIs(getSubscriptionManager(engine), manager)
+        manager.subscribe("DESCRIBE_ACTION", "actions", forcedBindings={"action_uri": "UNDEF"},
+                          handler=lambda added, removed: None)
+        self.assertEqual(len(engine.get_subscriptions()), 1)
+        engine = weakref.ref(engine)
+        gc.collect()
+        self.assertIsNone(engine())
+
+
+class TestCase3_Engines(unittest.TestCase):
+    def test_0(self):
+        """AsyncSEPA requests share keep-alive connections"""
+        broker = JSONBroker()
+
+        async def requests():
+            async with AsyncSEPA(broker, max_connections=1) as async_sepa:
+                results = [await async_sepa.sparql_query("select * where {?a ?b ?c}")
+                           for i in range(3)]
+                await async_sepa.sparql_update("delete where {?a ?b ?c}")
+            return results
+        try:
+            results = asyncio.run(requests())
+        finally:
+            broker.close()
+        self.assertEqual(results, [query_result([])]*3)
+        self.assertEqual(len(broker.received), 4)
+        self.assertEqual(len(broker.connections), 1)
+
+    def test_1(self):
+        """PooledSEPA streams the responses on keep-alive connections"""
+        construct = load_json(resource_filename(__name__, "res_jsonld-td-construct.json"))
+        broker = JSONBroker(construct)
+        engine = PooledSEPA(broker, max_connections=1)
+        try:
+            jld = jldFileBuilder(engine.sparql_query_stream("construct"), frame=json_ld_frame)
+            self.assertEqual(jld, jldFileBuilder(construct, frame=json_ld_frame))
+            self.assertEqual(engine.sparql_query_stream("construct").toQuery(), construct)
+        finally:
+            engine.close()
+            broker.close()
+        self.assertEqual(len(broker.received), 2)
+        self.assertEqual(len(broker.connections), 1)
+
+
+class TestCase3_Dispatcher(unittest.TestCase):
+    def test_0(self):
+        """The dispatcher limits concurrency, and keeps the order of each instance"""
+        dispatcher = Dispatcher(max_workers=4, max_pending=10)
+        lock = Lock()
+        running = {"now": 0, "max": 0}
+        handled = []
+        release = Event()
+
+        def slow_task(added, removed):
+            with lock:
+                running["now"] += 1
+                running["max"] = max(running["max"], running["now"])
+            release.wait(5)
+            with lock:
+                running["now"] -= 1
+                handled.append((added[0]["aInstance"]["value"], added[0]["n"]))
+        handler = dispatcher.wrap(slow_task, name="task", concurrency=2,
+                                  order_by=instanceKey("aInstance"))
+        for n in range(8):
+            handler([row("http://i{}".format(n % 2), n=n)], [])
+        self.assertEqual(dispatcher.metrics["handlers"]["task"], {"queued": 6, "running": 2})
+        release.set()
+        dispatcher.shutdown()
+
+        metrics = dispatcher.metrics
+        self.assertEqual((metrics["submitted"], metrics["completed"], metrics["pending"]), (8, 8, 0))
+        self.assertLessEqual(running["max"], 2)
+        for instance in ("http://i0", "http://i1"):
+            order = [n for i, n in handled if i == instance]
+            self.assertEqual(order, sorted(order))
+
+    def test_1(self):
+        """A full dispatcher drops notifications when not blocking"""
+        dispatcher = Dispatcher(max_workers=1, max_pending=1, block=False)
+        release = Event()
+        handler = dispatcher.wrap(lambda added, removed: release.wait(5))
+        handler([], [])
+        handler([], [])
+        release.set()
+        dispatcher.shutdown()
+        self.assertEqual(dispatcher.metrics["dropped"], 1)
+        self.assertEqual(dispatcher.metrics["completed"], 1)
+
+    def test_2(self):
+        """Dropping the queue gives back its slots"""
+        dispatcher = Dispatcher(max_workers=1, max_pending=3, block=False)
+        release = Event()
+        handler = dispatcher.wrap(lambda added, removed: release.wait(5), name="task",
+                                  concurrency=1)
+        for n in range(3):
+            handler([row("http://i{}".format(n))], [])
+        dispatcher.shutdown(wait=False)
+        release.set()
+        for _ in range(100):
+            if dispatcher.metrics["pending"] == 0:
+                break
+            time.sleep(0.02)
+        self.assertEqual(dispatcher.metrics["dropped"], 2)
+        self.assertEqual(dispatcher._slots._value, 3)
+
+    def test_3(self):
+        """A handler updating a synchronous engine does not wait for its own slot"""
+        engine = make_test_engine(cocktail_sap(), logging.ERROR)
+        dispatcher = Dispatcher(max_workers=1, max_pending=1)
+        delivered = Event()
+        updated = Event()
+
+        def handler(added, removed):
+            if added and not updated.is_set():
+                # the worker delivers the notifications of its own update
+                delivered.wait(5)
+                engine.sparql_update("insert data {<http://s> <http://p> <http://o2>}")
+                updated.set()
+        subid = engine.sparql_subscribe("select ?o where {<http://s> <http://p> ?o}", "test",
+                                        dispatcher.wrap(handler))
+        engine.sparql_update("insert data {<http://s> <http://p> <http://o1>}")
+        delivered.set()
+        self.assertTrue(updated.wait(5))
+        dispatcher.shutdown()
+        engine.unsubscribe(subid)
+        self.assertEqual(dispatcher.metrics["dropped"], 1)
+        self.assertEqual(dispatcher.metrics["completed"], 2)
+
+
+class TestCase3_Property(unittest.TestCase):
+    def test_0(self):
+        """Coalesced property updates write only the latest value, above threshold"""
+        prop = RecordingProperty(property_bindings("20")).coalesce(window=10, threshold=0.5)
+        for value in ("20.1", "20.3", "21", "22"):
+            prop.update(property_bindings(value))
+        self.assertEqual(prop.posted, [])
+        prop.flush()
+        self.assertEqual([b["newValue"] for b in prop.posted], ["22"])
+        prop.update(property_bindings("22.2"))
+        prop.flush()
+        self.assertEqual(len(prop.posted), 1)
+        prop.update(property_bindings("22.2", stability="200"))
+        prop.flush()
+        self.assertEqual(len(prop.posted), 2)
+
+        prop.stop_coalescing()
+        prop.update(property_bindings("22.3"))
+        self.assertEqual(len(prop.posted), 3)
+
+        # the window defaults to the stability, in milliseconds
+        prop = RecordingProperty(property_bindings("1", stability="20")).coalesce()
+        prop.update(property_bindings("2"))
+        prop.update(property_bindings("3"))
+        for _ in range(100):
+            if prop.posted:
+                break
+            time.sleep(0.02)
+        self.assertEqual([b["newValue"] for b in prop.posted], ["3"])
+        # the timer thread only hands the write to a worker
+        self.assertTrue(prop.threads[0].startswith("cocktail-workers"))
+        prop.stop_coalescing()
+
+
+class TestCase3_Event(unittest.TestCase):
+    def setUp(self):
+        self.engine = cocktail_engine("insert_dataschemas.sparql", "insert_thing_1.sparql")
+        self.event = CocktailEvent.buildFromQuery(self.engine, EVENT_1)
+
+    def tearDown(self):
+        self.event.stop_retaining()
+
+    def samples(self, count):
+        return [dict(self.event.next_instance_bindings(str(n))) for n in range(count)]
+
+    def instances(self):
+        return [b["eInstance"]["value"] for b in self.event.history()["results"]["bindings"]]
+
+    def test_0(self):
+        """Event samples are notified in bulk, keeping by default only the latest"""
+        requests = self.engine.requests
+        samples = self.samples(3)
+        self.assertEqual(self.event.notify_many(samples), [samples[2]["newEInstance"]])
+        self.assertEqual(self.engine.requests, requests+1)
+        self.assertEqual(self.instances(), [samples[2]["newEInstance"][1:-1]])
+        samples = self.samples(3)
+        self.event.notify_many(samples, latest_only=False)
+        self.assertEqual(self.instances(), [samples[2]["newEInstance"][1:-1]])
+
+        requests = self.engine.requests
+        with self.event.buffered(max_samples=4, max_delay=10) as buffer:
+            for sample in self.samples(10):
+                buffer.notify(sample)
+            self.assertEqual(len(buffer), 2)
+        self.assertEqual(self.engine.requests-requests, 3)
+        self.assertEqual((buffer.notified, buffer.requests), (10, 3))
+        self.assertEqual(self.instances(), [sample["newEInstance"][1:-1]])
+
+        # buffers left open are not kept alive by the exit hook
+        buffer = weakref.ref(self.event.buffered())
+        gc.collect()
+        self.assertIsNone(buffer())
+
+    def test_1(self):
+        """Instance uris are generated in the namespace of the interaction pattern"""
+        event = CocktailEvent(None, {"event": "<http://event>", "ods": "<http://ds>"})
+        first = dict(event.next_instance_bindings("1"))
+        second = event.next_instance_bindings("2")
+        self.assertEqual(set(second), {"event", "newEInstance", "newOData", "newValue", "newDS"})
+        self.assertEqual((second["event"], second["newDS"], second["newValue"]), ("<http://event>", "<http://ds>", "2"))
+        self.assertTrue(first["newEInstance"].startswith("<http://event/Instance_"))
+        self.assertTrue(first["newOData"].startswith("<http://event/Data_"))
+        self.assertNotEqual(first["newEInstance"], second["newEInstance"])
+        self.assertIs(event.next_instance_bindings(), second)
+
+        action = Action(None, {"action": "<http://action>", "ids": "<http://ds>"}, None)
+        request = action.next_request_bindings("<http://me>", "on")
+        self.assertEqual(set(request), {"action", "newAuthor", "newAInstance", "newIData", "newIValue", "newIDS"})
+        self.assertTrue(request["newAInstance"].startswith("<http://action/Request_"))
+        empty = Action(None, {"action": "<http://action>"}, None).next_request_bindings("<http://me>")
+        self.assertEqual(set(empty), {"action", "newAuthor", "newAInstance"})
+
+    def test_2(self):
+        """Compaction deletes the instances beyond the retention limits in one request"""
+        self.assertEqual(self.event.compact(), 0)
+        self.event.retain(count=3, compaction_interval=100)
+        samples = self.samples(5)
+        self.event.notify_many(samples)
+        self.assertEqual(len(self.instances()), 5)
+        requests = self.engine.requests
+        self.assertEqual(self.event.compact(), 2)
+        # the history query, and a single delete
+        self.assertEqual(self.engine.requests, requests+2)
+        self.assertEqual(sorted(self.instances()),
+                         sorted(sample["newEInstance"][1:-1] for sample in samples[2:]))
+        self.event.retain(count=3, seconds=3600, compaction_interval=100)
+        self.assertEqual(self.event.compact(), 0)
+        time.sleep(0.01)
+        self.event.retain(seconds=0, compaction_interval=100)
+        self.assertEqual(self.event.compact(), 3)
+        self.event.stop_retaining()
+        self.assertIsNone(self.event.retention)
+
+    def test_3(self):
+        """Retaining again while a compaction runs leaves a single compaction chain"""
+        class SlowEvent(CocktailEvent):
+            running = 0
+            overlapping = False
+
+            def compact(self):
+                SlowEvent.running += 1
+                SlowEvent.overlapping |= SlowEvent.running > 1
+                time.sleep(0.05)
+                SlowEvent.running -= 1
+                return 0
+        event = SlowEvent(self.engine, self.event.bindings)
+        event.retain(count=1, compaction_interval=0.01)
+        time.sleep(0.03)
+        event.stop_retaining()
+        event.retain(count=1, compaction_interval=0.01)
+        # the compaction running meanwhile is not interrupted, but it
+        # is the last of its chain
+        time.sleep(0.1)
+        SlowEvent.overlapping = False
+        time.sleep(0.3)
+        event.stop_retaining()
+        self.assertFalse(SlowEvent.overlapping)
+
+    def test_4(self):
+        """Notifications of all the instances of an event are ordered together"""
+        dispatcher = RecordingDispatcher(max_workers=1)
+        received = []
+        self.event.observe(lambda added, removed: received.extend(added), dispatcher=dispatcher)
+        order_by = dispatcher.kwargs["order_by"]
+        self.assertEqual(order_by([row("http://i0")], []), order_by([row("http://i1")], []))
+        self.event.notify(self.event.next_instance_bindings("1"))
+        self.event.stop_observing()
+        dispatcher.shutdown()
+        self.assertEqual(len(received), 1)
+
+
+class TestCase3_Records(unittest.TestCase):
+    def test_0(self):
+        """Records and columnar results keep every cell of a query result"""
+        result = {"head": {"vars": ["a", "b", "1st"]}, "results": {"bindings": [
+            {"a": uri("http://a0"), "b": literal("x"), "1st": {"type": "bnode", "value": "b0"}},
+            {"a": uri("http://a1"), "b": {"type": "literal", "value": "1", "datatype": "http://int"}},
+            {"a": uri("http://a2"), "b": {"type": "literal", "value": "ciao", "xml:lang": "it"}},
+            {"a": uri("http://a3"), "b": literal("y"), "1st": {"type": "bnode", "value": "b3"}}]}}
+        records = list(decodeRecords(result))
+        self.assertEqual([r.toBinding() for r in records], result["results"]["bindings"])
+        self.assertEqual((records[0].a, records[0]["b"], records[0]["1st"]), ("http://a0", "x", "b0"))
+        self.assertIsNone(records[1]["1st"])
+        self.assertEqual((records[1].type("b"), records[2].type("b")), ("http://int", "@it"))
+        self.assertIs(records[0]._types, records[3]._types)
+
+        # variables named as the methods of the records do not shadow them
+        reserved = ["type", "get", "toBinding", "variables", "fromBinding"]
+        shadowing = {"head": {"vars": reserved}, "results": {"bindings": [
+            {variable: literal(variable) for variable in reserved}]}}
+        record = next(decodeRecords(shadowing))
+        self.assertEqual(record.type("type"), "literal")
+        self.assertEqual([record[variable] for variable in reserved], reserved)
+        self.assertEqual(record, next(decodeRecords(shadowing)))
+        self.assertEqual(record.toBinding(), shadowing["results"]["bindings"][0])
+
+        columnar = ColumnarResult.fromQuery(result)
+        self.assertEqual(len(columnar), 4)
+        self.assertEqual(columnar.column("a"), ["http://a0", "http://a1", "http://a2", "http://a3"])
+        self.assertEqual(columnar.toQuery(), result)
+        self.assertEqual(list(columnar), records)
+
+
+class TestCase3_Streaming(unittest.TestCase):
+    def test_0(self):
+        """Streamed results are decoded a row at a time"""
+        rows = [{"a": uri("http://a{}".format(n)), "b": literal("caffè {}".format(n))}
+                for n in range(50)]
+        document = {"results": {"distinct": False, "bindings": rows}, "head": {"vars": ["a", "b"]}}
+        streamed = StreamedResult(BytesIO(json.dumps(document, ensure_ascii=False).encode("utf-8")),
+                                  chunk_size=7)
+        self.assertEqual(streamed["head"], document["head"])
+        self.assertEqual(streamed.toQuery(), document)
+
+        closed = []
+        streamed = StreamedResult(BytesIO(json.dumps(query_result(rows)).encode("utf-8")),
+                                  chunk_size=64, on_close=closed.append)
+        self.assertEqual(next(decodeRecords(streamed)).toBinding(), rows[0])
+        self.assertLess(len(streamed._reader.text), 200)
+        streamed.close()
+        self.assertEqual(closed, [False])
+
+
+class TestCase3_Registry(unittest.TestCase):
+    def test_0(self):
+        """LiveResultSets ignore transient changes"""
+        def actuator(n, name="a"):
+            return {"action": uri("http://a{}".format(n)), "name": literal(name)}
+        engine = cocktail_engine()
+        subscriptions = len(engine.get_subscriptions())
+        changes = []
+        live = LiveResultSet(engine, "DESCRIBE_ACTION", "action", forcedBindings={"action_uri": "UNDEF"},
+                             on_change=lambda added, removed: changes.append((added, removed)))
+        live.handler([actuator(1), actuator(1, "b"), actuator(2)], [])
+        live.start()
+        self.assertEqual(len(engine.get_subscriptions()), subscriptions+1)
+        self.assertEqual(len(live), 2)
+        live.handler([actuator(2)], [actuator(2)])
+        live.handler([actuator(1)], [])
+        self.assertEqual(len(changes), 1)
+        live.handler([], [actuator(2)])
+        self.assertEqual(changes[-1], ([], [actuator(2)]))
+        self.assertNotIn("http://a2", live)
+        self.assertIn("<http://a1>", live)
+        self.assertEqual(len(live.get("http://a1")), 2)
+        live.stop()
+        self.assertEqual(len(engine.get_subscriptions()), subscriptions)
+
+        changes = []
+        debounced = LiveResultSet(engine, "DESCRIBE_ACTION", "action", debounce=60,
+                                  on_change=lambda added, removed: changes.append((added, removed)))
+        debounced.handler([actuator(1)], [])
+        debounced.handler([], [actuator(1)])
+        debounced.handler([actuator(1)], [])
+        debounced.handler([actuator(3)], [])
+        self.assertEqual(changes, [])
+        debounced.flush()
+        self.assertEqual(sorted(changes[0][0], key=str), [actuator(1), actuator(3)])
+        self.assertEqual(debounced.keys(), ["http://a1", "http://a3"])
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
@@ -0,0 +1,38 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  __init__.py
+#
+#  Copyright 2018 Francesco Antoniazzi <francesco.antoniazzi@unibo.it>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from os import environ
+from cocktail.memory_engine import MemorySEPA
+
+
+def make_test_engine(sapObject, logLevel):
+    """
+    The engine used by the tests: a MemorySEPA, unless the environment
+    variable COCKTAIL_TEST_ENGINE is set to 'sepa', to test against the
+    SEPA broker of the sap (localhost:8000/9000).
+    """
+    if environ.get("COCKTAIL_TEST_ENGINE", "memory") == "sepa":
+        from sepy.SEPA import SEPA
+        return SEPA(sapObject=sapObject, logLevel=logLevel)
+    return MemorySEPA(sapObject=sapObject, logLevel=logLevel)
@@ -33,7 +33,7 @@ from cocktail.Property import Property
 from cocktail.Action import *
 from cocktail.Event import *
 from cocktail import __name__ as cName
-from cocktail.utils import generate_cocktail_sap, sparqlFolderToSap, compare_queries
+from cocktail.utils import cocktail_sap_content, sparqlFolderToSap, compare_queries
 
 from os.path import isfile, splitext
 from os import listdir
@@ -41,7 +41,6 @@ from os import listdir
 import sys
 import argparse
 import logging
-import yaml
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
@@ -326,8 +325,7 @@ def rebuild_test_7(engine):
 
 def main(args):
     logging.info("Setting up SAP objects and SEPA engine object...")
-    sap_file = generate_cocktail_sap(None)
-    ysap = SAPObject(yaml.load(sap_file))
+    ysap = SAPObject(cocktail_sap_content())
     engine = SEPA(sapObject=ysap, logLevel=logging.INFO)
     
     rebuild_test_0(engine)
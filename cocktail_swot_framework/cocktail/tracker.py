@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  tracker.py
+#
+#  Copyright 2019 Francesco Antoniazzi <francesco.antoniazzi1991@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from concurrent.futures import Future, InvalidStateError
+from threading import RLock, Lock
+from weakref import WeakKeyDictionary, proxy
+from .utils import plainURI
+from .scheduling import timerQueue
+
+import logging
+
+logger = logging.getLogger("cocktail_log")
+
+OUTPUT_VARIABLES = ["od", "oValue", "oDS"]
+_trackers = WeakKeyDictionary()
+_trackers_lock = Lock()
+
+
+def getTracker(sepa):
+    """
+    Returns the RequestTracker shared by the users of 'sepa' that do not
+    give their own one. It refers to 'sepa' weakly, so that both are
+    collected, with the subscriptions of the tracker, once 'sepa' is
+    no longer used.
+    """
+    with _trackers_lock:
+        if sepa not in _trackers:
+            _trackers[sepa] = RequestTracker(proxy(sepa))
+        return _trackers[sepa]
+
+
+class PendingRequest:
+    """
+    An action instance followed by a RequestTracker.
+    'confirmation', 'completion' and 'output' are Futures, set with the
+    binding of the timestamp ({"ts": ...}) or of the output
+    ({"od": ..., "oValue": ..., "oDS": ...}) when it reaches the rdf
+    store. The handlers, if any, are called as the subscription handlers
+    of Action.newRequest would be, i.e. handler(added, removed).
+    When the request is forgotten by its tracker, the Futures not set
+    yet are cancelled.
+    """
+    def __init__(self, instance, confirm_handler=None,
+                 completion_handler=None, output_handler=None):
+        self.instance = instance
+        self.confirmation = Future()
+        self.completion = Future()
+        self.output = Future()
+        self._handlers = {"confirmation": confirm_handler,
+                          "completion": completion_handler,
+                          "output": output_handler}
+        self._timer = None
+
+    def _set(self, step, binding):
+        future = getattr(self, step)
+        try:
+            future.set_result(binding)
+        except InvalidStateError:
+            # already set, cancelled, or timed out
+            return
+        handler = self._handlers[step]
+        if handler is not None:
+            try:
+                handler([binding], [])
+            except Exception as e:
+                logger.error("{} handler of {} failed: {}".format(step, self.instance, e))
+
+    def _update(self, row):
+        """
+        Updates the request with a SUBSCRIBE_ACTION_REQUESTS row.
+        Returns True when the request is completed.
+        """
+        if "confirmationTS" in row:
+            self._set("confirmation", {"ts": row["confirmationTS"]})
+        if "od" in row:
+            self._set("output", {key: row[key] for key in OUTPUT_VARIABLES if key in row})
+        if "completionTS" in row:
+            self._set("completion", {"ts": row["completionTS"]})
+        return self.completion.done()
+
+    def _drop(self, exception=None):
+        """
+        Cancels the Futures not set yet, or sets 'exception' on them
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+        for future in (self.confirmation, self.output, self.completion):
+            if exception is None:
+                future.cancel()
+            else:
+                try:
+                    future.set_exception(exception)
+                except InvalidStateError:
+                    pass
+
+    @property
+    def done(self):
+        return self.completion.done()
+
+
+class RequestTracker:
+    """
+    Follows the action requests of a client with a single subscription
+    per Action (or a single one overall, if the client gives its 'author'
+    uri), instead of three subscriptions per request. Notifications are
+    routed to the PendingRequest of their action instance, which is
+    forgotten as soon as the request is completed, or if the instance
+    is removed from the rdf store before completion.
+    """
+    def __init__(self, sepa, author=None):
+        self._sepa = sepa
+        self._author = author
+        self._lock = RLock()
+        self._pending = {}
+        self._subids = {}
+
+    def track(self, action, instance, confirm_handler=None,
+              completion_handler=None, output_handler=None, timeout=None):
+        """
+        Starts following 'instance', a request of the 'action' Action.
+        To avoid missing notifications, call it before posting the
+        request. Returns the PendingRequest.
+        If the request is not completed within 'timeout' seconds, its
+        Futures not set yet raise TimeoutError, and it is forgotten.
+        """
+        request = PendingRequest(
+            instance, confirm_handler=confirm_handler,
+            completion_handler=completion_handler, output_handler=output_handler)
+        with self._lock:
+            self._pending[plainURI(instance)] = request
+            self._subscribe(action)
+        if timeout is not None:
+            request._timer = timerQueue().schedule(
+                timeout, lambda: self.untrack(instance, exception=TimeoutError(
+                    "Request {} timed out after {}s".format(instance, timeout))))
+        return request
+
+    def untrack(self, instance, exception=None):
+        """
+        Stops following 'instance', cancelling its pending Futures, or
+        setting 'exception' on them.
+        """
+        with self._lock:
+            request = self._pending.pop(plainURI(instance), None)
+        if request is not None:
+            request._drop(exception=exception)
+
+    def _subscribe(self, action):
+        key = None if self._author is not None else action.uri
+        if key in self._subids:
+            return
+        forcedBindings = {"action_uri": "UNDEF" if key is None else action.uri,
+                          "author_uri": "UNDEF" if self._author is None else self._author}
+        self._subids[key] = self._sepa.subscribe(
+            "SUBSCRIBE_ACTION_REQUESTS",
+            "requests_"+("author" if key is None else action.uri),
+            forcedBindings=forcedBindings, handler=self._handler)
+
+    def _handler(self, added, removed):
+        with self._lock:
+            updates = [(self._pending[row["aInstance"]["value"]], row) for row in added
+                       if row["aInstance"]["value"] in self._pending]
+        # handlers are called out of the lock
+        completed = [request.instance for request, row in updates if request._update(row)]
+        # instances removed from the rdf store before their completion
+        dropped = set(row["aInstance"]["value"] for row in removed) - set(
+            row["aInstance"]["value"] for row in added)
+        with self._lock:
+            completed = [self._pending.pop(plainURI(instance), None) for instance in completed]
+        for request in completed:
+            if request is not None:
+                # steps never notified (e.g. the output of an action
+                # completed without one) are not waited for anymore
+                request._drop()
+        for instance in dropped:
+            if instance in self:
+                logger.debug("Request {} removed before completion".format(instance))
+                self.untrack(instance)
+
+    def stop(self):
+        """
+        Closes the subscriptions, and forgets the pending requests
+        """
+        with self._lock:
+            subids = list(self._subids.values())
+            self._subids = {}
+            pending = list(self._pending.keys())
+        for subid in subids:
+            self._sepa.unsubscribe(subid)
+        for instance in pending:
+            self.untrack(instance)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, instance):
+        return plainURI(instance) in self._pending
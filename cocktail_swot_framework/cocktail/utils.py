@@ -24,11 +24,14 @@
 
 from sepy.SAPObject import generate, defaultdict_to_dict, YsapTemplate
 from sepy.tablaze import tablify
-from os import listdir
-from os.path import splitext, isfile, split
+from os import listdir, makedirs, environ, replace
+from os.path import splitext, isfile, split, join, expanduser
+from urllib.parse import urlsplit
 from pkg_resources import resource_filename
-from collections import defaultdict
+from .templates import getTemplate
+from collections import defaultdict, Counter
 
+import hashlib
 import logging
 import yaml
 import json
@@ -41,6 +44,15 @@ COCKTAIL_NAMESPACES = {
     "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
     "swot": "http://wot.arces.unibo.it/ontology/web_of_things#"}
 
+COCKTAIL_SAP_FOLDERS = {
+    "queries": ["queries", "subscribes"],
+    "updates": ["updates", "deletes"]}
+# an empty COCKTAIL_CACHE_DIR keeps the compiled sap only in memory
+COCKTAIL_CACHE_DIR = environ.get(
+    "COCKTAIL_CACHE_DIR",
+    join(expanduser("~"), ".cache", "cocktail") if expanduser("~") != "~" else "") or None
+_compiled_sap = {}
+
 
 def sparqlFolderToSap(queryfolder, file_filter=None):
     """
@@ -55,19 +67,86 @@ def sparqlFolderToSap(queryfolder, file_filter=None):
             filepath = queryfolder+"/"+item
             if (isfile(filepath) and (splitext(item)[1] == ".sparql")):
                 with open(filepath, "r") as csa:
-                    y = yaml.load(csa)
+                    y = yaml.load(csa, Loader=yaml.SafeLoader)
                 sapDict.update(y)
             if file_filter == item:
                 break
     return sapDict
 
 
-def generate_cocktail_sap(destination, jinjaTemplate=YsapTemplate):
+def sparqlFoldersHash(folders, layout=None):
     """
-    This function generates into the file at path 'destination' a sap file
-    according to the 'jinjaTemplate' given for the cocktail framework.
-    The default is an ysap output. The file is also returned as string.
+    Computes a content hash of the .sparql files contained in 'folders',
+    and of the folder each one sits in. The 'layout' dictionary, if
+    given, is hashed as well.
+    """
+    sha = hashlib.sha1()
+    if layout is not None:
+        sha.update(json.dumps(layout, sort_keys=True).encode("utf-8"))
+    for folder in folders:
+        sha.update(split(folder.rstrip("/"))[1].encode("utf-8")+b"/")
+        for item in sorted(listdir(folder)):
+            filepath = folder+"/"+item
+            if (isfile(filepath) and (splitext(item)[1] == ".sparql")):
+                sha.update(item.encode("utf-8"))
+                with open(filepath, "rb") as csa:
+                    sha.update(csa.read())
+    return sha.hexdigest()
+
+
+def cocktail_sap_dict(cache_dir=COCKTAIL_CACHE_DIR):
     """
+    Returns the dictionary {"queries": ..., "updates": ...} merging all the
+    .sparql files of the cocktail package.
+    The dictionary is parsed from yaml only the first time: it is then
+    stored as json in 'cache_dir', with a name depending on the content
+    hash of the .sparql folders, so that later processes skip yaml parsing.
+    Set 'cache_dir' to None (or the COCKTAIL_CACHE_DIR environment
+    variable to an empty string) to keep the compiled dictionary only in
+    memory. A 'cache_dir' that cannot be written is not used.
+    Every call returns a fresh copy, that can be modified freely.
+    """
+    if cache_dir not in _compiled_sap:
+        folders = {
+            key: [resource_filename(__name__, f) for f in subfolders]
+            for key, subfolders in COCKTAIL_SAP_FOLDERS.items()}
+        content_hash = sparqlFoldersHash(
+            [f for key in sorted(folders) for f in folders[key]],
+            layout=COCKTAIL_SAP_FOLDERS)
+        compiled = None
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = join(cache_dir, "cocktail_sap_{}.json".format(content_hash))
+            try:
+                with open(cache_file, "r") as cached:
+                    compiled = cached.read()
+                # a truncated or corrupt file is compiled again
+                json.loads(compiled)
+                logger.debug("Loaded compiled sap from {}".format(cache_file))
+            except (OSError, ValueError):
+                logger.debug("Compiled sap not available in {}".format(cache_file))
+                compiled = None
+        if compiled is None:
+            sapDict = {}
+            for key, subfolders in folders.items():
+                sapDict[key] = {}
+                for folder in subfolders:
+                    sapDict[key].update(sparqlFolderToSap(folder))
+            compiled = json.dumps(sapDict)
+            if cache_file is not None:
+                try:
+                    makedirs(cache_dir, exist_ok=True)
+                    with open(cache_file+".tmp", "w") as cached:
+                        cached.write(compiled)
+                    replace(cache_file+".tmp", cache_file)
+                except OSError as e:
+                    logger.debug("Unable to store compiled sap: {}".format(e))
+        _compiled_sap[cache_dir] = compiled
+    return json.loads(_compiled_sap[cache_dir])
+
+
+def _cocktail_protocols():
+    # sparql 1.1 and sparql 1.1 SE protocol sections of the cocktail sap
     nested_dict = lambda: defaultdict(nested_dict)
     sparql11 = nested_dict()
     sparql11["protocol"] = "http"
@@ -86,12 +165,41 @@ def generate_cocktail_sap(destination, jinjaTemplate=YsapTemplate):
     sparql11se["availableProtocols"]["wss"]["port"] = 9443
     sparql11se["availableProtocols"]["wss"]["path"] = "/secure/subscribe"
     sparql11se = defaultdict_to_dict(sparql11se)
+    return sparql11, sparql11se
+
+
+def cocktail_sap_content(cache_dir=COCKTAIL_CACHE_DIR):
+    """
+    Returns the cocktail sap as a dictionary, to be given to SAPObject,
+    with the same content of the file written by generate_cocktail_sap.
+    No template is rendered and no yaml is parsed, if the dictionary of
+    the .sparql files is in 'cache_dir' (see cocktail_sap_dict).
+    """
+    sparql11, sparql11se = _cocktail_protocols()
+    sapDict = cocktail_sap_dict(cache_dir=cache_dir)
+    # as in the generated file, where empty default values become null
+    for sparqlSet in ("queries", "updates"):
+        for entry in sapDict[sparqlSet].values():
+            for binding in entry.get("forcedBindings", {}).values():
+                if binding.get("value") == "":
+                    binding["value"] = None
+    sapDict.update({"host": "localhost",
+                    "sparql11protocol": defaultdict_to_dict(sparql11),
+                    "sparql11seprotocol": sparql11se,
+                    "namespaces": dict(COCKTAIL_NAMESPACES)})
+    return sapDict
 
-    queries = sparqlFolderToSap(resource_filename(__name__, "queries"))
-    queries.update(sparqlFolderToSap(resource_filename(__name__, "subscribes")))
 
-    updates = sparqlFolderToSap(resource_filename(__name__, "updates"))
-    updates.update(sparqlFolderToSap(resource_filename(__name__, "deletes")))
+def generate_cocktail_sap(destination, jinjaTemplate=YsapTemplate):
+    """
+    This function generates into the file at path 'destination' a sap file
+    according to the 'jinjaTemplate' given for the cocktail framework.
+    The default is an ysap output. The file is also returned as string.
+    """
+    sparql11, sparql11se = _cocktail_protocols()
+    sapDict = cocktail_sap_dict()
+    queries = sapDict["queries"]
+    updates = sapDict["updates"]
     
     if destination is not None:
         logger.info("Writing sap file to {}: please customize it from there".format(destination))
@@ -105,15 +213,38 @@ def generate_cocktail_sap(destination, jinjaTemplate=YsapTemplate):
                     destination_file=destination)
 
 
+def plainURI(uri):
+    """
+    Removes the angle brackets from 'uri', if any
+    """
+    if uri.startswith("<") and uri.endswith(">"):
+        return uri[1:-1]
+    return uri
+
+
+def absoluteURI(uri, namespaces=COCKTAIL_NAMESPACES):
+    """
+    Returns 'uri' without angle brackets if it is an absolute one, or the
+    expansion of the prefixed name 'uri' with 'namespaces' (the dictionary
+    of the sap). Raises ValueError otherwise.
+    """
+    if uri.startswith("<") and uri.endswith(">"):
+        if urlsplit(uri[1:-1]).scheme:
+            return uri[1:-1]
+    else:
+        prefix, colon, local = uri.partition(":")
+        if colon and (prefix in namespaces):
+            return namespaces[prefix] + local
+    raise ValueError("{} is not an absolute uri, nor a known prefixed name".format(uri))
+
+
 def forPropertySparqlBuilder(sap, ip, properties):
     """
     This function, given the 'sap' object and the 'ip'-interaction pattern
     builds up the sparql to connect the ip with the 'properties', with the
     wot:forProperty predicate.
     """
-    sparql = sap.getSparql(
-        sap.updates, "ADD_FORPROPERTY",
-        forcedBindings={"ip": ip}, bindingCheck=False)
+    sparql = getTemplate(sap, "ADD_FORPROPERTY").render({"ip": ip, "property": None})
     pFirstBind = [p.bindings["property"] for p in properties]
     pSecondBind = ["{} a wot:Property".format(p) for p in pFirstBind]
     sparql = sparql.replace("?property", ", ".join(pFirstBind), 1)
@@ -121,6 +252,29 @@ def forPropertySparqlBuilder(sap, ip, properties):
     return sparql
 
 
+def batch_update(sepa, sparqls):
+    """
+    This function sends the list of 'sparqls' updates to the 'sepa' as a
+    single SPARQL 1.1 update request, separating them with ';'.
+    If the broker rejects the request, the batch is split in two halves,
+    sent separately (recursively). A single update that is rejected raises
+    the original exception.
+    Returns the number of requests accepted by the broker, rejected ones
+    not included.
+    """
+    if not sparqls:
+        return 0
+    try:
+        sepa.sparql_update(" ;\n".join(sparqls))
+        return 1
+    except ValueError as e:
+        if len(sparqls) == 1:
+            raise
+        logger.warning("Batch of {} updates rejected, splitting it: {}".format(len(sparqls), e))
+        half = len(sparqls)//2
+        return batch_update(sepa, sparqls[:half]) + batch_update(sepa, sparqls[half:])
+
+
 def cfr_bindings(bA, bB, ignorance):
     """
     bA is a list of bindings, bB is another list of bindings
@@ -164,6 +318,77 @@ def diff_JsonQuery(jA, jB, ignore_val=[], show_diff=False, log_message=""):
     return result
 
 
+def canonical_binding(binding, ignorance=[]):
+    """
+    Transforms a 'binding' into a hashable key. Blank nodes are skipped,
+    while the keys in 'ignorance' only keep their type, so that their
+    value does not take part to the comparison.
+    """
+    return frozenset(
+        (key, cell["type"], None if key in ignorance else cell["value"])
+        for key, cell in binding.items() if cell["type"] != "bnode")
+
+
+class QueryDiff:
+    """
+    Result of the indexed comparison of two query outputs A and B.
+    'missing_in_a' contains the bindings of B that have no counterpart
+    in A, 'missing_in_b' the bindings of A that have no counterpart in B.
+    The object is True when A and B are equal.
+    """
+    def __init__(self, missing_in_a, missing_in_b, count_a, count_b, vars_equal=True):
+        self.missing_in_a = missing_in_a
+        self.missing_in_b = missing_in_b
+        self.count_a = count_a
+        self.count_b = count_b
+        self.vars_equal = vars_equal
+
+    @property
+    def equal(self):
+        return self.vars_equal and not (self.missing_in_a or self.missing_in_b)
+
+    @property
+    def counts(self):
+        return {"A": self.count_a, "B": self.count_b,
+                "missing_in_A": len(self.missing_in_a),
+                "missing_in_B": len(self.missing_in_b)}
+
+    def __bool__(self):
+        return self.equal
+
+    def __repr__(self):
+        return "QueryDiff({})".format(self.counts)
+
+
+def diff_queries(jA, jB, ignore_val=[]):
+    """
+    Linear time comparison of the outputs of query json jA towards jB.
+    Each binding is canonicalized with 'canonical_binding', and the two
+    results are compared as multisets: duplicated bindings have to appear
+    the same number of times in both outputs.
+    Returns a QueryDiff object.
+    """
+    bindingsA = jA["results"]["bindings"]
+    bindingsB = jB["results"]["bindings"]
+    indexA = Counter(canonical_binding(b, ignore_val) for b in bindingsA)
+    indexB = Counter(canonical_binding(b, ignore_val) for b in bindingsB)
+    missing_in_b = _exceeding_bindings(bindingsA, indexA - indexB, ignore_val)
+    missing_in_a = _exceeding_bindings(bindingsB, indexB - indexA, ignore_val)
+    return QueryDiff(missing_in_a, missing_in_b, len(bindingsA), len(bindingsB))
+
+
+def _exceeding_bindings(bindings, exceeding, ignorance):
+    # picks from 'bindings' as many items as requested by the 'exceeding' counter
+    result = []
+    if exceeding:
+        for binding in bindings:
+            key = canonical_binding(binding, ignorance)
+            if exceeding[key] > 0:
+                exceeding[key] -= 1
+                result.append(binding)
+    return result
+
+
 def load_json(j):
     try:
         with open(j, "r") as fA:
@@ -176,7 +401,7 @@ def load_json(j):
     return output
 
 
-def compare_queries(i_jA, i_jB, show_diff=False, ignore_val=[], strictVars=True):
+def compare_queries(i_jA, i_jB, show_diff=False, ignore_val=[], strictVars=True, indexed=False):
     """
     This function compares two json outputs of a SPARQL query.
     jA, jB params are the two json objects containing the results of the query.
@@ -190,6 +415,9 @@ def compare_queries(i_jA, i_jB, show_diff=False, ignore_val=[], strictVars=True)
     strictVars parameters checks that ["head"]["vars"] fields are the same.
     If true, it returns false in case of non equality. Otherwise it only
     notifies a warning.
+    When 'indexed' is True, the comparison is performed in linear time by
+    'diff_queries', and a QueryDiff object is returned instead of the
+    boolean. The QueryDiff evaluates to True when jA==jB.
     """
     # Dealing with paths vs json objects as arguments
     jA = load_json(i_jA)
@@ -204,7 +432,22 @@ def compare_queries(i_jA, i_jB, show_diff=False, ignore_val=[], strictVars=True)
         for item in (setVarB-setVarA):
             logging.warning("B->A Variable '{}'  not found!".format(item))
         if strictVars:
+            if indexed:
+                return QueryDiff([], [], len(jA["results"]["bindings"]),
+                                 len(jB["results"]["bindings"]), vars_equal=False)
             return False
+
+    if indexed:
+        diff = diff_queries(jA, jB, ignore_val=ignore_val)
+        if show_diff:
+            for message, j, bindings in (("A->B", jA, diff.missing_in_b),
+                                         ("B->A", jB, diff.missing_in_a)):
+                if bindings:
+                    jdiff = {"head": {"vars": j["head"]["vars"]},
+                             "results": {"bindings": bindings}}
+                    logger.warning("{} Differences:\n{}".format(
+                        message, tablify(jdiff, destination=None)))
+        return diff
             
     # A->B
     # Check if every binding in A exists also in B
@@ -57,10 +57,23 @@ def subscription_handler(added, removed):
 
 def main(args):
     with open(args["ysap_file"], "r") as ysap_file:
-        ysap = SAPObject(yaml.load(ysap_file))
+        ysap = SAPObject(yaml.load(ysap_file, Loader=yaml.SafeLoader))
     engine = SEPA(sapObject=ysap, logLevel=logging.ERROR)
     try:
-        if not args["subscribe"]:
+        if (not args["subscribe"]) and args["page_size"]:
+            # Paged queries, printing the results while they arrive
+            for flag, name, category in [("thing", "Thing", Thing), ("action", "Action", Action),
+                                         ("event", "Event", Event), ("property", "Property", Property),
+                                         ("dataschema", "DataSchema", DataSchema)]:
+                if args[flag]:
+                    print("{} discovery:".format(name))
+                    for index, binding in enumerate(category.discover_iter(engine, page_size=args["page_size"])):
+                        if args["nice"]:
+                            for key in binding.keys():
+                                print("{}.\t{}\t({}):\t{}".format(index, key, binding[key]["type"], binding[key]["value"]))
+                        else:
+                            print(binding)
+        elif not args["subscribe"]:
             # Plain queries using the direct cocktail call
             if args["thing"]:
                 print("Thing discovery:")
@@ -125,6 +138,8 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--property", action="store_true", help="Property discovery")
     parser.add_argument("-d", "--dataschema", action="store_true", help="DataSchema discovery")
     parser.add_argument("-n", "--nice", action="store_true", help="Nicer output flag")
+    parser.add_argument("-P", "--page-size", default=0, type=int,
+                        help="Query the results in pages of this size, printing them one by one")
     parser.add_argument("ysap_file", help="Path to cocktail ysap file")
     arguments = vars(parser.parse_args())
     sys.exit(main(arguments))